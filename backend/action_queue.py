@@ -0,0 +1,61 @@
+"""Per-character queues of pending socket actions, drained in batches.
+
+Clients on slow links often send several perform_action events back to
+back. Rather than each running its own read, write and state push, the
+actions are queued per character. The handler that finds a character's
+queue idle drains it, taking up to ACTION_BATCH_MAX actions at a time and
+running them as one batch (see game_logic.process_actions); actions that
+arrive meanwhile join the next batch. The queues are per worker.
+"""
+import os
+import threading
+from collections import deque
+
+# Most actions run in one batch
+ACTION_BATCH_MAX = int(os.environ.get('ACTION_BATCH_MAX', 10))
+
+# Character ID -> pending actions; present while a handler is draining it
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def enqueue(character_id, item):
+    """Queue an action. Returns True if the caller should drain the queue."""
+    with _queues_lock:
+        queue = _queues.get(character_id)
+        if queue is not None:
+            queue.append(item)
+            return False
+        _queues[character_id] = deque([item])
+        return True
+
+
+def next_batch(character_id):
+    """Take the next batch of pending actions, or [] once the queue is empty.
+
+    Returning [] ends the drain: the next action queued starts a new one.
+    """
+    with _queues_lock:
+        queue = _queues[character_id]
+        if not queue:
+            del _queues[character_id]
+            return []
+        return [queue.popleft() for _ in range(min(len(queue), ACTION_BATCH_MAX))]
+
+
+def drain(character_id, run_batch):
+    """Run batches from a character's queue until it is empty.
+
+    If run_batch raises, the queue is dropped so later actions can start a
+    new drain, and the error propagates.
+    """
+    try:
+        while True:
+            batch = next_batch(character_id)
+            if not batch:
+                return
+            run_batch(batch)
+    except Exception:
+        with _queues_lock:
+            _queues.pop(character_id, None)
+        raise
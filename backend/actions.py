@@ -0,0 +1,209 @@
+"""Action handlers, registered by action type.
+
+Each action is a class that declares what the engine (game_logic.py) needs
+to know before running it:
+
+- ``cost``: AP spent. Actions that spend AP also name the Lua ``script``
+  that re-checks and deducts it on the server (see scripts.py), so
+  concurrent requests cannot double-spend it, and the ``denied`` message
+  for when AP is short.
+- ``validate(data)``: checks the client's action data before anything is
+  loaded from Redis.
+- ``preconditions``: (check(character, location), message) pairs, tried in
+  order after the AP check against the loaded character.
+- ``reads``: extra Redis reads (see models.ACTION_READS), fetched in the
+  same round trip as the character and passed to ``run`` by name.
+- ``name``, ``options`` and ``available()``: the action's menu entry and
+  when it is offered.
+
+``run`` decides the outcome in memory, without I/O, and returns a result
+made with ``succeed`` or ``fail``; the engine deducts the AP cost. Register
+a class with @register; menus list actions in registration order.
+"""
+from world_data import get_world_bounds
+
+# Action type -> handler, in registration order
+ACTIONS = {}
+
+
+def register(cls):
+    """Class decorator adding an action handler to ACTIONS."""
+    ACTIONS[cls.type] = cls()
+    return cls
+
+
+def succeed(message, log_entry='', position=None, stats=None):
+    """A successful result, with the position and stats the action changes."""
+    character_updates = {}
+    if position is not None:
+        character_updates['position'] = position
+    if stats is not None:
+        character_updates['stats'] = stats
+    return {'success': True, 'message': message, 'character_updates': character_updates, 'log_entry': log_entry}
+
+
+def fail(message):
+    """A refused action's result."""
+    return {'success': False, 'message': message, 'character_updates': {}, 'log_entry': ''}
+
+
+class Action:
+    """Base for action handlers; see the module docstring for what to declare."""
+
+    type = None
+    name = None
+    options = ()
+    cost = 0
+    script = None
+    denied = None
+    preconditions = ()
+    reads = ()
+
+    def validate(self, data):
+        """An error message if the action data is malformed, otherwise None."""
+        return None
+
+    def check(self, character, location):
+        """The reason the action cannot run now, or None."""
+        if character['ap'] < self.cost:
+            return self.denied
+        for condition, message in self.preconditions:
+            if not condition(character, location):
+                return message
+        return None
+
+    def available(self, has_building, inside_building):
+        """Whether the action is offered on a tile in this building state."""
+        return True
+
+    def menu_entry(self):
+        return {'type': self.type, 'name': self.name, 'options': [dict(option) for option in self.options]}
+
+    def run(self, character, location, data, reads):
+        raise NotImplementedError
+
+
+def _has_building(character, location):
+    return bool(location and location.has_building)
+
+
+def _inside_building(character, location):
+    return bool(character['inside_building'])
+
+
+@register
+class Move(Action):
+    type = 'MOVE'
+    name = 'Move'
+    options = (
+        {'value': 'north', 'label': 'North'},
+        {'value': 'east', 'label': 'East'},
+        {'value': 'south', 'label': 'South'},
+        {'value': 'west', 'label': 'West'}
+    )
+
+    # Direction -> (dx, dy)
+    DIRECTIONS = {'north': (0, -1), 'east': (1, 0), 'south': (0, 1), 'west': (-1, 0)}
+
+    def validate(self, data):
+        if data.get('direction') not in self.DIRECTIONS:
+            return 'Invalid direction'
+        return None
+
+    def available(self, has_building, inside_building):
+        return not inside_building
+
+    def run(self, character, location, data, reads):
+        direction = data['direction']
+        dx, dy = self.DIRECTIONS[direction]
+
+        # Stay within the world's bounds
+        width, height = get_world_bounds()
+        new_x = min(max(character['x'] + dx, 0), width - 1)
+        new_y = min(max(character['y'] + dy, 0), height - 1)
+
+        if new_x == character['x'] and new_y == character['y']:
+            return succeed("You can't move any further in that direction.")
+
+        return succeed(
+            f'Moved {direction}',
+            f'Moved {direction} to ({new_x}, {new_y})',
+            position={'x': new_x, 'y': new_y, 'inside_building': False}
+        )
+
+
+@register
+class EnterBuilding(Action):
+    type = 'ENTER_BUILDING'
+    name = 'Enter Building'
+    cost = 1
+    script = 'enter_building'
+    denied = 'Not enough AP to enter building'
+    preconditions = ((_has_building, 'No building to enter at this location'),)
+
+    def available(self, has_building, inside_building):
+        return has_building and not inside_building
+
+    def run(self, character, location, data, reads):
+        building_name = location.building_name or 'building'
+        return succeed(
+            f'Entered {building_name}',
+            f'Entered {building_name} at ({character["x"]}, {character["y"]})',
+            position={'x': character['x'], 'y': character['y'], 'inside_building': True}
+        )
+
+
+@register
+class ExitBuilding(Action):
+    type = 'EXIT_BUILDING'
+    name = 'Exit Building'
+    cost = 1
+    script = 'exit_building'
+    denied = 'Not enough AP to exit building'
+    preconditions = ((_inside_building, 'Not inside a building'),)
+
+    def available(self, has_building, inside_building):
+        return inside_building
+
+    def run(self, character, location, data, reads):
+        building_name = (location and location.building_name) or 'building'
+        return succeed(
+            f'Exited {building_name}',
+            f'Exited {building_name} at ({character["x"]}, {character["y"]})',
+            position={'x': character['x'], 'y': character['y'], 'inside_building': False}
+        )
+
+
+@register
+class Rest(Action):
+    type = 'REST'
+    name = 'Rest'
+    cost = 2
+    script = 'rest'
+    denied = 'Not enough AP to rest (need 2 AP)'
+
+    def run(self, character, location, data, reads):
+        hp_recovery = min(10, character['max_health'] - character['health'])
+        mp_recovery = min(10, character['max_mp'] - character['mp'])
+        message = f'Rested and recovered {hp_recovery} HP and {mp_recovery} MP'
+        return succeed(message, message, stats={
+            'health': character['health'] + hp_recovery,
+            'mp': character['mp'] + mp_recovery
+        })
+
+
+@register
+class Search(Action):
+    type = 'SEARCH'
+    name = 'Search Area'
+    cost = 1
+    script = 'search'
+    denied = 'Not enough AP to search'
+
+    def run(self, character, location, data, reads):
+        # For now, just a simple search with no rewards
+        location_type = 'building' if character['inside_building'] else 'area'
+        return succeed(
+            f'Searched the {location_type} but found nothing',
+            f'Searched the {location_type} at ({character["x"]}, {character["y"]}) but found nothing'
+        )
@@ -0,0 +1,134 @@
+"""Pushes regenerated AP to online players.
+
+AP itself regenerates lazily (see models.regenerate_ap), so nothing here
+writes characters. This module only tells open clients when their AP ticks up.
+
+Online characters whose AP is below max are kept in sorted sets scored by
+when they next gain AP, split into AP_TICK_SHARDS shards by character ID.
+Each tick a worker leases whichever shards are free, reads the characters
+that are due in batched pipelines, pushes their new AP and reschedules or
+drops them. Offline and full characters are never visited, so a tick costs
+a constant amount of Redis work per online player that is due, however many
+characters exist.
+
+With the character cache (see character_cache.py), the owning worker may
+not have flushed a character's latest AP to its hash yet. Its journal
+holds every change not yet flushed, so the tick applies the journal over
+the hash, whichever worker owns the character.
+"""
+import os
+import threading
+import time
+
+import character_cache
+from database import get_db
+from models import regenerate_ap, next_ap_regen_at
+from presence import NODE_ID
+
+AP_TICK_INTERVAL = float(os.environ.get('AP_TICK_INTERVAL', 1))
+AP_TICK_SHARDS = int(os.environ.get('AP_TICK_SHARDS', 16))
+AP_TICK_BATCH = int(os.environ.get('AP_TICK_BATCH', 500))
+
+
+def _due_key(character_id):
+    return f'ap_regen:due:{int(character_id) % AP_TICK_SHARDS}'
+
+
+def schedule(character):
+    """Queue an online character's next AP push, or drop it once AP is full."""
+    key = _due_key(character['id'])
+    member = f"{character['id']}:{character['user_id']}"
+
+    due = next_ap_regen_at(character)
+    if due is None:
+        get_db().zrem(key, member)
+    else:
+        get_db().zadd(key, {member: due})
+
+
+def unschedule(character_id, user_id):
+    """Stop pushing AP to a character whose player went offline."""
+    get_db().zrem(_due_key(character_id), f'{character_id}:{user_id}')
+
+
+def tick(push):
+    """Push AP to every due character in the shards this worker can lease.
+
+    ``push(user_id, fields)`` sends changed character fields to a player.
+    """
+    db = get_db()
+
+    seconds, microseconds = db.time()
+    now = seconds * 1000 + microseconds // 1000
+
+    # Lease shards for one tick, so concurrent workers split them
+    pipe = db.pipeline(transaction=False)
+    for shard in range(AP_TICK_SHARDS):
+        pipe.set(f'ap_regen:lease:{shard}', NODE_ID, nx=True, px=int(AP_TICK_INTERVAL * 1000))
+    leased = [shard for shard, acquired in enumerate(pipe.execute()) if acquired]
+
+    for shard in leased:
+        _tick_shard(db, f'ap_regen:due:{shard}', now, push)
+
+
+def _tick_shard(db, key, now, push):
+    while True:
+        members = db.zrangebyscore(key, '-inf', now, start=0, num=AP_TICK_BATCH)
+        if not members:
+            return
+
+        ids = [member.split(':') for member in members]
+        pipe = db.pipeline(transaction=False)
+        for character_id, user_id in ids:
+            pipe.hmget(f'character:{character_id}', 'ap', 'max_ap', 'ap_updated_at')
+            pipe.sismember('presence:online', user_id)
+            if character_cache.ENABLED:
+                pipe.xrange(f'character_journal:{character_id}')
+        replies = pipe.execute()
+
+        stride = 3 if character_cache.ENABLED else 2
+        pipe = db.pipeline(transaction=False)
+        for i, ((character_id, user_id), member) in enumerate(zip(ids, members)):
+            ap, max_ap, ap_updated_at = replies[i * stride]
+            online = replies[i * stride + 1]
+            if ap is None or not online:
+                pipe.zrem(key, member)
+                continue
+
+            if character_cache.ENABLED:
+                # Journal entries hold absolute values, newest last
+                for _, fields in replies[i * stride + 2]:
+                    ap = fields.get('ap', ap)
+                    ap_updated_at = fields.get('ap_updated_at', ap_updated_at)
+
+            character = regenerate_ap(
+                {'ap': int(ap), 'max_ap': int(max_ap or 0), 'ap_updated_at': int(ap_updated_at or 0)}, now
+            )
+            push(int(user_id), {'ap': character['ap'], 'ap_updated_at': character['ap_updated_at']})
+
+            due = next_ap_regen_at(character)
+            if due is None:
+                pipe.zrem(key, member)
+            else:
+                pipe.zadd(key, {member: due})
+        pipe.execute()
+
+        if len(members) < AP_TICK_BATCH:
+            return
+
+
+def _run_ticker(push):
+    while True:
+        started = time.monotonic()
+        try:
+            tick(push)
+        except Exception as e:
+            print(f'AP tick failed: {e}')
+        time.sleep(max(0.0, AP_TICK_INTERVAL - (time.monotonic() - started)))
+
+
+def start_ticker(push):
+    """Start the tick loop in a daemon thread (a green thread under eventlet)."""
+    thread = threading.Thread(target=_run_ticker, args=(push,), name='ap-regen-ticker', daemon=True)
+    thread.start()
+    return thread
@@ -1,31 +1,53 @@
-from flask import Flask, request, jsonify, render_template, session, redirect, url_for
+# Must come first: sets up eventlet monkey patching when that mode is enabled
+import concurrency
+
+from flask import Flask, Response, request, render_template, make_response, session, redirect, url_for, g
 from flask_cors import CORS
 import json
+import math
 import os
-from werkzeug.security import generate_password_hash, check_password_hash
+import time
 import uuid
-from datetime import datetime, timedelta
+from datetime import timedelta
 
 # Import other modules
-from database import init_db, get_db
-from models import create_user, get_user_by_username, get_character_by_user_id
-from game_logic import process_action, get_available_actions
-from world_data import initialize_world, get_location_info
-from auth import login_required
+from database import init_db, get_db, init_app as init_db_app
+from models import (create_user, get_user_by_username, get_character_id, get_action_logs_page,
+                    update_password_hash)
+from character_cache import get_character, get_position, start_flusher
+from game_logic import process_action, get_available_actions_json
+from world_data import initialize_world, get_location_info, get_world_bounds, get_world_version, start_world_listener
+from spatial import get_tile_occupants
+from auth import (login_required, check_rate_limit, start_session, end_session, session_valid,
+                  current_character_id)
+from scripts import load_scripts
+from serializer import jsonify, encode
+from passwords import HashingBusy, hash_password, verify_password, needs_rehash
+from presence import is_online, start_heartbeat
+from ap_regen import start_ticker
+import metrics
 
 app = Flask(__name__,
             static_folder='../frontend/static',
             template_folder='../frontend/templates')
 CORS(app)
 
-# Configure session
-app.secret_key = os.urandom(24)
+# Configure session. The signed session cookie is the auth token, so every
+# worker needs the same SECRET_KEY to verify it; the random fallback only
+# suits a single worker.
+app.secret_key = os.environ.get('SECRET_KEY') or os.urandom(24)
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=7)
 
+# Seconds browsers may reuse static assets before revalidating them. Their
+# URLs are not versioned, so keep this short enough for deploys to show up.
+STATIC_MAX_AGE = int(os.environ.get('STATIC_MAX_AGE', 300))
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = STATIC_MAX_AGE
+
 # Import socketio after app is created
-from socketio_events import socketio
+from socketio_events import socketio, init_socketio, push_state_patch, push_character_update, announce_move
 
-socketio.init_app(app)  # Initialize socketio with the app
+init_socketio(app)  # Initialize socketio with the app
+init_db_app(app)  # Share one Redis connection pool across HTTP and WebSocket handlers
 
 
 # Initialize database and world
@@ -33,12 +55,98 @@ socketio.init_app(app)  # Initialize socketio with the app
 def setup():
     init_db()
     initialize_world()
+    load_scripts(get_db())
+    start_world_listener(get_db())
+    start_heartbeat()
+    start_ticker(push_character_update)
+    start_flusher()
+
+
+# Time every request, and profile those that ask for it with X-Profile
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    if metrics.profile_requested(request.headers.get('X-Profile')):
+        g.profile = metrics.start_profile()
+
+
+@app.after_request
+def record_request_time(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        metrics.observe(
+            'http_request_duration_seconds',
+            time.perf_counter() - started,
+            endpoint=request.endpoint or 'unknown',
+            status=response.status_code
+        )
+    return response
+
+
+@app.teardown_request
+def finish_request_profile(error=None):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        metrics.finish_profile(f'{request.method} {request.path}', profile)
+
+
+@app.route('/metrics')
+def get_metrics():
+    """This worker's metrics in the Prometheus text format."""
+    if not metrics.authorized(request.headers.get('Authorization')):
+        return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/metrics/profiles')
+def get_profiles():
+    """Recent profiles from X-Profile requests, as collapsed stacks for flame graph tools."""
+    if not metrics.authorized(request.headers.get('Authorization')):
+        return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    return Response(metrics.render_profiles(), mimetype='text/plain')
+
+
+def render_page(template):
+    """Render a page with an ETag, so browsers revalidate it and get a 304 until a deploy changes it."""
+    response = make_response(render_template(template))
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+def not_modified(etag):
+    """A 304 if the client already has the response tagged ``etag``, otherwise None."""
+    if etag in request.if_none_match:
+        response = Response(status=304)
+        return _revalidate(response, etag)
+    return None
+
+
+def json_with_etag(body, etag):
+    """Send pre-encoded JSON that browsers keep but revalidate on every use."""
+    return _revalidate(Response(body.encoded, mimetype='application/json'), etag)
+
+
+def _revalidate(response, etag):
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def hashing_busy(busy):
+    """503 telling the client when to retry a login or signup."""
+    response = jsonify({'success': False, 'message': 'Server busy, try again shortly',
+                        'retry_after': busy.retry_after})
+    response.headers['Retry-After'] = str(busy.retry_after)
+    return response, 503
 
 
 # Auth routes
 @app.route('/')
 def index():
-    if 'user_id' in session:
+    if session_valid():
         return redirect(url_for('game'))
     return redirect(url_for('login'))
 
@@ -46,7 +154,7 @@ def index():
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'GET':
-        return render_template('login.html')
+        return render_page('login.html')
 
     data = request.get_json()
     username = data.get('username')
@@ -54,11 +162,21 @@ def login():
 
     user = get_user_by_username(username)
 
-    if not user or not check_password_hash(user['password_hash'], password):
-        return jsonify({'success': False, 'message': 'Invalid credentials'}), 401
+    try:
+        if not user or not verify_password(user['password_hash'], password):
+            return jsonify({'success': False, 'message': 'Invalid credentials'}), 401
+    except HashingBusy as busy:
+        return hashing_busy(busy)
+
+    # Move hashes made at an older cost to the configured one
+    if needs_rehash(user['password_hash']):
+        try:
+            update_password_hash(user['id'], hash_password(password))
+        except HashingBusy:
+            pass  # Rehash on a later login
 
-    session.permanent = True
-    session['user_id'] = user['id']
+    # Users created before the user record held the character ID need a lookup
+    start_session(user['id'], user.get('character_id') or get_character_id(user['id']))
 
     return jsonify({'success': True, 'redirect': '/game'})
 
@@ -66,7 +184,7 @@ def login():
 @app.route('/signup', methods=['GET', 'POST'])
 def signup():
     if request.method == 'GET':
-        return render_template('signup.html')
+        return render_page('signup.html')
 
     data = request.get_json()
     username = data.get('username')
@@ -80,12 +198,14 @@ def signup():
     if existing_user:
         return jsonify({'success': False, 'message': 'Username already exists'}), 400
 
-    password_hash = generate_password_hash(password)
     try:
-        user_id = create_user(username, password_hash, character_name)
+        password_hash = hash_password(password)
+    except HashingBusy as busy:
+        return hashing_busy(busy)
 
-        session.permanent = True
-        session['user_id'] = user_id
+    try:
+        user_id, character_id = create_user(username, password_hash, character_name)
+        start_session(user_id, character_id)
 
         return jsonify({'success': True, 'redirect': '/game'})
     except Exception as e:
@@ -94,7 +214,7 @@ def signup():
 
 @app.route('/logout')
 def logout():
-    session.clear()
+    end_session()
     return redirect(url_for('login'))
 
 
@@ -105,61 +225,105 @@ def game():
     # Check for a query parameter to use the Vue version
     use_vue = request.args.get('vue', '1') == '1'
     if use_vue:
-        return render_template('vue-game.html')
+        return render_page('vue-game.html')
     else:
-        return render_template('game.html')
+        return render_page('game.html')
 
 
 @app.route('/api/character')
 @login_required
-def get_character():
-    user_id = session['user_id']
-    character = get_character_by_user_id(user_id)
+def get_character_info():
+    character = get_character(current_character_id())
     return jsonify(character)
 
 
 @app.route('/api/location')
 @login_required
 def get_location():
-    user_id = session['user_id']
-    character = get_character_by_user_id(user_id)
-    location_info = get_location_info(character['x'], character['y'], character['inside_building'])
-    return jsonify(location_info)
+    """The player's location, tagged with the world version and position.
+
+    The response only changes when the player moves or the world is
+    reseeded, so a revalidation costs one HMGET and usually ends in a 304.
+    """
+    x, y, inside_building = get_position(current_character_id())
+    etag = f'{get_world_version()}-{x}-{y}-{int(inside_building)}'
+    return not_modified(etag) or json_with_etag(encode(get_location_info(x, y, inside_building)), etag)
+
+
+@app.route('/api/world')
+@login_required
+def get_world_info():
+    width, height = get_world_bounds()
+    return jsonify({'width': width, 'height': height})
+
+
+@app.route('/api/location/occupants')
+@login_required
+def get_occupants():
+    """Page through the characters on the player's side of the tile, including the player.
+
+    Pass the previous page's ``next_after`` as ``after`` to get the next page.
+    """
+    x, y, inside_building = get_position(current_character_id())
+    after = request.args.get('after', type=int)
+    limit = request.args.get('limit', 20, type=int)
+    return jsonify(get_tile_occupants(x, y, inside_building, after=after, limit=limit))
 
 
 @app.route('/api/actions')
 @login_required
 def get_actions():
-    user_id = session['user_id']
-    character = get_character_by_user_id(user_id)
-    actions = get_available_actions(character['x'], character['y'], character['inside_building'])
-    return jsonify(actions)
+    """The player's action menu, tagged with a hash of the pre-encoded menu."""
+    actions = get_available_actions_json(*get_position(current_character_id()))
+    return not_modified(actions.etag) or json_with_etag(actions, actions.etag)
 
 
 @app.route('/api/action', methods=['POST'])
 @login_required
 def perform_action():
     user_id = session['user_id']
-    data = request.get_json()
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'success': False, 'message': 'Invalid request'}), 400
     action_type = data.get('action_type')
+    action_data = data.get('action_data')
 
     if not action_type:
         return jsonify({'success': False, 'message': 'Action type is required'}), 400
+    if not isinstance(action_type, str):
+        return jsonify({'success': False, 'message': 'Invalid action type'}), 400
+    if action_data is not None and not isinstance(action_data, dict):
+        return jsonify({'success': False, 'message': 'Invalid action data'}), 400
+
+    allowed, retry_after = check_rate_limit(user_id, action_type)
+    if not allowed:
+        response = jsonify({'success': False, 'message': 'Rate limit exceeded', 'retry_after': retry_after})
+        response.headers['Retry-After'] = str(math.ceil(retry_after))
+        return response, 429
+
+    result = process_action(current_character_id(), action_type, action_data)
+
+    # Keep the player's open sockets, on any worker, in step with the change
+    if result.get('success', False):
+        announce_move(result)
+        if is_online(user_id):
+            push_state_patch(user_id, result)
 
-    result = process_action(user_id, action_type, data.get('action_data', {}))
     return jsonify(result)
 
 
 @app.route('/api/logs')
 @login_required
 def get_logs():
-    user_id = session['user_id']
-    # Get logs from database (implement in game_logic.py)
-    # For now, return dummy data
-    logs = [
-        {'timestamp': datetime.now().isoformat(), 'message': 'You entered the game.'}
-    ]
-    return jsonify(logs)
+    """Page through the character's action log, newest first.
+
+    Pass the previous page's ``next_before`` as ``before`` to get older entries.
+    """
+    before = request.args.get('before', type=float)
+    if before is not None and not math.isfinite(before):
+        return jsonify({'success': False, 'message': 'Invalid before cursor'}), 400
+    limit = request.args.get('limit', 20, type=int)
+    return jsonify(get_action_logs_page(current_character_id(), before=before, limit=limit))
 
 
 if __name__ == '__main__':
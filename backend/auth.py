@@ -1,33 +1,191 @@
 from functools import wraps
-from flask import session, redirect, url_for, jsonify, request
+from flask import session, redirect, url_for, request, current_app
+import os
+import threading
 import time
+import uuid
+
+from actions import ACTIONS
+from database import get_db
+from models import get_character_id
+from serializer import jsonify
+from scripts import register_script, run_script
+
+# Token bucket per user and action type: up to RATE_LIMIT_BURST actions at
+# once, refilled at RATE_LIMIT_PER_SECOND
+RATE_LIMIT_BURST = int(os.environ.get('RATE_LIMIT_BURST', 5))
+RATE_LIMIT_PER_SECOND = float(os.environ.get('RATE_LIMIT_PER_SECOND', 2))
+
+# Most denials remembered locally, so repeat offenders skip Redis until they may retry
+RATE_LIMIT_DENY_CACHE_SIZE = int(os.environ.get('RATE_LIMIT_DENY_CACHE_SIZE', 10000))
+
+# How often each worker reads new revocations of session tokens. A logout
+# takes up to this long to reach the other workers.
+AUTH_REVOCATION_REFRESH = float(os.environ.get('AUTH_REVOCATION_REFRESH', 2))
+
+# The session cookie is the token: Flask signs it with the app's secret key
+# and verifies it in-process, so it carries the user and character IDs
+# without a Redis lookup. Each session gets a token ID. Revoking one appends
+# it, with when the token would have expired anyway, to the auth:revocations
+# stream, which keeps entries for as long as a session can last. Workers
+# read the entries added since their last read (see _revoked_tokens).
+REVOCATIONS = 'auth:revocations'
+
+def start_session(user_id, character_id):
+    """Issue a new session token for a user and their character."""
+    session.clear()
+    session.permanent = True
+    session['user_id'] = user_id
+    session['character_id'] = character_id
+    session['token_id'] = uuid.uuid4().hex
+
+
+def end_session():
+    """Revoke the current session token everywhere and clear the cookie."""
+    token_id = session.get('token_id')
+    if token_id:
+        lifetime = current_app.permanent_session_lifetime.total_seconds()
+        oldest_kept = int((time.time() - lifetime) * 1000)
+        expires_at = int(time.time() + lifetime)
+        get_db().xadd(REVOCATIONS, {'t': token_id, 'e': expires_at}, minid=oldest_kept, approximate=True)
+        _revoked[token_id] = expires_at
+    session.clear()
+
+
+def session_valid():
+    """Whether the request has a session token that is signed in and not revoked.
+
+    Sessions without a token ID predate revocation and cannot be revoked, so
+    they are not valid either.
+    """
+    token_id = session.get('token_id')
+    return 'user_id' in session and token_id is not None and token_id not in _revoked_tokens()
+
+
+def current_character_id():
+    """The session's character ID.
+
+    Sessions issued before tokens carried it are upgraded with one lookup.
+    """
+    character_id = session.get('character_id')
+    if character_id is None:
+        character_id = session['character_id'] = get_character_id(session['user_id'])
+    return character_id
+
+
+# Revoked token ID -> when it expires, as read so far, and the ID of the
+# last revocation read
+_revoked = {}
+_revoked_read_to = '0-0'
+_revoked_loaded_at = 0.0
+_revoked_lock = threading.Lock()
+
+def _revoked_tokens():
+    """The revoked token IDs, updated at most every AUTH_REVOCATION_REFRESH seconds.
+
+    Each update reads only the revocations added since the last one, and
+    forgets tokens that have expired.
+    """
+    global _revoked_read_to, _revoked_loaded_at
+
+    now = time.monotonic()
+    if now - _revoked_loaded_at < AUTH_REVOCATION_REFRESH or not _revoked_lock.acquire(blocking=False):
+        return _revoked
+
+    try:
+        reply = get_db().xread({REVOCATIONS: _revoked_read_to})
+        entries = reply[0][1] if reply else []
+        for _, fields in entries:
+            _revoked[fields['t']] = int(fields['e'])
+        if entries:
+            _revoked_read_to = entries[-1][0]
+
+        # Tokens are added in about the order they expire, so the expired ones come first
+        wall_time = time.time()
+        while _revoked:
+            token_id = next(iter(_revoked))
+            if _revoked[token_id] > wall_time:
+                break
+            del _revoked[token_id]
+        _revoked_loaded_at = now
+    finally:
+        _revoked_lock.release()
+    return _revoked
 
 def login_required(f):
-    """Decorator to ensure the user is logged in."""
+    """Decorator to ensure the user is logged in with a session that is not revoked."""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
+        if not session_valid():
             if request.headers.get('Accept') == 'application/json':
                 return jsonify({'success': False, 'message': 'Authentication required'}), 401
             return redirect(url_for('login'))
         return f(*args, **kwargs)
     return decorated_function
 
-def rate_limiter(f):
-    """Basic rate limiter to prevent abuse."""
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        req_key = f"{request.remote_addr}:{request.path}"
-        current_time = time.time()
-        
-        # This would normally be stored in Redis/Memcached in a production system
-        if hasattr(rate_limiter, 'cache'):
-            last_request_time = rate_limiter.cache.get(req_key, 0)
-            if current_time - last_request_time < 1:  # 1 second limit
-                return jsonify({'success': False, 'message': 'Rate limit exceeded'}), 429
-        else:
-            rate_limiter.cache = {}
-        
-        rate_limiter.cache[req_key] = current_time
-        return f(*args, **kwargs)
-    return decorated_function
+# Takes one token from a bucket, refilling it for the time since the last
+# check. The clock is the Redis server's, so every worker agrees on it.
+#
+# KEYS: bucket hash
+# ARGV: capacity, tokens per second
+#
+# Returns {1, 0} if allowed, otherwise {0, milliseconds until a token is free}.
+register_script('rate_limit', """
+local capacity, rate = tonumber(ARGV[1]), tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) * 1000 + math.floor(tonumber(clock[2]) / 1000)
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate / 1000)
+
+local allowed, retry_after = 0, math.ceil((1 - tokens) * 1000 / rate)
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed, retry_after = 1, 0
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil((capacity - tokens) * 1000 / rate) + 1000)
+return {allowed, retry_after}
+""")
+
+# Bucket key -> monotonic time until which it is known to be empty
+_denied = {}
+_denied_lock = threading.Lock()
+
+def check_rate_limit(user_id, action_type):
+    """Take a token from the user's bucket for an action type.
+
+    Returns (allowed, seconds until the next action of that type is allowed).
+    Types that are not registered actions share one bucket, so clients
+    cannot create a key per made-up type.
+    """
+    if not isinstance(action_type, str) or action_type not in ACTIONS:
+        action_type = 'unknown'
+    key = f'ratelimit:{user_id}:{action_type}'
+    now = time.monotonic()
+
+    denied_until = _denied.get(key)
+    if denied_until is not None:
+        if now < denied_until:
+            return False, denied_until - now
+        _denied.pop(key, None)
+
+    allowed, retry_after_ms = run_script(
+        get_db(), 'rate_limit', keys=[key], args=[RATE_LIMIT_BURST, RATE_LIMIT_PER_SECOND]
+    )
+    if allowed:
+        return True, 0.0
+
+    retry_after = retry_after_ms / 1000
+    with _denied_lock:
+        if len(_denied) >= RATE_LIMIT_DENY_CACHE_SIZE:
+            # Forget entries that have lapsed; if none have, start over
+            for stale in [k for k, until in _denied.items() if until <= now]:
+                del _denied[stale]
+            if len(_denied) >= RATE_LIMIT_DENY_CACHE_SIZE:
+                _denied.clear()
+        _denied[key] = now + retry_after
+    return False, retry_after
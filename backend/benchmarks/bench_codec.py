@@ -0,0 +1,65 @@
+"""Microbenchmark for the character record codec.
+
+Usage:
+    python benchmarks/bench_codec.py [--number N]
+
+Times decoding and encoding one stored character hash with the legacy
+redis_hash_to_dict/dict_to_redis_hash helpers and with the schema codec.
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from codec import CHARACTERS
+from database import dict_to_redis_hash, redis_hash_to_dict
+
+# A character hash as Redis returns it
+STORED_CHARACTER = {
+    'id': '42',
+    'user_id': '42',
+    'name': 'Benchmark Hero',
+    'health': '87',
+    'max_health': '100',
+    'mp': '64',
+    'max_mp': '100',
+    'ap': '7',
+    'max_ap': '10',
+    'experience': '1250',
+    'x': '1',
+    'y': '2',
+    'inside_building': '1',
+    'created_at': '2024-01-01T12:00:00.000000'
+}
+
+
+def run(number):
+    """Time each codec operation and return {name: microseconds per call}."""
+    character = CHARACTERS.decode(STORED_CHARACTER)
+
+    cases = {
+        'legacy decode (redis_hash_to_dict)': lambda: redis_hash_to_dict(STORED_CHARACTER),
+        'legacy encode (dict_to_redis_hash)': lambda: dict_to_redis_hash(character),
+        'codec decode': lambda: CHARACTERS.decode(STORED_CHARACTER),
+        'codec encode': lambda: CHARACTERS.encode(character)
+    }
+
+    return {
+        name: min(timeit.repeat(case, number=number, repeat=5)) / number * 1e6
+        for name, case in cases.items()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the character record codec.')
+    parser.add_argument('--number', type=int, default=20000, help='calls per timing run')
+    args = parser.parse_args()
+
+    for name, micros in run(args.number).items():
+        print(f'{name:<40} {micros:8.2f} us/call')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""Load test the login and action endpoints in-process with simulated players.
+
+Usage:
+    python benchmarks/bench_load.py [--fake] [--players N] [--cycles N] [--transport http|ws|both]
+
+Each simulated player logs in through /login, then runs MOVE, ENTER_BUILDING,
+REST, EXIT_BUILDING cycles from its own thread, over HTTP (/api/action) or
+WebSocket (the perform_action event). The app runs in this process behind
+Flask's and Flask-SocketIO's test clients, against a local Redis or, with
+--fake, an in-process fake, so the numbers cover the server's own work
+without network overhead. socket_load.py drives a live server instead.
+
+Reports throughput, p50/p95/p99 latency and Redis round trips per request
+for login and each action, per transport.
+"""
+import argparse
+import threading
+import time
+import uuid
+
+import support
+
+# One cycle walks from the town square into the marketplace's store and back
+ACTION_CYCLE = [
+    ('MOVE', {'direction': 'east'}),
+    ('ENTER_BUILDING', {}),
+    ('REST', {}),
+    ('EXIT_BUILDING', {}),
+    ('MOVE', {'direction': 'west'})
+]
+
+
+def run_player(app, socketio, username, transport, cycles, samples):
+    """Log in and run the action cycles, recording each request's latency."""
+    from database import track_round_trips
+
+    client = app.test_client()
+
+    start = time.perf_counter()
+    with track_round_trips(f'bench:{transport}:login'):
+        response = client.post('/login', json={'username': username, 'password': 'benchmark'})
+    samples.setdefault(f'{transport}:login', []).append(time.perf_counter() - start)
+    if response.status_code != 200:
+        raise RuntimeError(f'Login failed for {username}: {response.status_code}')
+
+    socket = socketio.test_client(app, flask_test_client=client) if transport == 'ws' else None
+    if socket:
+        socket.get_received()
+
+    for _ in range(cycles):
+        for action_type, action_data in ACTION_CYCLE:
+            label = f'{transport}:{action_type}'
+            start = time.perf_counter()
+            with track_round_trips(f'bench:{label}'):
+                if socket:
+                    socket.emit('perform_action', {'action_type': action_type, 'action_data': action_data})
+                    replies = socket.get_received()
+                    ok = any(reply['name'] == 'state_patch' for reply in replies)
+                else:
+                    ok = client.post('/api/action', json={
+                        'action_type': action_type, 'action_data': action_data
+                    }).get_json().get('success', False)
+            samples.setdefault(label, []).append(time.perf_counter() - start)
+            if not ok:
+                samples.setdefault('failures', []).append(label)
+
+    if socket:
+        socket.disconnect()
+
+
+def run(players, cycles, transports):
+    """Run the simulated players for each transport and return the summaries."""
+    from app import app
+    from database import get_round_trip_stats
+    from socketio_events import socketio
+
+    support.prepare_redis()
+    run_id = uuid.uuid4().hex[:8]
+
+    results = {}
+    for transport in transports:
+        usernames = [f'load_{run_id}_{transport}_{index}' for index in range(players)]
+        for username in usernames:
+            support.create_player(username)
+
+        samples = {}
+        threads = [
+            threading.Thread(target=run_player, args=(app, socketio, username, transport, cycles, samples))
+            for username in usernames
+        ]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        if samples.get('failures'):
+            print(f"{transport}: {len(samples['failures'])} requests failed")
+
+        round_trips = get_round_trip_stats()
+        summaries = {}
+        for label, latencies in samples.items():
+            if label == 'failures':
+                continue
+            summary = support.latency_summary(latencies, elapsed)
+            summary['round_trips'] = round_trips[f'bench:{label}']['per_call']
+            summaries[label.split(':')[-1]] = summary
+
+        results[transport] = summaries
+
+    return results
+
+
+def print_results(results):
+    for transport, summaries in results.items():
+        print(f'[{transport}]')
+        for name, summary in summaries.items():
+            print(f"  {name:<16} {summary['count']:6d} reqs {summary['throughput']:9.1f}/s  "
+                  f"p50 {summary['p50_ms']:7.2f} ms  p95 {summary['p95_ms']:7.2f} ms  "
+                  f"p99 {summary['p99_ms']:7.2f} ms  {summary['round_trips']:5.2f} round trips")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the login and action endpoints in-process.')
+    parser.add_argument('--fake', action='store_true', help='use an in-process fake Redis')
+    parser.add_argument('--players', type=int, default=20, help='simulated players per transport')
+    parser.add_argument('--cycles', type=int, default=20, help='action cycles per player')
+    parser.add_argument('--transport', choices=['http', 'ws', 'both'], default='both')
+    args = parser.parse_args()
+
+    if args.fake:
+        support.use_fake_redis()
+
+    transports = ['http', 'ws'] if args.transport == 'both' else [args.transport]
+    print_results(run(args.players, args.cycles, transports))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Microbenchmarks for the hot helpers on the action path.
+
+Usage:
+    python benchmarks/bench_micro.py [--fake] [--number N]
+
+Times redis_hash_to_dict, get_available_actions (with and without the
+building lookup) and process_action for MOVE and REST. process_action talks
+to Redis: a local server by default, or an in-process fake with --fake.
+"""
+import argparse
+import itertools
+import timeit
+import uuid
+
+import support
+
+
+def run(number):
+    """Time each case and return {name: microseconds per call}."""
+    from bench_codec import STORED_CHARACTER
+    from database import redis_hash_to_dict
+    from game_logic import get_available_actions, process_action
+
+    support.prepare_redis()
+    _, character_id = support.create_player(f'micro_{uuid.uuid4().hex[:8]}')
+
+    # Walk east and back so every MOVE changes tile
+    directions = itertools.cycle(['east', 'west'])
+
+    cases = {
+        'redis_hash_to_dict': (lambda: redis_hash_to_dict(STORED_CHARACTER), number),
+        'get_available_actions': (lambda: get_available_actions(1, 1, False), number),
+        'get_available_actions (known building)':
+            (lambda: get_available_actions(1, 1, False, has_building=True), number),
+        # Actions are far slower; time fewer of them
+        'process_action MOVE':
+            (lambda: process_action(character_id, 'MOVE', {'direction': next(directions)}), max(1, number // 100)),
+        'process_action REST': (lambda: process_action(character_id, 'REST'), max(1, number // 100))
+    }
+
+    return {
+        name: min(timeit.repeat(case, number=calls, repeat=5)) / calls * 1e6
+        for name, (case, calls) in cases.items()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmark the action path helpers.')
+    parser.add_argument('--fake', action='store_true', help='use an in-process fake Redis')
+    parser.add_argument('--number', type=int, default=20000, help='calls per timing run')
+    args = parser.parse_args()
+
+    if args.fake:
+        support.use_fake_redis()
+
+    for name, micros in run(args.number).items():
+        print(f'{name:<40} {micros:10.2f} us/call')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Run the whole benchmark suite and compare it with the stored baseline.
+
+Usage:
+    python benchmarks/run_suite.py [--fake] [--check] [--save-baseline] [--tolerance 0.5]
+
+Runs the microbenchmarks and a short in-process load test (see
+bench_micro.py and bench_load.py). Baselines are kept in baseline.json, one
+per Redis mode ("fake" or "local"), since the two differ by design.
+
+--save-baseline records this run as the baseline for its mode. --check
+exits with status 1 if any timing is more than the tolerance slower than
+the baseline, or if any request makes more Redis round trips than it did.
+Round trips are only compared for requests made at least
+ROUND_TRIP_MIN_COUNT times (see support.py); logins, one per player, are
+too few at the default sizes. Timings depend on the machine, so record the
+baseline on the machine that runs the checks; the round-trip counts hold
+anywhere.
+"""
+import argparse
+import json
+import os
+import sys
+
+import support
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the benchmark suite.')
+    parser.add_argument('--fake', action='store_true', help='use an in-process fake Redis')
+    parser.add_argument('--check', action='store_true', help='fail on regressions against the baseline')
+    parser.add_argument('--save-baseline', action='store_true', help='store this run as the baseline')
+    parser.add_argument('--tolerance', type=float, default=support.DEFAULT_TOLERANCE,
+                        help='allowed slowdown for timings, as a fraction')
+    parser.add_argument('--number', type=int, default=20000, help='calls per microbenchmark timing run')
+    parser.add_argument('--players', type=int, default=10, help='simulated players per transport')
+    parser.add_argument('--cycles', type=int, default=10, help='action cycles per player')
+    args = parser.parse_args()
+
+    mode = 'fake' if args.fake else 'local'
+    if args.fake:
+        support.use_fake_redis()
+
+    import bench_load
+    import bench_micro
+
+    results = {
+        'micro': {f'{name}_us': micros for name, micros in bench_micro.run(args.number).items()},
+        'load': bench_load.run(args.players, args.cycles, ['http', 'ws'])
+    }
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+    baselines = support.load_baseline() if os.path.exists(support.BASELINE_PATH) else {}
+
+    if args.save_baseline:
+        baselines[mode] = results
+        support.save_baseline(baselines)
+        print(f'Saved the {mode} baseline to {support.BASELINE_PATH}')
+
+    if args.check:
+        if mode not in baselines:
+            sys.exit(f'No {mode} baseline to check against; run with --save-baseline first')
+
+        regressions = support.compare(results, baselines[mode], args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+        print(f'No regressions against the {mode} baseline')
+
+
+if __name__ == '__main__':
+    main()
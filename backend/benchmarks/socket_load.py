@@ -0,0 +1,153 @@
+"""Socket.IO load test: hold many idle sockets while active players send actions.
+
+Usage:
+    pip install -r benchmarks/requirements.txt
+    python benchmarks/socket_load.py --url http://localhost:5000 \
+        --accounts 50 --idle 2000 --duration 60
+
+Each account gets one active socket that loops through game actions and
+waits for the resulting state_patch (or error). The idle sockets are spread
+over the same accounts and only receive broadcasts. Start the server with
+SOCKETIO_ASYNC_MODE=eventlet to see it hold thousands of sockets per worker.
+
+The client runs on eventlet so one process can open thousands of sockets;
+by default it opens 2000 idle ones plus one per account. It needs the
+requests and websocket-client packages (see benchmarks/requirements.txt),
+which the synchronous python-socketio client uses for its transports.
+"""
+import eventlet
+
+eventlet.monkey_patch()
+
+import argparse
+import statistics
+import time
+import uuid
+
+import requests
+import socketio
+
+# Actions the active players cycle through
+ACTION_CYCLE = [
+    ('MOVE', {'direction': 'east'}),
+    ('ENTER_BUILDING', {}),
+    ('EXIT_BUILDING', {}),
+    ('MOVE', {'direction': 'west'}),
+    ('REST', {}),
+    ('SEARCH', {})
+]
+
+
+def create_account(url, run_id, index):
+    """Sign up a throwaway account and return its session cookie header."""
+    http = requests.Session()
+    response = http.post(f'{url}/signup', json={
+        'username': f'load_{run_id}_{index}',
+        'password': 'load-test',
+        'character_name': f'Load {index}'
+    })
+    response.raise_for_status()
+    return '; '.join(f'{name}={value}' for name, value in http.cookies.items())
+
+
+def open_socket(url, cookie, on_reply=None):
+    """Connect a Socket.IO client with a session cookie."""
+    client = socketio.Client(reconnection=False)
+    if on_reply:
+        client.on('state_patch', lambda data: on_reply(True))
+        client.on('error', lambda data: on_reply(False))
+    client.connect(url, headers={'Cookie': cookie}, transports=['websocket'])
+    return client
+
+
+def run_player(url, cookie, deadline, think_time, stats):
+    """Send actions from one socket until the deadline, timing each reply."""
+    reply = {'event': eventlet.event.Event()}
+
+    def on_reply(accepted):
+        if not reply['event'].ready():
+            reply['event'].send(accepted)
+
+    client = open_socket(url, cookie, on_reply)
+    step = 0
+    try:
+        while time.time() < deadline:
+            action_type, action_data = ACTION_CYCLE[step % len(ACTION_CYCLE)]
+            step += 1
+
+            reply['event'] = eventlet.event.Event()
+            start = time.perf_counter()
+            client.emit('perform_action', {'action_type': action_type, 'action_data': action_data})
+
+            try:
+                with eventlet.Timeout(10):
+                    accepted = reply['event'].wait()
+            except eventlet.Timeout:
+                stats['timeouts'] += 1
+                continue
+
+            stats['latencies'].append(time.perf_counter() - start)
+            stats['accepted' if accepted else 'refused'] += 1
+            eventlet.sleep(think_time)
+    finally:
+        client.disconnect()
+
+
+def percentile(cuts, p):
+    return cuts[p - 1] * 1000 if cuts else float('nan')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the Socket.IO action path.')
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--accounts', type=int, default=50, help='active players, one account each')
+    parser.add_argument('--idle', type=int, default=2000, help='idle sockets spread over the accounts')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to run the active players')
+    parser.add_argument('--connect-concurrency', type=int, default=50,
+                        help='sockets opened at once while ramping up')
+    parser.add_argument('--think-time', type=float, default=0.5, help='seconds between a player\'s actions')
+    args = parser.parse_args()
+
+    run_id = uuid.uuid4().hex[:8]
+    print(f'Creating {args.accounts} accounts...')
+    cookies = [create_account(args.url, run_id, index) for index in range(args.accounts)]
+
+    print(f'Opening {args.idle} idle sockets...')
+    idle_sockets = []
+    errors = {}
+
+    def open_idle(index):
+        try:
+            idle_sockets.append(open_socket(args.url, cookies[index % len(cookies)]))
+        except Exception as e:
+            errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+
+    # Ramp up in bounded batches so the server's listen backlog isn't overrun
+    for _ in eventlet.GreenPool(args.connect_concurrency).imap(open_idle, range(args.idle)):
+        pass
+    print(f'Idle sockets connected: {len(idle_sockets)} (failed: {errors or 0})')
+
+    stats = {'latencies': [], 'accepted': 0, 'refused': 0, 'timeouts': 0}
+    deadline = time.time() + args.duration
+    started = time.time()
+    players = eventlet.GreenPool(args.accounts)
+    for cookie in cookies:
+        players.spawn(run_player, args.url, cookie, deadline, args.think_time, stats)
+    players.waitall()
+    elapsed = time.time() - started
+
+    still_connected = sum(1 for client in idle_sockets if client.connected)
+    for client in idle_sockets:
+        client.disconnect()
+
+    latencies = stats['latencies']
+    cuts = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else []
+    print(f'Idle sockets still connected at end: {still_connected}/{len(idle_sockets)}')
+    print(f'Actions: {len(latencies)} in {elapsed:.1f}s ({len(latencies) / elapsed:.1f}/s), '
+          f"accepted {stats['accepted']}, refused {stats['refused']}, timeouts {stats['timeouts']}")
+    print(f'Latency p50 {percentile(cuts, 50):.1f} ms, p95 {percentile(cuts, 95):.1f} ms, '
+          f'p99 {percentile(cuts, 99):.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
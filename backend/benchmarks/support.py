@@ -0,0 +1,133 @@
+"""Shared setup for the benchmark suite: Redis selection, statistics and baselines.
+
+Import this before anything from the backend. It puts the backend on the
+path and relaxes the limits that would otherwise throttle simulated
+players.
+"""
+import json
+import os
+import statistics
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+# Simulated players act and log in far faster than people; don't throttle them
+os.environ.setdefault('RATE_LIMIT_BURST', '1000000')
+os.environ.setdefault('RATE_LIMIT_PER_SECOND', '1000000')
+os.environ.setdefault('PASSWORD_HASH_QUEUE', '1000000')
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Allowed slowdown against the baseline before a timing counts as a regression
+DEFAULT_TOLERANCE = 0.5
+
+# Round trips per request may drift by this much: a worker occasionally
+# reserves a new block of IDs, which lands on whichever request needed it
+ROUND_TRIP_SLACK = 0.1
+
+# Fewest requests whose round trips are compared. Over fewer, the occasional
+# round trips (ID blocks, revocation reads) land on too few requests to
+# average out, so the per-request figure says little.
+ROUND_TRIP_MIN_COUNT = int(os.environ.get('ROUND_TRIP_MIN_COUNT', 50))
+
+
+def use_fake_redis():
+    """Point the backend at an in-process fake Redis instead of a server.
+
+    Needs the fakeredis package, plus lupa for the Lua scripts. Call before
+    the first Redis command.
+    """
+    try:
+        import fakeredis
+    except ImportError:
+        sys.exit('The in-process Redis needs fakeredis and lupa: pip install fakeredis lupa')
+
+    import database
+
+    server = fakeredis.FakeServer()
+    create_pool = database.create_pool
+
+    def create_fake_pool(**overrides):
+        return create_pool(connection_class=fakeredis.FakeConnection, server=server, **overrides)
+
+    database.create_pool = create_fake_pool
+
+
+def latency_summary(latencies, elapsed):
+    """Throughput and p50/p95/p99 latency (ms) for a list of latencies in seconds."""
+    if not latencies:
+        latencies = [0.0]
+    cuts = statistics.quantiles(latencies * 2 if len(latencies) == 1 else latencies, n=100)
+    return {
+        'count': len(latencies),
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': cuts[49] * 1000,
+        'p95_ms': cuts[94] * 1000,
+        'p99_ms': cuts[98] * 1000
+    }
+
+
+def prepare_redis():
+    """Initialize the database and world, and load the Lua scripts."""
+    from database import init_db, get_db
+    from scripts import load_scripts
+    from world_data import initialize_world
+
+    init_db()
+    initialize_world()
+    load_scripts(get_db())
+
+
+def create_player(username, password='benchmark', ap=1000000):
+    """Create a user with enough AP that a benchmark never runs out.
+
+    Returns (user ID, character ID).
+    """
+    from werkzeug.security import generate_password_hash
+    from database import get_db
+    from models import create_user
+
+    user_id, character_id = create_user(username, generate_password_hash(password), f'Bench {username}')
+    get_db().hset(f'character:{character_id}', mapping={'ap': ap, 'max_ap': ap})
+    return user_id, character_id
+
+
+def load_baseline(path=BASELINE_PATH):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(results, path=BASELINE_PATH):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """List the regressions of ``results`` against ``baseline``.
+
+    Timings (``*_us``, ``*_ms``) may be up to ``tolerance`` slower. Redis
+    round trips per request do not depend on the machine, so they may only
+    drift by ROUND_TRIP_SLACK, and are only compared when both runs made at
+    least ROUND_TRIP_MIN_COUNT requests. Throughput is not compared; it
+    follows from the latencies.
+    """
+    regressions = []
+
+    def walk(current, expected, path):
+        for key, value in expected.items():
+            if key not in current:
+                continue
+            name = f'{path}.{key}' if path else key
+            if isinstance(value, dict):
+                walk(current[key], value, name)
+            elif key.endswith(('_us', '_ms')) and current[key] > value * (1 + tolerance):
+                regressions.append(f'{name}: {current[key]:.2f} vs baseline {value:.2f}')
+            elif key == 'round_trips' and current[key] > value + ROUND_TRIP_SLACK:
+                if min(current.get('count', 0), expected.get('count', 0)) < ROUND_TRIP_MIN_COUNT:
+                    continue
+                regressions.append(f'{name}: {current[key]:.2f} round trips vs baseline {value:.2f}')
+
+    walk(results, baseline, '')
+    return regressions
@@ -0,0 +1,362 @@
+"""Optional write-behind cache of active characters.
+
+With CHARACTER_CACHE=1, the worker that serves a character keeps it in
+memory and is the only one that writes it:
+
+- Ownership is a lease, character_owner:{id}, holding the worker's node ID.
+  Taking it loads the character in the same script call. A worker that
+  finds the lease held elsewhere refuses the action, so run the workers
+  behind sticky sessions (as multi-node Socket.IO already needs).
+- Actions are decided against the cached character, AP included, without
+  reading Redis. Each action's changed fields are appended to the journal
+  stream character_journal:{id} in the same MULTI/EXEC as its log entry,
+  event and tile index move, so nothing acknowledged is lost if the worker
+  dies.
+- A flusher writes the dirty fields of each character to its hash in one
+  pipeline every CHARACTER_FLUSH_INTERVAL seconds, or sooner once
+  CHARACTER_FLUSH_DIRTY characters are dirty. Each flush trims the journal
+  entries it covers and renews the lease. Characters idle for
+  CHARACTER_CACHE_IDLE seconds are flushed and released.
+- If the owner dies, its leases lapse after CHARACTER_LEASE_TTL seconds.
+  The next owner replays the remaining journal into the hash before
+  loading the character. A cached character whose lease was last renewed
+  more than half the TTL ago is checked against Redis before it is used,
+  and dropped if the lease was lost.
+
+Readers that go to Redis see the hash as of the last flush; the AP ticker
+reads the journal as well (see ap_regen.py).
+"""
+import atexit
+import os
+import threading
+import time
+
+from codec import CHARACTERS
+from database import get_db
+from events import queue_event
+from models import (get_character as load_character, get_character_position, regenerate_ap, now_ms,
+                    trim_action_logs, encode_log, decode_logs, _pairs_to_dict)
+from presence import NODE_ID
+from redis.exceptions import NoScriptError
+from scripts import register_script, run_script, queue_script, load_scripts
+
+ENABLED = os.environ.get('CHARACTER_CACHE', '0') == '1'
+CHARACTER_FLUSH_INTERVAL = float(os.environ.get('CHARACTER_FLUSH_INTERVAL', 1))
+CHARACTER_FLUSH_DIRTY = int(os.environ.get('CHARACTER_FLUSH_DIRTY', 1000))
+CHARACTER_CACHE_IDLE = float(os.environ.get('CHARACTER_CACHE_IDLE', 300))
+CHARACTER_LEASE_TTL = int(os.environ.get('CHARACTER_LEASE_TTL', 30))
+
+# Takes a character's lease, or renews it if this node holds it, and loads
+# the character after replaying any journal a previous owner left unflushed.
+# Journal entries hold absolute field values, so replaying is idempotent.
+#
+# KEYS: owner lease, character hash, journal stream
+# ARGV: node ID, lease ms
+#
+# Returns {0, owner} if another node holds the lease, otherwise
+# {1, [field, value, ...] of the character}.
+register_script('acquire_character', """
+local owner = redis.call('GET', KEYS[1])
+if owner and owner ~= ARGV[1] then
+    return {0, owner}
+end
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+
+for _, entry in ipairs(redis.call('XRANGE', KEYS[3], '-', '+')) do
+    redis.call('HSET', KEYS[2], unpack(entry[2]))
+end
+redis.call('DEL', KEYS[3])
+return {1, redis.call('HGETALL', KEYS[2])}
+""")
+
+# Writes a cached character's dirty fields, drops the journal entries they
+# cover, then renews the lease, or releases it when lease ms is 0.
+#
+# KEYS: owner lease, character hash, journal stream
+# ARGV: node ID, lease ms, first journal ID to keep, field, value, ...
+#
+# Returns 0 without writing if this node lost the lease.
+register_script('flush_character', """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if #ARGV > 3 then
+    redis.call('HSET', KEYS[2], unpack(ARGV, 4))
+end
+redis.call('XTRIM', KEYS[3], 'MINID', ARGV[3])
+if ARGV[2] == '0' then
+    redis.call('DEL', KEYS[1])
+else
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 1
+""")
+
+
+# Renews a lease this node holds.
+#
+# KEYS: owner lease
+# ARGV: node ID, lease ms
+#
+# Returns 0 if this node no longer holds the lease.
+register_script('renew_character_lease', """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('PEXPIRE', KEYS[1], ARGV[2])
+return 1
+""")
+
+
+class CachedCharacter:
+    """A character owned by this worker, with the fields not yet flushed."""
+
+    __slots__ = ('character', 'dirty', 'journal_id', 'lock', 'used_at', 'renewed_at')
+
+    def __init__(self, character):
+        self.character = character
+        self.dirty = {}
+        self.journal_id = None  # Last journal entry not yet flushed
+        self.lock = threading.Lock()
+        self.used_at = self.renewed_at = time.monotonic()
+
+
+# Character ID -> CachedCharacter
+_cache = {}
+_cache_lock = threading.Lock()
+_flush_now = threading.Event()
+
+# Characters whose lease is being released; not taken again until it is
+_releasing = set()
+
+# Cached characters with fields not yet flushed
+_dirty_count = 0
+
+
+def _keys(character_id):
+    return [f'character_owner:{character_id}', f'character:{character_id}', f'character_journal:{character_id}']
+
+
+def acquire(character_id):
+    """The cached character, taking its lease if needed; None if another worker owns it.
+
+    Check the entry with held() once its lock is taken, in case it was
+    released meanwhile.
+    """
+    entry = _cache.get(character_id)
+    if entry is not None:
+        now = time.monotonic()
+        entry.used_at = now
+        if now - entry.renewed_at < CHARACTER_LEASE_TTL / 2:
+            return entry
+
+        # The flusher has not renewed the lease lately, so it may have lapsed
+        if run_script(get_db(), 'renew_character_lease', keys=_keys(character_id)[:1],
+                      args=[NODE_ID, CHARACTER_LEASE_TTL * 1000]):
+            entry.renewed_at = now
+            return entry
+
+        # Lost: load it again below, replaying the journal, unless another worker owns it now
+        _drop(character_id, entry)
+    if character_id in _releasing:
+        return None
+
+    reply = run_script(get_db(), 'acquire_character', keys=_keys(character_id),
+                       args=[NODE_ID, CHARACTER_LEASE_TTL * 1000])
+    if not reply[0]:
+        return None
+
+    character = CHARACTERS.decode(_pairs_to_dict(reply[1]))
+    if character is None:
+        return None
+
+    with _cache_lock:
+        # Another thread may have loaded it meanwhile; keep the first
+        return _cache.setdefault(character_id, CachedCharacter(character))
+
+
+def held(character_id, entry):
+    """Whether ``entry`` is still this worker's copy of the character."""
+    return _cache.get(character_id) is entry
+
+
+def _drop(character_id, entry):
+    """Forget a cached character whose lease was lost; its journal keeps what was not flushed."""
+    with entry.lock:
+        with _cache_lock:
+            if _cache.get(character_id) is entry:
+                del _cache[character_id]
+        if entry.dirty:
+            _count_dirty(-1)
+        entry.dirty, entry.journal_id = {}, None
+
+
+def get_character(character_id):
+    """A character with its AP regenerated, from the cache if this worker holds it."""
+    entry = _cache.get(character_id) if ENABLED else None
+    if entry is None:
+        return load_character(character_id)
+    with entry.lock:
+        return regenerate_ap(dict(entry.character), now_ms())
+
+
+def get_position(character_id):
+    """A character's (x, y, inside_building), from the cache if this worker holds it."""
+    entry = _cache.get(character_id) if ENABLED else None
+    if entry is None:
+        return get_character_position(character_id)
+    character = entry.character
+    return character['x'], character['y'], bool(character['inside_building'])
+
+
+def commit(entry, character, updates, log_entries, events=(), tile_move=None, log_limit=10):
+    """Apply an action's results: journal the fields, write the logs, events and tile move now.
+
+    Call with ``entry.lock`` held. ``character`` becomes the cached state and
+    ``updates`` are marked dirty for the next flush. Returns the recent logs.
+    """
+    character_id = character['id']
+    db = get_db()
+    pipe = db.pipeline(transaction=True)
+
+    if updates:
+        pipe.xadd(f'character_journal:{character_id}', CHARACTERS.encode(updates))
+
+    if tile_move:
+        old_key, new_key = tile_move
+        pipe.zrem(old_key, character_id)
+        pipe.zadd(new_key, {character_id: character_id})
+
+    if log_entries:
+        now = time.time()
+        # Later entries score higher, so the log keeps the actions' order
+        pipe.zadd(f'action_logs:{character_id}', {
+            encode_log(log_data): now + offset / 1e6 for offset, log_data in enumerate(log_entries)
+        })
+        trim_action_logs(pipe, character_id, now)
+
+    for event in events:
+        queue_event(pipe, event)
+
+    pipe.zrevrange(f'action_logs:{character_id}', 0, log_limit - 1)
+    replies = pipe.execute()
+
+    entry.character = character
+    if updates:
+        if not entry.dirty:
+            _count_dirty(1)
+        entry.dirty.update(updates)
+        entry.journal_id = replies[0]
+
+    return decode_logs(replies[-1])
+
+
+def _count_dirty(change):
+    """Track how many characters are dirty, waking the flusher at the threshold."""
+    global _dirty_count
+
+    with _cache_lock:
+        _dirty_count += change
+        if _dirty_count >= CHARACTER_FLUSH_DIRTY:
+            _flush_now.set()
+
+
+def _next_stream_id(stream_id):
+    """The smallest stream ID after ``stream_id``, for trimming up to and including it."""
+    ms, seq = stream_id.split('-')
+    return f'{ms}-{int(seq) + 1}'
+
+
+def flush(release_idle=True, release_all=False):
+    """Write dirty fields and renew leases in one pipeline.
+
+    Idle characters (or every character, with ``release_all``) are flushed
+    and released. Returns the number of characters written.
+    """
+    now = time.monotonic()
+    batch = []
+    for character_id, entry in list(_cache.items()):
+        release = release_all or (release_idle and now - entry.used_at > CHARACTER_CACHE_IDLE)
+        renew = now - entry.renewed_at > CHARACTER_LEASE_TTL / 3
+        if not (entry.dirty or release or renew):
+            continue
+
+        with entry.lock:
+            fields, journal_id = entry.dirty, entry.journal_id
+            entry.dirty, entry.journal_id = {}, None
+            if fields:
+                _count_dirty(-1)
+            if release:
+                with _cache_lock:
+                    _cache.pop(character_id, None)
+                    _releasing.add(character_id)
+        batch.append((character_id, entry, fields, journal_id, release))
+
+    if not batch:
+        return 0
+
+    db = get_db()
+    try:
+        try:
+            written = _queue_flush(db.pipeline(transaction=False), batch).execute()
+        except NoScriptError:
+            load_scripts(db)
+            written = _queue_flush(db.pipeline(transaction=False), batch).execute()
+    except Exception:
+        _restore(batch)
+        raise
+    finally:
+        with _cache_lock:
+            _releasing.difference_update(character_id for character_id, *_, release in batch if release)
+
+    for (character_id, entry, fields, journal_id, release), ok in zip(batch, written):
+        entry.renewed_at = now
+        if not ok:
+            # The lease lapsed and another worker replayed the journal; its copy wins
+            _drop(character_id, entry)
+    return sum(1 for (_, _, fields, _, _), ok in zip(batch, written) if ok and fields)
+
+
+def _restore(batch):
+    """Put back what a failed flush took, so the next one writes it."""
+    for character_id, entry, fields, journal_id, release in batch:
+        with entry.lock:
+            if fields:
+                if not entry.dirty:
+                    _count_dirty(1)
+                entry.dirty = {**fields, **entry.dirty}
+                entry.journal_id = entry.journal_id or journal_id
+            if release:
+                with _cache_lock:
+                    _cache.setdefault(character_id, entry)
+
+
+def _queue_flush(pipe, batch):
+    for character_id, entry, fields, journal_id, release in batch:
+        args = [NODE_ID, 0 if release else CHARACTER_LEASE_TTL * 1000,
+                _next_stream_id(journal_id) if journal_id else '0-0']
+        for field, value in CHARACTERS.encode(fields).items():
+            args += [field, value]
+        queue_script(pipe, 'flush_character', keys=_keys(character_id), args=args)
+    return pipe
+
+
+def _run_flusher():
+    while True:
+        _flush_now.wait(CHARACTER_FLUSH_INTERVAL)
+        _flush_now.clear()
+        try:
+            flush()
+        except Exception as e:
+            print(f'Character flush failed: {e}')
+
+
+def start_flusher():
+    """Start the flush loop in a daemon thread, and flush everything at exit."""
+    if not ENABLED:
+        return None
+
+    atexit.register(flush, release_all=True)
+    thread = threading.Thread(target=_run_flusher, name='character-flusher', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,126 @@
+import json
+
+# Field types a schema can declare
+INT = 'int'
+BOOL = 'bool'
+STR = 'str'
+JSON = 'json'
+
+_TRUE_VALUES = frozenset(('1', 'True', 'true'))
+
+
+def _decode_int(value):
+    return int(value) if value else 0
+
+
+def _decode_bool(value):
+    return value in _TRUE_VALUES
+
+
+def _decode_str(value):
+    return value
+
+
+def _decode_json(value):
+    return json.loads(value) if value else None
+
+
+def _encode_int(value):
+    return str(int(value)) if value is not None else ''
+
+
+def _encode_bool(value):
+    return '1' if value else '0'
+
+
+def _encode_str(value):
+    return str(value) if value is not None else ''
+
+
+def _encode_json(value):
+    return json.dumps(value) if value is not None else ''
+
+
+_DECODERS = {INT: _decode_int, BOOL: _decode_bool, STR: _decode_str, JSON: _decode_json}
+_ENCODERS = {INT: _encode_int, BOOL: _encode_bool, STR: _encode_str, JSON: _encode_json}
+_DEFAULTS = {INT: 0, BOOL: False, STR: '', JSON: None}
+
+
+class RecordCodec:
+    """Schema-driven conversion between Redis hashes and typed Python values.
+
+    Every field declares its type, and the per-field converters are looked
+    up once when the codec is built. Fields missing from the schema pass
+    through unchanged as strings.
+    """
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = tuple(fields)
+        self._decoders = {field: _DECODERS[kind] for field, kind in self.fields}
+        self._encoders = {field: _ENCODERS[kind] for field, kind in self.fields}
+        # Each field's value when it is absent, e.g. for filling in old records
+        self.defaults = {field: _DEFAULTS[kind] for field, kind in self.fields}
+
+    def decode(self, hash_dict):
+        """Convert a Redis hash to a dict of typed values, or None if it is empty."""
+        if not hash_dict:
+            return None
+
+        decoders = self._decoders
+        return {
+            key: decoders[key](value) if key in decoders else value
+            for key, value in hash_dict.items()
+        }
+
+    def encode(self, data):
+        """Convert a (possibly partial) dict of values to Redis hash strings."""
+        encoders = self._encoders
+        return {
+            key: encoders[key](value) if key in encoders else _encode_str(value)
+            for key, value in data.items()
+        }
+
+
+USERS = RecordCodec('User', [
+    ('id', INT),
+    ('username', STR),
+    ('password_hash', STR),
+    ('character_id', INT),
+    ('created_at', STR)
+])
+
+CHARACTERS = RecordCodec('Character', [
+    ('id', INT),
+    ('user_id', INT),
+    ('name', STR),
+    ('health', INT),
+    ('max_health', INT),
+    ('mp', INT),
+    ('max_mp', INT),
+    ('ap', INT),
+    ('max_ap', INT),
+    ('ap_updated_at', INT),
+    ('experience', INT),
+    ('x', INT),
+    ('y', INT),
+    ('inside_building', BOOL),
+    ('created_at', STR)
+])
+
+# Entries of the action event stream (see events.py), by their full field names
+ACTION_EVENTS = RecordCodec('ActionEvent', [
+    ('character_id', INT),
+    ('action_type', STR),
+    ('log_id', INT),
+    ('ap_cost', INT),
+    ('x', INT),
+    ('y', INT),
+    ('inside_building', BOOL)
+])
+
+# Codec for each key prefix, used by tools that walk the keyspace
+CODECS_BY_PREFIX = {
+    'user': USERS,
+    'character': CHARACTERS
+}
@@ -0,0 +1,17 @@
+"""Concurrency mode for the server process.
+
+Import this module before anything else. With SOCKETIO_ASYNC_MODE=eventlet,
+the standard library is monkey patched here, so sockets (including
+redis-py's), threads, locks and queues become cooperative green threads.
+One worker can then hold thousands of idle and active Socket.IO connections
+without dedicating an OS thread to each one.
+"""
+import os
+
+# 'threading' (one OS thread per connection) or 'eventlet' (green threads)
+ASYNC_MODE = os.environ.get('SOCKETIO_ASYNC_MODE', 'threading')
+
+if ASYNC_MODE == 'eventlet':
+    import eventlet
+
+    eventlet.monkey_patch()
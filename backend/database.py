@@ -1,7 +1,13 @@
 import redis
 import json
-from flask import g
+from contextlib import contextmanager
+import atexit
 import os
+import threading
+import time
+from urllib.parse import quote
+
+import metrics
 
 # Redis configuration
 REDIS_HOST = os.environ.get('REDIS_HOST', 'localhost')
@@ -9,24 +15,230 @@ REDIS_PORT = int(os.environ.get('REDIS_PORT', 6379))
 REDIS_DB = int(os.environ.get('REDIS_DB', 0))
 REDIS_PASSWORD = os.environ.get('REDIS_PASSWORD', None)
 
+# Connection pool configuration, shared by HTTP and Socket.IO handlers
+REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 50))
+REDIS_BLOCKING_POOL = os.environ.get('REDIS_BLOCKING_POOL', '1') == '1'
+REDIS_POOL_TIMEOUT = float(os.environ.get('REDIS_POOL_TIMEOUT', 5))
+REDIS_SOCKET_TIMEOUT = float(os.environ.get('REDIS_SOCKET_TIMEOUT', 5))
+REDIS_CONNECT_TIMEOUT = float(os.environ.get('REDIS_CONNECT_TIMEOUT', 2))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.environ.get('REDIS_HEALTH_CHECK_INTERVAL', 30))
 
-def get_db():
-    """Get Redis connection for the current request."""
-    if 'redis_db' not in g:
-        g.redis_db = redis.Redis(
-            host=REDIS_HOST,
-            port=REDIS_PORT,
-            db=REDIS_DB,
-            password=REDIS_PASSWORD,
-            decode_responses=True  # Return strings instead of bytes
+
+# Per-thread count of Redis round trips, plus totals per tracked label
+_round_trips = threading.local()
+_round_trip_stats = {}
+_round_trip_stats_lock = threading.Lock()
+
+
+def _count_round_trip():
+    _round_trips.count = getattr(_round_trips, 'count', 0) + 1
+
+
+@contextmanager
+def _timed_command(command, commands=1):
+    """Count a round trip and record its commands and latency in the metrics."""
+    _count_round_trip()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe('redis_command_duration_seconds', time.perf_counter() - start, command=command)
+        metrics.inc('redis_commands_total', commands, command=command)
+
+
+class CountingPipeline(redis.client.Pipeline):
+    """Pipeline that counts one round trip per flush to the server."""
+
+    def immediate_execute_command(self, *args, **options):
+        with _timed_command(args[0]):
+            return super().immediate_execute_command(*args, **options)
+
+    def execute(self, raise_on_error=True):
+        if not self.command_stack:
+            return super().execute(raise_on_error)
+        with _timed_command('PIPELINE', len(self.command_stack)):
+            return super().execute(raise_on_error)
+
+
+class CountingRedis(redis.Redis):
+    """Redis client that counts every round trip made by the calling thread."""
+
+    def execute_command(self, *args, **options):
+        with _timed_command(args[0]):
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return CountingPipeline(
+            self.connection_pool, self.response_callbacks, transaction, shard_hint
         )
-    return g.redis_db
 
 
-def close_db(e=None):
-    """Close Redis connection at the end of request."""
-    redis_db = g.pop('redis_db', None)
-    # Redis handles connection pooling, no need to explicitly close
+def round_trip_count():
+    """Return the number of Redis round trips made so far by this thread."""
+    return getattr(_round_trips, 'count', 0)
+
+
+@contextmanager
+def track_round_trips(label):
+    """Record the Redis round trips made inside the block under a label."""
+    start = round_trip_count()
+    try:
+        yield
+    finally:
+        used = round_trip_count() - start
+        with _round_trip_stats_lock:
+            stats = _round_trip_stats.setdefault(label, {'calls': 0, 'round_trips': 0, 'max': 0})
+            stats['calls'] += 1
+            stats['round_trips'] += used
+            stats['max'] = max(stats['max'], used)
+
+
+def get_round_trip_stats():
+    """Return round trip totals and per-call averages for each tracked label."""
+    with _round_trip_stats_lock:
+        return {
+            label: dict(stats, per_call=stats['round_trips'] / stats['calls'])
+            for label, stats in _round_trip_stats.items()
+        }
+
+
+class PoolStatsMixin:
+    """Records how often and how long callers wait to check out a connection."""
+
+    def reset(self):
+        super().reset()
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def get_connection(self, command_name, *keys, **options):
+        start = time.perf_counter()
+        connection = super().get_connection(command_name, *keys, **options)
+        waited = time.perf_counter() - start
+        with self._stats_lock:
+            self.checkouts += 1
+            self.wait_time_total += waited
+            self.wait_time_max = max(self.wait_time_max, waited)
+        return connection
+
+
+class StatsConnectionPool(PoolStatsMixin, redis.ConnectionPool):
+    """Non-blocking pool: raises once max_connections are checked out."""
+
+    def connection_counts(self):
+        with self._lock:
+            return len(self._in_use_connections), len(self._available_connections)
+
+
+class StatsBlockingConnectionPool(PoolStatsMixin, redis.BlockingConnectionPool):
+    """Blocking pool: callers wait up to the pool timeout for a free connection."""
+
+    def connection_counts(self):
+        idle = sum(1 for connection in list(self.pool.queue) if connection is not None)
+        return len(self._connections) - idle, idle
+
+
+def create_pool(**overrides):
+    """Create the process-wide connection pool from the configuration."""
+    options = dict(
+        host=REDIS_HOST,
+        port=REDIS_PORT,
+        db=REDIS_DB,
+        password=REDIS_PASSWORD,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        socket_timeout=REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+        health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+        decode_responses=True  # Return strings instead of bytes
+    )
+    options.update(overrides)
+
+    if REDIS_BLOCKING_POOL:
+        return StatsBlockingConnectionPool(timeout=REDIS_POOL_TIMEOUT, **options)
+    return StatsConnectionPool(**options)
+
+
+def create_blocking_client(block):
+    """A client on a pool of its own, for commands that block up to ``block`` seconds.
+
+    Reads on the shared pool give up after REDIS_SOCKET_TIMEOUT, which a
+    blocking read that waits about as long would race; this client's reads
+    wait for the block plus REDIS_SOCKET_TIMEOUT.
+    """
+    return CountingRedis(connection_pool=create_pool(max_connections=1, socket_timeout=block + REDIS_SOCKET_TIMEOUT))
+
+
+def redis_url():
+    """The configured Redis server as a URL, for clients that take one (e.g. the Socket.IO queue)."""
+    auth = f':{quote(REDIS_PASSWORD, safe="")}@' if REDIS_PASSWORD else ''
+    return f'redis://{auth}{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}'
+
+
+# Process-wide client and pool, created on first use
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_db():
+    """Get the process-wide Redis client.
+
+    HTTP requests, Socket.IO handlers and background threads all share one
+    connection pool, so connections are reused rather than opened per request.
+    """
+    global _client
+
+    client = _client
+    if client is None:
+        with _client_lock:
+            if _client is None:
+                _client = CountingRedis(connection_pool=create_pool())
+            client = _client
+    return client
+
+
+def get_pool_stats():
+    """Return connection counts and checkout wait times for the shared pool."""
+    if _client is None:
+        return None
+
+    pool = _client.connection_pool
+    in_use, idle = pool.connection_counts()
+    with pool._stats_lock:
+        return {
+            'in_use': in_use,
+            'idle': idle,
+            'max_connections': pool.max_connections,
+            'checkouts': pool.checkouts,
+            'wait_time_total': pool.wait_time_total,
+            'wait_time_avg': pool.wait_time_total / pool.checkouts if pool.checkouts else 0.0,
+            'wait_time_max': pool.wait_time_max
+        }
+
+
+def collect_pool_metrics():
+    """The shared pool's stats as metric samples."""
+    stats = get_pool_stats()
+    if stats is None:
+        return []
+    return [
+        ('redis_pool_connections', {'state': 'in_use'}, stats['in_use']),
+        ('redis_pool_connections', {'state': 'idle'}, stats['idle']),
+        ('redis_pool_max_connections', {}, stats['max_connections']),
+        ('redis_pool_checkouts_total', {}, stats['checkouts']),
+        ('redis_pool_wait_seconds_total', {}, stats['wait_time_total']),
+        ('redis_pool_wait_seconds_max', {}, stats['wait_time_max'])
+    ]
+
+
+def close_db():
+    """Disconnect every pooled connection, e.g. at process shutdown."""
+    global _client
+
+    with _client_lock:
+        client, _client = _client, None
+    if client is not None:
+        client.connection_pool.disconnect()
 
 
 def database_exists():
@@ -54,12 +266,6 @@ def init_db():
     # No need to create schemas as Redis is schemaless
 
 
-def get_next_id(entity_type):
-    """Get the next ID for a given entity type."""
-    r = get_db()
-    return r.incr(f'id:{entity_type}')
-
-
 def dict_to_redis_hash(dictionary):
     """Convert a dictionary to a format suitable for Redis hash storage.
     Handles non-string values by converting them to strings."""
@@ -100,5 +306,11 @@ def redis_hash_to_dict(hash_dict):
 
 
 def init_app(app):
-    """Register database functions with the Flask app."""
-    app.teardown_appcontext(close_db)
\ No newline at end of file
+    """Register database functions with the Flask app.
+
+    The shared pool is created up front so the first requests don't race to
+    build it, and its connections are closed when the process exits.
+    """
+    get_db()
+    atexit.register(close_db)
+    metrics.add_collector(collect_pool_metrics)
\ No newline at end of file
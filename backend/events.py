@@ -0,0 +1,193 @@
+"""Stream of processed actions, and workers that consume it in groups.
+
+Every action that succeeds is appended to the EVENT_STREAM Redis Stream in
+the same atomic write as its log entry, so the stream and the logs agree.
+Entries use one-letter field names (see EVENT_FIELDS) and leave out empty
+values; the entry ID gives the time. The stream is capped at about
+EVENT_STREAM_MAXLEN entries, so a consumer group that falls further behind
+than that misses the oldest entries.
+
+Downstream processors (analytics, achievements, anti-cheat) run an
+EventConsumer in a consumer group, off the request path:
+
+    consumer = EventConsumer('achievements', handle_events)
+    consumer.start()
+
+The handler gets batches of (entry ID, event) and the batch is acknowledged
+when it returns. If it raises, the batch stays pending and is claimed again
+(by this or another consumer in the group) once it has been idle for
+EVENT_CLAIM_IDLE seconds, so handlers should be idempotent.
+
+Usage, to print the stream as a consumer group would see it:
+    python events.py [--group GROUP] [--consumer NAME]
+"""
+import argparse
+import os
+import threading
+import time
+
+import metrics
+from codec import ACTION_EVENTS
+from database import create_blocking_client
+from redis.exceptions import ResponseError
+
+EVENT_STREAM = os.environ.get('EVENT_STREAM', 'events:actions')
+EVENT_STREAM_MAXLEN = int(os.environ.get('EVENT_STREAM_MAXLEN', 100000))
+
+# Entries read per XREADGROUP, and how long a read waits for new ones. Each
+# consumer reads on a connection of its own, whose timeout outlasts the wait.
+EVENT_BATCH = int(os.environ.get('EVENT_BATCH', 100))
+EVENT_BLOCK = float(os.environ.get('EVENT_BLOCK', 5))
+
+# Pending entries idle this long are taken over from their consumer
+EVENT_CLAIM_IDLE = float(os.environ.get('EVENT_CLAIM_IDLE', 60))
+
+# Event fields and the names they are stored under. The AP-spending and
+# batch scripts (scripts.py) write the same names.
+EVENT_FIELDS = {
+    'character_id': 'c',
+    'action_type': 'a',
+    'log_id': 'l',
+    'ap_cost': 'k',
+    'x': 'x',
+    'y': 'y',
+    'inside_building': 'b'
+}
+_FIELD_NAMES = {short: field for field, short in EVENT_FIELDS.items()}
+
+
+def action_event(character_id, action_type, log_id, ap_cost, character):
+    """An event for an action that left the character at ``character``'s position."""
+    return {
+        'character_id': character_id,
+        'action_type': action_type,
+        'log_id': log_id,
+        'ap_cost': ap_cost,
+        'x': character['x'],
+        'y': character['y'],
+        'inside_building': character['inside_building']
+    }
+
+
+def encode_event(event):
+    """Stream entry fields for an event, without the empty ones."""
+    return {EVENT_FIELDS[field]: value for field, value in ACTION_EVENTS.encode(event).items() if value != ''}
+
+
+def decode_event(fields):
+    """Turn a stream entry's fields back into an event."""
+    return ACTION_EVENTS.decode({_FIELD_NAMES.get(short, short): value for short, value in fields.items()})
+
+
+def queue_event(pipe, event):
+    """Queue appending an event to the stream on a pipeline."""
+    pipe.xadd(EVENT_STREAM, encode_event(event), maxlen=EVENT_STREAM_MAXLEN, approximate=True)
+
+
+class EventConsumer:
+    """A consumer in a group reading the event stream in batches."""
+
+    def __init__(self, group, handler, name=None, stream=EVENT_STREAM, batch=EVENT_BATCH,
+                 block=EVENT_BLOCK, claim_idle=EVENT_CLAIM_IDLE):
+        self.group = group
+        self.handler = handler
+        self.name = name or f'{os.uname().nodename}-{os.getpid()}'
+        self.stream = stream
+        self.batch = batch
+        self.block_ms = int(block * 1000)
+        self.claim_idle_ms = int(claim_idle * 1000)
+        self._claimed_at = 0
+        self._stop = threading.Event()
+
+    def ensure_group(self, db):
+        """Create the group at the start of the stream if it does not exist."""
+        try:
+            db.xgroup_create(self.stream, self.group, id='0', mkstream=True)
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def handle(self, db, entries):
+        """Pass entries to the handler and acknowledge them once it returns.
+
+        Entries trimmed from the stream while pending come back without
+        fields; they are acknowledged without being handled. Returns the
+        number of entries handled.
+        """
+        ids = [entry_id for entry_id, _ in entries]
+        events = [(entry_id, decode_event(fields)) for entry_id, fields in entries if fields]
+        if events:
+            try:
+                self.handler(events)
+            except Exception:
+                metrics.inc('events_failed_total', group=self.group)
+                raise
+        if ids:
+            db.xack(self.stream, self.group, *ids)
+            metrics.inc('events_handled_total', len(events), group=self.group)
+        return len(events)
+
+    def claim_stuck(self, db):
+        """Take over and handle entries left pending by a failed or dead consumer."""
+        handled, start = 0, '0-0'
+        while True:
+            reply = db.xautoclaim(self.stream, self.group, self.name, self.claim_idle_ms,
+                                  start_id=start, count=self.batch)
+            start, entries = reply[0], reply[1]
+            if entries:
+                metrics.inc('events_claimed_total', len(entries), group=self.group)
+                handled += self.handle(db, entries)
+            if start in ('0-0', b'0-0'):
+                return handled
+
+    def run_once(self, db):
+        """Claim stuck entries if due, then read and handle one batch of new ones."""
+        now = time.monotonic()
+        if now - self._claimed_at >= self.claim_idle_ms / 1000:
+            self._claimed_at = now
+            self.claim_stuck(db)
+
+        reply = db.xreadgroup(self.group, self.name, {self.stream: '>'}, count=self.batch, block=self.block_ms)
+        return sum(self.handle(db, entries) for _, entries in reply or ())
+
+    def run(self):
+        """Consume until stop() is called, carrying on after handler errors."""
+        db = create_blocking_client(self.block_ms / 1000)
+        try:
+            self.ensure_group(db)
+            while not self._stop.is_set():
+                try:
+                    self.run_once(db)
+                except Exception as e:
+                    print(f'Event consumer {self.group}/{self.name} failed: {e}')
+                    self._stop.wait(1)
+        finally:
+            db.connection_pool.disconnect()
+
+    def start(self):
+        """Run the consumer in a daemon thread."""
+        thread = threading.Thread(target=self.run, name=f'events-{self.group}', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        """Stop after the current read returns."""
+        self._stop.set()
+
+
+def _print_events(events):
+    for entry_id, event in events:
+        print(entry_id, event)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print action events as a consumer group reads them.')
+    parser.add_argument('--group', default='tail', help='consumer group (default: tail)')
+    parser.add_argument('--consumer', help='consumer name (default: host and PID)')
+    args = parser.parse_args()
+
+    EventConsumer(args.group, _print_events, name=args.consumer).run()
+
+
+if __name__ == '__main__':
+    main()
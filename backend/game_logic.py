@@ -1,315 +1,449 @@
-from models import (
-    get_character_by_user_id, 
-    update_character_position, 
-    update_character_stats,
-    add_action_log,
-    get_action_logs
-)
-from world_data import get_location_info, location_has_building
-
-def process_action(user_id, action_type, action_data=None):
-    """Process a player action and return the result."""
+from datetime import datetime
+import time
+
+import character_cache
+import metrics
+from actions import ACTIONS, fail
+from database import track_round_trips
+from events import action_event
+from ids import next_action_log_id
+from models import (load_action_state, load_reads, commit_action, commit_batch, spend_ap_action, regenerate_ap,
+                    now_ms)
+from serializer import encode
+from spatial import tile_key
+from world_data import format_location_info, get_location, location_has_building
+
+# Action types with a registered handler (see actions.py)
+ACTION_TYPES = tuple(ACTIONS)
+
+# Refusal when another worker holds the character (see character_cache.py)
+CHARACTER_BUSY = 'Your character is busy on another server; try again shortly'
+
+def process_action(character_id, action_type, action_data=None):
+    """Process a player action for a character and return the result.
+
+    Actions run in two Redis round trips: one script call gathers every read
+    up front, and one write applies the updates and log entry and reads back
+    the recent logs. Locations come from the in-process world snapshot.
+    Action data is validated before anything is loaded, and the handler's
+    declared reads are fetched with the character. AP-spending actions write
+    through their Lua script, the rest through the commit_action script.
+
+    Round trips are tracked per action type, and the time spent loading,
+    deciding and writing is recorded in the action_duration_seconds metric.
+    """
     if action_data is None:
         action_data = {}
-    
-    character = get_character_by_user_id(user_id)
-    character_id = character['id']
-    
-    result = {
-        'success': True,
-        'message': '',
-        'character_updates': {},
-        'log_entry': ''
-    }
+
+    label = action_type if action_type in ACTION_TYPES else 'INVALID'
+    with track_round_trips(f'action:{label}'), \
+            metrics.timer('action_duration_seconds', action=label, phase='total'):
+        if character_cache.ENABLED:
+            results, result = _process_cached(character_id, [(action_type, action_data)], label)
+            result = result or results[0]
+        else:
+            result = _process_action(character_id, action_type, action_data)
+
+    metrics.inc('actions_total', action=label, outcome='success' if result.get('success') else 'failure')
+    return result
+
+def _process_action(character_id, action_type, action_data):
+    """Run a single action against state loaded in one batch."""
+    error = _validate(action_type, action_data)
+    if error:
+        return {'success': False, 'message': error}
+    action = ACTIONS[action_type]
+
+    with metrics.timer('action_duration_seconds', action=action_type, phase='load'):
+        state = load_action_state(character_id, action.reads)
+    if state is None:
+        return {'success': False, 'message': 'Character not found'}
+
+    character = state['character']
+    location = get_location(character['x'], character['y'])
     
     # Handle different action types
-    if action_type == 'MOVE':
-        result = handle_move(character, action_data.get('direction'))
-    elif action_type == 'ENTER_BUILDING':
-        result = handle_enter_building(character)
-    elif action_type == 'EXIT_BUILDING':
-        result = handle_exit_building(character)
-    elif action_type == 'REST':
-        result = handle_rest(character)
-    elif action_type == 'SEARCH':
-        result = handle_search(character)
+    decided = time.perf_counter()
+    result = _run_handler(character, location, action_type, action_data, state['reads'])
+    metrics.observe('action_duration_seconds', time.perf_counter() - decided, action=action_type, phase='handler')
+    
+    # AP-spending actions are checked and applied atomically on the server
+    if result['success'] and action.script:
+        with metrics.timer('action_duration_seconds', action=action_type, phase='commit'):
+            applied = _apply_ap_action(result, character, location, action, state['log_id'])
+        if applied is None:
+            # The character moved since it was loaded; decide again where it is now
+            return _process_action(character_id, action_type, action_data)
+        return applied
+    
+    # Work out the character updates in memory
+    updated_character, updates = _apply_updates(character, result)
+    
+    # Build the action log entry and event
+    log_data = event = None
+    if result['success']:
+        if result['log_entry']:
+            log_data = _log_data(state['log_id'], character_id, action_type, result['log_entry'])
+        event = action_event(character_id, action_type, log_data and log_data['id'], 0, updated_character)
+    
+    # Write everything at once; a move takes the tile index entry along
+    with metrics.timer('action_duration_seconds', action=action_type, phase='commit'):
+        logs = commit_action(character, updates=updates, log_data=log_data, event=event,
+                             tile_move=_tile_move(character, updated_character))
+    if logs is None:
+        # The character moved since it was loaded; decide again where it is now
+        return _process_action(character_id, action_type, action_data)
+    location = get_location(updated_character['x'], updated_character['y'])
+    
+    return _finish_result(result, character, updated_character, location, logs)
+
+def process_actions(character_id, actions):
+    """Process several queued actions for a character as one batch.
+
+    ``actions`` is a list of (action type, action data). The character is
+    loaded once and each action is decided in order against the state the
+    previous ones left, AP included, in memory. The net effect of those that
+    succeed is written in one script call, which re-checks AP on the server
+    and that the character has not changed since it was loaded; if it has,
+    the actions run one at a time through process_action instead. With the
+    character cache enabled the batch is decided against the cached
+    character and journaled like a single action.
+
+    Returns (results, final): a {'success', 'message'} result per action, and
+    the state after the batch as process_action returns it (with the last
+    successful action's message), or None if no action succeeded.
+    """
+    if len(actions) == 1:
+        result = process_action(character_id, *actions[0])
+        return [{'success': result['success'], 'message': result.get('message', '')}], \
+            (result if result['success'] else None)
+
+    with track_round_trips('action:BATCH'), \
+            metrics.timer('action_duration_seconds', action='BATCH', phase='total'):
+        if character_cache.ENABLED:
+            results, final = _process_cached(character_id, actions, 'BATCH')
+            loaded = None
+        else:
+            results, final, loaded = _process_batch(character_id, actions)
+
+    committed = results is not None
+    if not committed:
+        # The character changed under the batch; fall back to one at a time
+        results, final = [], None
+        for action_type, action_data in actions:
+            result = process_action(character_id, action_type, action_data)
+            results.append({'success': result['success'], 'message': result.get('message', '')})
+            if result['success']:
+                final = result
+        if final is not None:
+            final.pop('previous_tile', None)
+            _set_previous_tile(final, loaded, final['character'])
     else:
-        result['success'] = False
-        result['message'] = 'Invalid action type'
-        return result
-    
-    # Apply character updates
+        for (action_type, _), result in zip(actions, results):
+            label = action_type if action_type in ACTION_TYPES else 'INVALID'
+            metrics.inc('actions_total', action=label, outcome='success' if result['success'] else 'failure')
+
+    metrics.inc('action_batches_total', outcome='committed' if committed else 'fallback')
+    return results, final
+
+def _process_batch(character_id, actions):
+    """Decide a batch in memory and write it at once.
+
+    Returns (results, final result, loaded character), or (None, None,
+    loaded character) if the write found the character changed.
+    """
+    invalid = _invalid_results(actions)
+    if invalid:
+        return invalid, None, None
+
+    with metrics.timer('action_duration_seconds', action='BATCH', phase='load'):
+        state = load_action_state(character_id, _declared_reads(actions))
+    if state is None:
+        return [{'success': False, 'message': 'Character not found'} for _ in actions], None, None
+
+    loaded = state['character']
+    results, character, updates, log_entries, events, cost, message = \
+        _decide_batch(loaded, actions, state['log_id'], state['reads'], 'BATCH')
+    if message is None:
+        return results, None, loaded
+
+    # AP is written from the server's count, so leave it to the script
+    updates.pop('ap', None)
+    updates.pop('ap_updated_at', None)
+
+    with metrics.timer('action_duration_seconds', action='BATCH', phase='commit'):
+        committed = commit_batch(loaded, cost, updates, log_entries, events,
+                                 tile_move=_tile_move(loaded, character))
+    if committed is None:
+        return None, None, loaded
+
+    character.update(committed['updates'])
+    final = {'success': True, 'message': message, 'character_updates': {}, 'log_entry': ''}
+    location = get_location(character['x'], character['y'])
+    return results, _finish_result(final, loaded, character, location, committed['logs']), loaded
+
+def _process_cached(character_id, actions, label):
+    """Decide actions against the cached character and journal the result.
+
+    Returns (results, final result) as process_actions does.
+    """
+    invalid = _invalid_results(actions)
+    if invalid:
+        return invalid, None
+
+    with metrics.timer('action_duration_seconds', action=label, phase='load'):
+        entry = character_cache.acquire(character_id)
+        if entry is None:
+            return [{'success': False, 'message': CHARACTER_BUSY} for _ in actions], None
+        reads = load_reads(character_id, _declared_reads(actions))
+
+    with entry.lock:
+        if not character_cache.held(character_id, entry):
+            return [{'success': False, 'message': CHARACTER_BUSY} for _ in actions], None
+        loaded = regenerate_ap(dict(entry.character), now_ms())
+        results, character, updates, log_entries, events, cost, message = \
+            _decide_batch(loaded, actions, None, reads, label)
+        if message is None:
+            return results, None
+
+        with metrics.timer('action_duration_seconds', action=label, phase='commit'):
+            logs = character_cache.commit(entry, character, updates, log_entries, events,
+                                          tile_move=_tile_move(loaded, character))
+
+    final = {'success': True, 'message': message, 'character_updates': {}, 'log_entry': ''}
+    location = get_location(character['x'], character['y'])
+    return results, _finish_result(final, loaded, character, location, logs)
+
+def _decide_batch(loaded, actions, log_id, reads, label):
+    """Decide actions in order against a character, in memory.
+
+    Each action sees the state the previous ones left, AP included.
+    ``log_id`` is used for the first log entry, if given, and ``reads`` are
+    the declared reads of every action in the batch. Returns (results,
+    final character, fields to write, log entries, events, total AP cost,
+    last successful message or None).
+    """
+    character, updates = dict(loaded), {}
+    results, log_entries, events, cost, message = [], [], [], 0, None
+
+    decided = time.perf_counter()
+    for action_type, action_data in actions:
+        action_data = {} if action_data is None else action_data
+        error = _validate(action_type, action_data)
+        if error:
+            results.append({'success': False, 'message': error})
+            continue
+
+        location = get_location(character['x'], character['y'])
+        result = _run_handler(character, location, action_type, action_data, reads)
+        results.append({'success': result['success'], 'message': result['message']})
+        if not result['success']:
+            continue
+
+        character, changed = _apply_updates(character, result)
+        updates.update(changed)
+        action_cost = ACTIONS[action_type].cost
+        cost += action_cost
+        message = result['message']
+        action_log_id = None
+        if result['log_entry']:
+            action_log_id, log_id = log_id or next_action_log_id(), None
+            log_entries.append(_log_data(action_log_id, loaded['id'], action_type, result['log_entry']))
+        events.append(action_event(loaded['id'], action_type, action_log_id, action_cost, character))
+    metrics.observe('action_duration_seconds', time.perf_counter() - decided, action=label, phase='handler')
+
+    return results, character, updates, log_entries, events, cost, message
+
+def _validate(action_type, action_data):
+    """Why an action cannot run, judged from its type and data alone, or None."""
+    action = ACTIONS.get(action_type) if isinstance(action_type, str) else None
+    if action is None:
+        return 'Invalid action type'
+    if not isinstance(action_data, dict):
+        return 'Invalid action data'
+    return action.validate(action_data)
+
+def _invalid_results(actions):
+    """Results for a batch in which no action is valid, or None if any is."""
+    errors = [_validate(action_type, {} if action_data is None else action_data)
+              for action_type, action_data in actions]
+    if all(errors):
+        return [{'success': False, 'message': error} for error in errors]
+    return None
+
+def _declared_reads(actions):
+    """The reads declared by the valid actions in a batch, each once."""
+    reads = {}
+    for action_type, _ in actions:
+        if isinstance(action_type, str) and action_type in ACTIONS:
+            reads.update(dict.fromkeys(ACTIONS[action_type].reads))
+    return tuple(reads)
+
+def _run_handler(character, location, action_type, action_data, reads):
+    """Decide an action against a character and its location, without I/O.
+
+    The handler runs once the AP check and its preconditions pass, and the
+    AP cost is deducted from the result.
+    """
+    action = ACTIONS[action_type]
+    reason = action.check(character, location)
+    if reason:
+        return fail(reason)
+
+    result = action.run(character, location, action_data, reads)
+    if result['success'] and action.cost:
+        result['character_updates'].setdefault('stats', {})['ap'] = character['ap'] - action.cost
+    return result
+
+def _apply_updates(character, result):
+    """Apply a handler's character updates to a copy of the character.
+
+    Returns (updated character, fields to write).
+    """
+    updated_character = dict(character)
+    updates = {}
     if result['success'] and result['character_updates']:
         if 'position' in result['character_updates']:
             pos = result['character_updates']['position']
-            update_character_position(
-                character_id, 
-                pos['x'], 
-                pos['y'], 
-                pos['inside_building']
-            )
+            updated_character.update(x=pos['x'], y=pos['y'], inside_building=pos['inside_building'])
+            updates.update(x=pos['x'], y=pos['y'], inside_building=1 if pos['inside_building'] else 0)
         
         if 'stats' in result['character_updates']:
-            stats = result['character_updates']['stats']
-            update_character_stats(
-                character_id,
-                health=stats.get('health'),
-                mp=stats.get('mp'),
-                ap=stats.get('ap'),
-                experience=stats.get('experience')
-            )
+            stats = clamp_stats(character, result['character_updates']['stats'])
+            updated_character.update(stats)
+            updates.update(stats)
+    return updated_character, updates
+
+def _log_data(log_id, character_id, action_type, message):
+    return {
+        'id': log_id,
+        'character_id': character_id,
+        'action_type': action_type,
+        'message': message,
+        'created_at': datetime.now().isoformat()
+    }
+
+def _tile_move(character, updated_character):
+    """The (old, new) tile index keys if the character changed tile, else None."""
+    old_tile = tile_key(character['x'], character['y'], character['inside_building'])
+    new_tile = tile_key(updated_character['x'], updated_character['y'], updated_character['inside_building'])
+    if new_tile != old_tile:
+        return old_tile, new_tile
+    return None
+
+def _apply_ap_action(result, character, location, action, log_id):
+    """Apply an AP-spending action through its server-side script.
+
+    Returns None if the character moved since it was loaded.
+    """
+    spent = spend_ap_action(
+        action.script,
+        character,
+        action.type,
+        action.cost,
+        log_id,
+        result['message'],
+        result['log_entry'],
+        action.denied
+    )
+    
+    if spent is None:
+        return None
+    if not spent['success']:
+        return {'success': False, 'message': spent['message']}
+    
+    result['message'] = spent['message']
+    result['log_entry'] = spent['log_entry']
     
-    # Add action log
-    if result['success'] and result['log_entry']:
-        add_action_log(character_id, action_type, result['log_entry'])
+    updated_character = dict(character)
+    updated_character.update(spent['updates'])
     
-    # Get updated character data
-    updated_character = get_character_by_user_id(user_id)
+    return _finish_result(result, character, updated_character, location, spent['logs'])
+
+def _finish_result(result, character, updated_character, location, logs):
+    """Attach the post-action state the client needs to an action result."""
     result['character'] = updated_character
     
+    # Record the tile side left behind, so occupants of both can be told
+    _set_previous_tile(result, character, updated_character)
+    
     # Get location info
-    result['location'] = get_location_info(
-        updated_character['x'], 
-        updated_character['y'], 
-        updated_character['inside_building']
-    )
+    result['location'] = format_location_info(location, updated_character['inside_building'])
     
     # Get available actions
-    result['available_actions'] = get_available_actions(
+    result['available_actions'] = get_available_actions_json(
         updated_character['x'], 
         updated_character['y'], 
-        updated_character['inside_building']
+        updated_character['inside_building'],
+        has_building=bool(location and location.has_building)
     )
     
     # Get recent logs
-    result['logs'] = get_action_logs(character_id)
+    result['logs'] = logs
     
     return result
 
-def get_available_actions(x, y, inside_building):
-    """Get available actions for a character at a specific location."""
-    actions = []
-    
-    # Movement is always available when outside
-    if not inside_building:
-        actions.append({
-            'type': 'MOVE',
-            'name': 'Move',
-            'options': [
-                {'value': 'north', 'label': 'North'},
-                {'value': 'east', 'label': 'East'},
-                {'value': 'south', 'label': 'South'},
-                {'value': 'west', 'label': 'West'}
-            ]
-        })
-    
-    # Enter building action
-    if not inside_building and location_has_building(x, y):
-        actions.append({
-            'type': 'ENTER_BUILDING',
-            'name': 'Enter Building',
-            'options': []
-        })
-    
-    # Exit building action
-    if inside_building:
-        actions.append({
-            'type': 'EXIT_BUILDING',
-            'name': 'Exit Building',
-            'options': []
-        })
-    
-    # Rest action is always available
-    actions.append({
-        'type': 'REST',
-        'name': 'Rest',
-        'options': []
-    })
-    
-    # Search action
-    actions.append({
-        'type': 'SEARCH',
-        'name': 'Search Area',
-        'options': []
-    })
-    
-    return actions
-
-def handle_move(character, direction):
-    """Handle character movement."""
-    result = {
-        'success': True,
-        'message': '',
-        'character_updates': {},
-        'log_entry': ''
-    }
-    
-    # Determine new position based on direction
-    new_x, new_y = character['x'], character['y']
-    
-    if direction == 'north':
-        new_y = max(0, character['y'] - 1)
-    elif direction == 'east':
-        new_x = min(2, character['x'] + 1)
-    elif direction == 'south':
-        new_y = min(2, character['y'] + 1)
-    elif direction == 'west':
-        new_x = max(0, character['x'] - 1)
-    else:
-        result['success'] = False
-        result['message'] = 'Invalid direction'
-        return result
-    
-    # Check if actually moved
-    if new_x == character['x'] and new_y == character['y']:
-        result['message'] = "You can't move any further in that direction."
-        return result
-    
-    # Update position and AP
-    result['character_updates']['position'] = {
-        'x': new_x,
-        'y': new_y,
-        'inside_building': False
-    }
-    
-    result['message'] = f'Moved {direction}'
-    result['log_entry'] = f'Moved {direction} to ({new_x}, {new_y})'
-    
-    return result
-
-def handle_enter_building(character):
-    """Handle entering a building."""
-    result = {
-        'success': True,
-        'message': '',
-        'character_updates': {},
-        'log_entry': ''
-    }
-    
-    # Check if character has enough AP
-    if character['ap'] < 1:
-        result['success'] = False
-        result['message'] = 'Not enough AP to enter building'
-        return result
-    
-    # Check if there's a building to enter
-    if not location_has_building(character['x'], character['y']):
-        result['success'] = False
-        result['message'] = 'No building to enter at this location'
-        return result
-    
-    # Update position and AP
-    result['character_updates']['position'] = {
+def _set_previous_tile(result, character, updated_character):
+    """Set result['previous_tile'] if the character changed tile."""
+    previous_tile = {
         'x': character['x'],
         'y': character['y'],
-        'inside_building': True
+        'inside_building': bool(character['inside_building'])
     }
-    
-    result['character_updates']['stats'] = {
-        'ap': character['ap'] - 1
+    current_tile = {
+        'x': updated_character['x'],
+        'y': updated_character['y'],
+        'inside_building': bool(updated_character['inside_building'])
     }
-    
-    location = get_location_info(character['x'], character['y'], False)
-    building_name = location.get('building_name', 'building')
-    
-    result['message'] = f'Entered {building_name}'
-    result['log_entry'] = f'Entered {building_name} at ({character["x"]}, {character["y"]})'
-    
-    return result
+    if current_tile != previous_tile:
+        result['previous_tile'] = previous_tile
 
-def handle_exit_building(character):
-    """Handle exiting a building."""
-    result = {
-        'success': True,
-        'message': '',
-        'character_updates': {},
-        'log_entry': ''
-    }
-    
-    # Check if character has enough AP
-    if character['ap'] < 1:
-        result['success'] = False
-        result['message'] = 'Not enough AP to exit building'
-        return result
+def clamp_stats(character, stats):
+    """Clamp stat updates to the character's maximums, as stored in Redis."""
+    updates = {}
     
-    # Check if character is actually in a building
-    if not character['inside_building']:
-        result['success'] = False
-        result['message'] = 'Not inside a building'
-        return result
+    if stats.get('health') is not None:
+        updates['health'] = min(stats['health'], character['max_health'])
     
-    # Update position and AP
-    result['character_updates']['position'] = {
-        'x': character['x'],
-        'y': character['y'],
-        'inside_building': False
-    }
+    if stats.get('mp') is not None:
+        updates['mp'] = min(stats['mp'], character['max_mp'])
     
-    result['character_updates']['stats'] = {
-        'ap': character['ap'] - 1
-    }
+    if stats.get('ap') is not None:
+        updates['ap'] = min(stats['ap'], character['max_ap'])
+        # The loaded AP includes regeneration up to ap_updated_at; keep them together
+        updates['ap_updated_at'] = character['ap_updated_at']
     
-    location = get_location_info(character['x'], character['y'], True)
-    building_name = location.get('building_name', 'building')
+    if stats.get('experience') is not None:
+        updates['experience'] = stats['experience']
     
-    result['message'] = f'Exited {building_name}'
-    result['log_entry'] = f'Exited {building_name} at ({character["x"]}, {character["y"]})'
-    
-    return result
+    return updates
 
-def handle_rest(character):
-    """Handle resting to recover HP and MP."""
-    result = {
-        'success': True,
-        'message': '',
-        'character_updates': {},
-        'log_entry': ''
-    }
-    
-    # Check if character has enough AP
-    if character['ap'] < 2:
-        result['success'] = False
-        result['message'] = 'Not enough AP to rest (need 2 AP)'
-        return result
-    
-    # Calculate recovery amounts
-    hp_recovery = min(10, character['max_health'] - character['health'])
-    mp_recovery = min(10, character['max_mp'] - character['mp'])
-    
-    # Update stats
-    result['character_updates']['stats'] = {
-        'health': character['health'] + hp_recovery,
-        'mp': character['mp'] + mp_recovery,
-        'ap': character['ap'] - 2
-    }
-    
-    result['message'] = f'Rested and recovered {hp_recovery} HP and {mp_recovery} MP'
-    result['log_entry'] = f'Rested and recovered {hp_recovery} HP and {mp_recovery} MP'
-    
-    return result
+def get_available_actions(x, y, inside_building, has_building=None):
+    """Get available actions for a character at a specific location.
 
-def handle_search(character):
-    """Handle searching the area."""
-    result = {
-        'success': True,
-        'message': '',
-        'character_updates': {},
-        'log_entry': ''
-    }
-    
-    # Check if character has enough AP
-    if character['ap'] < 1:
-        result['success'] = False
-        result['message'] = 'Not enough AP to search'
-        return result
-    
-    # For now, just a simple search with no rewards
-    result['character_updates']['stats'] = {
-        'ap': character['ap'] - 1
-    }
-    
-    location_type = 'building' if character['inside_building'] else 'area'
-    result['message'] = f'Searched the {location_type} but found nothing'
-    result['log_entry'] = f'Searched the {location_type} at ({character["x"]}, {character["y"]}) but found nothing'
-    
-    return result
+    Pass ``has_building`` when the location is already loaded to skip the
+    lookup. The returned list is shared between callers and must not be modified.
+    """
+    return _ACTION_MENUS[_action_menu_key(x, y, inside_building, has_building)][0]
+
+def get_available_actions_json(x, y, inside_building, has_building=None):
+    """Get available actions as pre-encoded JSON (a RawJSON string)."""
+    return _ACTION_MENUS[_action_menu_key(x, y, inside_building, has_building)][1]
+
+def _action_menu_key(x, y, inside_building, has_building):
+    """Key the action menus by the tile's building state."""
+    inside_building = bool(inside_building)
+    if has_building is None:
+        has_building = inside_building or location_has_building(x, y)
+    return (bool(has_building), inside_building)
+
+def build_available_actions(has_building, inside_building):
+    """Build the action menu for a tile's building state, in registration order."""
+    return [action.menu_entry() for action in ACTIONS.values() if action.available(has_building, inside_building)]
+
+# Every action menu, built and encoded once: (has_building, inside_building) -> (actions, RawJSON)
+_ACTION_MENUS = {}
+for has_building in (False, True):
+    for inside_building in (False, True):
+        menu = build_available_actions(has_building, inside_building)
+        _ACTION_MENUS[(has_building, inside_building)] = (menu, encode(menu))
@@ -0,0 +1,252 @@
+import atexit
+import itertools
+import os
+import threading
+import time
+
+from database import get_db
+from presence import NODE_ID
+from scripts import register_script, run_script
+
+# IDs reserved from Redis per INCRBY; unused IDs in a block are skipped on restart
+ID_BLOCK_SIZE = int(os.environ.get('ID_BLOCK_SIZE', 100))
+
+# How action log IDs are made: 'block' (reserved from id:action_logs) or
+# 'snowflake' (time-ordered, generated locally with no central counter)
+ACTION_LOG_IDS = os.environ.get('ACTION_LOG_IDS', 'block')
+
+# Snowflake layout: 41 bits of milliseconds since SNOWFLAKE_EPOCH, 5 bits of
+# worker ID and 7 bits of sequence. That is 53 bits in total, so the IDs stay
+# exact as JavaScript numbers (Number.MAX_SAFE_INTEGER is 2**53 - 1).
+SNOWFLAKE_EPOCH = 1704067200000  # 2024-01-01T00:00:00Z in milliseconds
+WORKER_ID_BITS = 5
+SEQUENCE_BITS = 7
+MAX_WORKER_ID = (1 << WORKER_ID_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+# Without WORKER_ID, each process leases a free worker ID: the key
+# id:worker:{n} holding its node ID. The lease is renewed every third of
+# SNOWFLAKE_LEASE_TTL seconds and lapses that long after its holder stops.
+SNOWFLAKE_LEASE_TTL = float(os.environ.get('SNOWFLAKE_LEASE_TTL', 30))
+
+# Takes the first free worker ID lease.
+#
+# KEYS: the lease of every worker ID, in order
+# ARGV: node ID, lease ms
+#
+# Returns the worker ID taken, or -1 if every one is leased.
+register_script('lease_worker_id', """
+for i, key in ipairs(KEYS) do
+    if redis.call('SET', key, ARGV[1], 'NX', 'PX', ARGV[2]) then
+        return i - 1
+    end
+end
+return -1
+""")
+
+# Renews a worker ID lease this node holds, or releases it when lease ms is 0.
+#
+# KEYS: worker ID lease
+# ARGV: node ID, lease ms
+#
+# Returns 0 if this node no longer holds the lease.
+register_script('renew_worker_id', """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if ARGV[2] == '0' then
+    redis.call('DEL', KEYS[1])
+else
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 1
+""")
+
+
+class NoFreeWorkerId(Exception):
+    """Every snowflake worker ID is leased by another process."""
+
+
+class BlockIdAllocator:
+    """Hands out IDs locally from blocks reserved with one INCRBY each.
+
+    Taking the next ID from the current block is a single ``next()`` on an
+    itertools.count, which is atomic under the GIL, so threads only lock
+    when a block runs out and a new one has to be reserved.
+    """
+
+    def __init__(self, entity_type, block_size=ID_BLOCK_SIZE):
+        self.key = f'id:{entity_type}'
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._block = (itertools.count(1), 0)  # (counter, last ID in block)
+
+    def _reserve(self):
+        last = get_db().incrby(self.key, self.block_size)
+        return itertools.count(last - self.block_size + 1), last
+
+    def next_id(self):
+        while True:
+            block = self._block
+            value = next(block[0])
+            if value <= block[1]:
+                return value
+
+            with self._lock:
+                if self._block is block:
+                    self._block = self._reserve()
+
+
+class SnowflakeIdGenerator:
+    """Generates time-ordered IDs locally from the clock, a worker ID and a sequence."""
+
+    def __init__(self, worker_id):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f'Worker ID must be between 0 and {MAX_WORKER_ID}')
+
+        self.worker_id = worker_id
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._sequence = 0
+
+    def next_id(self):
+        with self._lock:
+            now = int(time.time() * 1000) - SNOWFLAKE_EPOCH
+
+            # Never go backwards if the clock does; keep counting in the last millisecond
+            now = max(now, self._last_ms)
+
+            if now == self._last_ms:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    # Sequence exhausted for this millisecond; wait for the next one
+                    while now <= self._last_ms:
+                        now = int(time.time() * 1000) - SNOWFLAKE_EPOCH
+            else:
+                self._sequence = 0
+
+            self._last_ms = now
+            return (now << (WORKER_ID_BITS + SEQUENCE_BITS)) | (self.worker_id << SEQUENCE_BITS) | self._sequence
+
+
+class WorkerIdLease:
+    """A snowflake worker ID leased from Redis.
+
+    The ID may only be used while ``held()``: until the lease's TTL, counted
+    from before the last successful renewal was sent, so it stops being
+    used before Redis can hand it to another process.
+    """
+
+    def __init__(self, node_id=NODE_ID, ttl=SNOWFLAKE_LEASE_TTL):
+        self.node_id = node_id
+        self.ttl = ttl
+        self.worker_id = None
+        self._held_until = 0.0
+        self._released = threading.Event()
+
+    def _key(self):
+        return f'id:worker:{self.worker_id}'
+
+    def acquire(self):
+        """Lease the first free worker ID and return it; raises NoFreeWorkerId if none is."""
+        sent = time.monotonic()
+        keys = [f'id:worker:{worker_id}' for worker_id in range(MAX_WORKER_ID + 1)]
+        worker_id = run_script(get_db(), 'lease_worker_id', keys=keys, args=[self.node_id, int(self.ttl * 1000)])
+        if worker_id < 0:
+            raise NoFreeWorkerId(f'All {MAX_WORKER_ID + 1} snowflake worker IDs are leased')
+        self.worker_id = worker_id
+        self._held_until = sent + self.ttl
+        return worker_id
+
+    def held(self):
+        return time.monotonic() < self._held_until
+
+    def renew(self):
+        """Extend the lease; returns False if it was lost."""
+        sent = time.monotonic()
+        renewed = run_script(get_db(), 'renew_worker_id', keys=[self._key()], args=[self.node_id, int(self.ttl * 1000)])
+        if renewed:
+            self._held_until = sent + self.ttl
+        else:
+            self._held_until = 0.0
+        return bool(renewed)
+
+    def release(self):
+        """Give the worker ID back and stop renewing."""
+        self._released.set()
+        self._held_until = 0.0
+        if self.worker_id is not None:
+            run_script(get_db(), 'renew_worker_id', keys=[self._key()], args=[self.node_id, 0])
+
+    def _run_renewal(self):
+        while not self._released.wait(self.ttl / 3):
+            try:
+                if not self.renew():
+                    return
+            except Exception as e:
+                print(f'Snowflake worker ID {self.worker_id} renewal failed: {e}')
+
+    def start_renewal(self):
+        """Renew the lease in a daemon thread until it is lost or released."""
+        thread = threading.Thread(target=self._run_renewal, name='worker-id-lease', daemon=True)
+        thread.start()
+        return thread
+
+
+_allocators = {}
+_allocators_lock = threading.Lock()
+_action_log_ids = None
+_worker_id_lease = None
+
+
+def next_id(entity_type):
+    """Get the next ID for an entity type from this process's reserved block."""
+    allocator = _allocators.get(entity_type)
+    if allocator is None:
+        with _allocators_lock:
+            allocator = _allocators.setdefault(entity_type, BlockIdAllocator(entity_type))
+    return allocator.next_id()
+
+
+def _lease_worker_id():
+    """Lease a worker ID for this process, giving back any it held before."""
+    global _worker_id_lease
+
+    _release_worker_id()
+    lease = WorkerIdLease()
+    lease.acquire()
+    lease.start_renewal()
+    _worker_id_lease = lease
+    return lease.worker_id
+
+
+def _release_worker_id():
+    if _worker_id_lease is not None:
+        _worker_id_lease.release()
+
+
+atexit.register(_release_worker_id)
+
+
+def next_action_log_id():
+    """Get the next action log ID, using the scheme chosen by ACTION_LOG_IDS.
+
+    Snowflake IDs use WORKER_ID if set, otherwise a leased worker ID. If the
+    lease is lost, a free worker ID is leased again before the next ID.
+    """
+    global _action_log_ids
+
+    if ACTION_LOG_IDS != 'snowflake':
+        return next_id('action_logs')
+
+    generator = _action_log_ids
+    if generator is None or (_worker_id_lease is not None and not _worker_id_lease.held()):
+        with _allocators_lock:
+            if _action_log_ids is generator:
+                if 'WORKER_ID' in os.environ:
+                    worker_id = int(os.environ['WORKER_ID'])
+                else:
+                    worker_id = _lease_worker_id()
+                _action_log_ids = SnowflakeIdGenerator(worker_id)
+            generator = _action_log_ids
+    return generator.next_id()
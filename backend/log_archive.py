@@ -0,0 +1,93 @@
+"""Move old action log entries from Redis to compressed files on disk.
+
+Usage:
+    python log_archive.py [--older-than SECONDS]
+
+Entries older than LOG_ARCHIVE_AFTER (or --older-than), and the oldest
+beyond each character's newest LOG_MAX_ENTRIES, are appended to
+LOG_ARCHIVE_DIR/<character_id>.jsonl.gz and then removed from the
+character's action_logs sorted set. Run it periodically, e.g. from cron,
+with LOG_ARCHIVE=1 set for the app so writes leave the count cap to it
+(see models.py).
+"""
+import argparse
+import gzip
+import json
+import os
+import time
+
+from database import get_db
+from models import LOG_MAX_ENTRIES
+
+LOG_ARCHIVE_DIR = os.environ.get('LOG_ARCHIVE_DIR', 'log_archive')
+LOG_ARCHIVE_AFTER = int(os.environ.get('LOG_ARCHIVE_AFTER', 7 * 24 * 3600))
+
+
+def archive_path(character_id):
+    """Path of a character's archive file."""
+    return os.path.join(LOG_ARCHIVE_DIR, f'{character_id}.jsonl.gz')
+
+
+def archive_action_logs(db, character_id, cutoff, keep=LOG_MAX_ENTRIES):
+    """Archive one character's entries scored at or before ``cutoff``, and
+    any older than its newest ``keep``.
+
+    Entries are only removed from Redis after they have been written to disk.
+    Returns the number of entries archived.
+    """
+    key = f'action_logs:{character_id}'
+
+    entries = db.zrangebyscore(key, '-inf', cutoff, withscores=True)
+    over = db.zcard(key) - keep
+    if over > len(entries):
+        entries = db.zrange(key, 0, over - 1, withscores=True)
+    if not entries:
+        return 0
+
+    os.makedirs(LOG_ARCHIVE_DIR, exist_ok=True)
+
+    # Appending to a gzip file adds a new member; readers see one stream
+    with gzip.open(archive_path(character_id), 'at', encoding='utf-8') as archive:
+        for entry, score in entries:
+            archive.write(json.dumps({'score': score, 'entry': json.loads(entry)}) + '\n')
+
+    db.zremrangebyscore(key, '-inf', entries[-1][1])
+    return len(entries)
+
+
+def archive_all(db, older_than=LOG_ARCHIVE_AFTER, keep=LOG_MAX_ENTRIES):
+    """Archive old entries for every character. Returns the total archived."""
+    cutoff = time.time() - older_than
+    archived = 0
+
+    for key in db.scan_iter(match='action_logs:*', count=1000):
+        character_id = key.split(':', 1)[1]
+        archived += archive_action_logs(db, character_id, cutoff, keep)
+
+    return archived
+
+
+def read_archived_logs(character_id):
+    """Yield a character's archived log entries, oldest first."""
+    path = archive_path(character_id)
+    if not os.path.exists(path):
+        return
+
+    with gzip.open(path, 'rt', encoding='utf-8') as archive:
+        for line in archive:
+            yield json.loads(line)['entry']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Archive old action log entries to disk.')
+    parser.add_argument('--older-than', type=int, default=LOG_ARCHIVE_AFTER,
+                        help='archive entries older than this many seconds')
+    parser.add_argument('--keep', type=int, default=LOG_MAX_ENTRIES,
+                        help='archive all but this many of each character\'s newest entries')
+    args = parser.parse_args()
+
+    print(f'Archived {archive_all(get_db(), args.older_than, args.keep)} action log entries')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+"""In-process metrics in the Prometheus text format, plus an opt-in sampling profiler.
+
+Counters, gauges and histograms are kept per worker in plain dicts under one
+lock, so recording a sample costs a dict lookup and an add. ``render()``
+writes them out for the /metrics endpoint; each worker is scraped on its
+own. Collectors added with ``add_collector`` are read at render time, for
+values that already live elsewhere (e.g. the Redis pool's counts).
+
+The profiler samples the stack of one thread every PROFILE_INTERVAL seconds
+while a request runs. It only runs for requests that send PROFILE_TOKEN in
+the X-Profile header, so it can be turned on for a single request in
+production. Under eventlet the sampler is a green thread too, so it only
+samples when the request yields (e.g. on Redis I/O).
+"""
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import deque, Counter
+from contextlib import contextmanager
+from functools import wraps
+
+# Bearer token required to read /metrics; empty leaves it open
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# X-Profile header value that turns on the profiler for a request; empty disables it
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN', '')
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.001))
+# Recent profiles kept for /metrics/profiles
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', 20))
+
+# Histogram buckets in seconds, from sub-millisecond Redis commands to slow requests
+BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+HELP = {
+    'http_request_duration_seconds': ('histogram', 'HTTP request handling time by endpoint and status'),
+    'socketio_event_duration_seconds': ('histogram', 'Socket.IO event handling time by event'),
+    'action_duration_seconds': ('histogram', 'process_action time by action type and phase'),
+    'actions_total': ('counter', 'Actions processed by action type and outcome'),
+    'action_batches_total': ('counter', 'Queued action batches by whether they were written at once'),
+    'redis_commands_total': ('counter', 'Redis commands sent by command'),
+    'redis_command_duration_seconds': ('histogram', 'Redis round trip time by command (PIPELINE for a pipeline)'),
+    'socketio_connections': ('gauge', 'Open Socket.IO connections on this worker'),
+    'socketio_emit_bytes_total': ('counter', 'Encoded Socket.IO packet bytes by event'),
+    'socketio_emits_total': ('counter', 'Encoded Socket.IO packets by event'),
+    'redis_pool_connections': ('gauge', 'Redis pool connections by state'),
+    'redis_pool_max_connections': ('gauge', 'Redis pool size limit'),
+    'redis_pool_checkouts_total': ('counter', 'Connections checked out of the Redis pool'),
+    'redis_pool_wait_seconds_total': ('counter', 'Time spent waiting for a Redis pool connection'),
+    'redis_pool_wait_seconds_max': ('gauge', 'Longest wait for a Redis pool connection'),
+    'password_hash_duration_seconds': ('histogram', 'Password hash and verify time, queueing included'),
+    'password_hash_rejected_total': ('counter', 'Password hashes turned away by reason'),
+    'events_handled_total': ('counter', 'Action events handled by consumer group'),
+    'events_failed_total': ('counter', 'Event batches whose handler raised, by consumer group'),
+    'events_claimed_total': ('counter', 'Pending action events taken over from another consumer, by group'),
+    'profiles_total': ('counter', 'Requests profiled by the sampling profiler')
+}
+
+_lock = threading.Lock()
+_counters = {}    # (name, labels) -> value
+_gauges = {}      # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [count per bucket..., count above the last, sum]
+_collectors = []
+
+
+def inc(name, amount=1, **labels):
+    """Add to a counter."""
+    key = (name, tuple(labels.items()))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def set_gauge(name, value, **labels):
+    key = (name, tuple(labels.items()))
+    with _lock:
+        _gauges[key] = value
+
+
+def add_gauge(name, amount, **labels):
+    """Move a gauge up or down, e.g. on connect and disconnect."""
+    key = (name, tuple(labels.items()))
+    with _lock:
+        _gauges[key] = _gauges.get(key, 0) + amount
+
+
+def observe(name, seconds, **labels):
+    """Record a duration in a histogram."""
+    key = (name, tuple(labels.items()))
+    bucket = bisect_left(BUCKETS, seconds)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(BUCKETS) + 2)
+        histogram[bucket] += 1
+        histogram[-1] += seconds
+
+
+@contextmanager
+def timer(name, **labels):
+    """Record how long the block takes in a histogram."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def timed(name, **labels):
+    """Decorator that records each call's duration in a histogram."""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with timer(name, **labels):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add_collector(collect):
+    """Read extra samples at render time.
+
+    ``collect()`` returns (name, labels dict, value) tuples for metrics listed
+    in HELP, or nothing when it has no values yet.
+    """
+    _collectors.append(collect)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs) + '}'
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        histograms = {key: list(value) for key, value in _histograms.items()}
+
+    for collect in _collectors:
+        for name, labels, value in collect() or ():
+            kind = HELP[name][0]
+            (counters if kind == 'counter' else gauges)[(name, tuple(labels.items()))] = value
+
+    samples = {}
+    for (name, labels), value in list(counters.items()) + list(gauges.items()):
+        samples.setdefault(name, []).append(f'{name}{_format_labels(labels)} {value}')
+
+    for (name, labels), histogram in histograms.items():
+        lines = samples.setdefault(name, [])
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), histogram):
+            cumulative += count
+            lines.append(f'{name}_bucket{_format_labels(labels, [("le", bound)])} {cumulative}')
+        lines.append(f'{name}_sum{_format_labels(labels)} {histogram[-1]}')
+        lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+
+    output = []
+    for name in sorted(samples):
+        kind, description = HELP.get(name, ('untyped', name))
+        output.append(f'# HELP {name} {description}')
+        output.append(f'# TYPE {name} {kind}')
+        output.extend(samples[name])
+    return '\n'.join(output) + '\n'
+
+
+def reset():
+    """Forget every recorded value, e.g. between benchmark runs."""
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+
+
+class SamplingProfiler:
+    """Samples one thread's stack at a fixed interval from a background thread.
+
+    Stacks are counted in the collapsed format flame graph tools read:
+    ``outer;inner;innermost count``, one line per distinct stack.
+    """
+
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.stacks
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        return '\n'.join(f'{stack} {count}' for stack, count in self.stacks.most_common())
+
+
+# Most recent profiles as (label, wall seconds, collapsed stacks)
+_profiles = deque(maxlen=PROFILE_KEEP)
+
+
+def profile_requested(header_value):
+    """Whether a request's X-Profile header turns the profiler on."""
+    return bool(PROFILE_TOKEN) and header_value == PROFILE_TOKEN
+
+
+def start_profile():
+    """Start sampling the calling thread."""
+    return SamplingProfiler(threading.get_ident()).start(), time.perf_counter()
+
+
+def finish_profile(label, profile):
+    """Stop a profile from start_profile and keep its stacks for /metrics/profiles."""
+    profiler, started = profile
+    profiler.stop()
+    _profiles.append((label, time.perf_counter() - started, profiler.collapsed()))
+    inc('profiles_total')
+
+
+def render_profiles():
+    """The kept profiles, newest first, each under a header line."""
+    return '\n\n'.join(
+        f'# {label} {seconds * 1000:.1f} ms\n{stacks}' for label, seconds, stacks in reversed(_profiles)
+    ) + '\n'
+
+
+def authorized(header_value):
+    """Whether an Authorization header may read the metrics."""
+    return not METRICS_TOKEN or header_value == f'Bearer {METRICS_TOKEN}'
@@ -0,0 +1,120 @@
+"""Rewrite stored user and character records through their codecs.
+
+Usage:
+    python migrate_records.py [--dry-run]
+
+Every user:* and character:* hash is decoded with its schema and written
+back in canonical form (booleans as 1/0, integers without padding, missing
+schema fields filled with their defaults). A record is only rewritten if
+it is still as it was read, so a concurrent write is never overwritten
+with the old values; records that changed are read and rewritten again.
+"""
+import argparse
+
+from codec import CODECS_BY_PREFIX
+from database import get_db
+from scripts import register_script, run_script
+from serializer import dumps_text
+
+BATCH_SIZE = 500
+
+# Rewrites the hashes that are unchanged since they were read.
+#
+# KEYS: the hashes
+# ARGV: per hash, its [field, value, ...] as read and the [field, value, ...]
+#       to write, both as JSON
+#
+# Returns {number rewritten, [0-based positions of the hashes that changed]}.
+register_script('rewrite_records', """
+local rewritten, changed = 0, {}
+for i, key in ipairs(KEYS) do
+    local read = cjson.decode(ARGV[2 * i - 1])
+    local current = redis.call('HGETALL', key)
+    local same = #current == #read
+    if same then
+        local expected = {}
+        for j = 1, #read, 2 do
+            expected[read[j]] = read[j + 1]
+        end
+        for j = 1, #current, 2 do
+            if expected[current[j]] ~= current[j + 1] then
+                same = false
+                break
+            end
+        end
+    end
+    if same then
+        redis.call('HSET', key, unpack(cjson.decode(ARGV[2 * i])))
+        rewritten = rewritten + 1
+    else
+        changed[#changed + 1] = i - 1
+    end
+end
+return {rewritten, changed}
+""")
+
+
+def _flatten(mapping):
+    return dumps_text([item for pair in mapping.items() for item in pair])
+
+
+def canonical(codec, hash_dict):
+    """A record's schema fields in canonical form, or None for an empty hash."""
+    record = codec.decode(hash_dict)
+    if record is None:
+        return None
+    return codec.encode({field: record.get(field, default) for field, default in codec.defaults.items()})
+
+
+def migrate_batch(db, keys, codec, dry_run=False):
+    """Rewrite a batch of hashes, reading again any that change meanwhile; returns how many were rewritten."""
+    migrated = 0
+
+    while keys:
+        read = db.pipeline(transaction=False)
+        for key in keys:
+            read.hgetall(key)
+        hashes = read.execute()
+
+        records = [(key, hash_dict, canonical(codec, hash_dict)) for key, hash_dict in zip(keys, hashes)]
+        records = [(key, hash_dict, record) for key, hash_dict, record in records if record is not None]
+        if dry_run:
+            return len(records)
+        if not records:
+            break
+
+        args = []
+        for _, hash_dict, record in records:
+            args += [_flatten(hash_dict), _flatten(record)]
+        rewritten, changed = run_script(db, 'rewrite_records', keys=[key for key, _, _ in records], args=args)
+
+        migrated += rewritten
+        keys = [records[position][0] for position in changed]
+
+    return migrated
+
+
+def migrate_prefix(db, prefix, codec, dry_run=False):
+    """Migrate every hash under a key prefix and return how many were rewritten."""
+    migrated = 0
+    keys = list(db.scan_iter(match=f'{prefix}:*', count=BATCH_SIZE, _type='hash'))
+
+    for start in range(0, len(keys), BATCH_SIZE):
+        migrated += migrate_batch(db, keys[start:start + BATCH_SIZE], codec, dry_run=dry_run)
+
+    return migrated
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rewrite stored records through their codecs.')
+    parser.add_argument('--dry-run', action='store_true', help='decode records without writing')
+    args = parser.parse_args()
+
+    db = get_db()
+    for prefix, codec in CODECS_BY_PREFIX.items():
+        count = migrate_prefix(db, prefix, codec, dry_run=args.dry_run)
+        print(f"{'Checked' if args.dry_run else 'Migrated'} {count} {prefix} records")
+
+
+if __name__ == '__main__':
+    main()
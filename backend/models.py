@@ -1,20 +1,86 @@
-from database import get_db, get_next_id, dict_to_redis_hash, redis_hash_to_dict
+from database import get_db
+from ids import next_id, next_action_log_id
+from codec import USERS, CHARACTERS
+from events import EVENT_STREAM, EVENT_STREAM_MAXLEN, encode_event
+from scripts import run_script
+from serializer import RawJSON, dumps_text
+from spatial import tile_key
 from datetime import datetime
-import json
+import os
 import time
 
+# Action log bounds, enforced in the same write that appends an entry.
+# When archiving (see log_archive.py), set LOG_ARCHIVE=1 and keep
+# LOG_ARCHIVE_AFTER below LOG_MAX_AGE so entries reach cold storage before
+# they are trimmed. Writes then leave the count cap to the archiver, which
+# moves entries beyond LOG_MAX_ENTRIES to disk rather than dropping them.
+LOG_ARCHIVE = os.environ.get('LOG_ARCHIVE', '0') == '1'
+LOG_MAX_ENTRIES = int(os.environ.get('LOG_MAX_ENTRIES', 200))
+LOG_MAX_AGE = int(os.environ.get('LOG_MAX_AGE', 30 * 24 * 3600))
+
+# Entries kept by count when writing; 0 for no count cap
+LOG_TRIM_ENTRIES = 0 if LOG_ARCHIVE else LOG_MAX_ENTRIES
+LOG_PAGE_MAX = 100
+
+# AP regenerates lazily: the stored ``ap`` is the value at ``ap_updated_at``
+# (ms since the epoch), and AP_REGEN_AMOUNT is regained every
+# AP_REGEN_INTERVAL seconds after that, up to max_ap. Nothing is written until
+# the character next spends AP.
+AP_REGEN_INTERVAL = int(os.environ.get('AP_REGEN_INTERVAL', 60))
+AP_REGEN_AMOUNT = int(os.environ.get('AP_REGEN_AMOUNT', 1))
+
+
+def _pairs_to_dict(flat):
+    """Turn a flat [field, value, ...] reply from Lua into a dict."""
+    return dict(zip(flat[::2], flat[1::2]))
+
+
+def now_ms():
+    """Current time in milliseconds since the epoch."""
+    return int(time.time() * 1000)
+
+
+def regenerate_ap(character, now):
+    """Bring a character's AP up to date as of ``now`` (ms).
+
+    Updates ``ap`` and ``ap_updated_at`` in place and returns the character.
+    Part of an interval already waited carries over; at max_ap it does not.
+    The AP-spending scripts apply the same rule on the server.
+    """
+    interval = AP_REGEN_INTERVAL * 1000
+    ap, max_ap = character['ap'], character['max_ap']
+    anchor = character.get('ap_updated_at') or now
+
+    if ap < max_ap:
+        ticks = max(0, now - anchor) // interval
+        ap = min(max_ap, ap + ticks * AP_REGEN_AMOUNT)
+        anchor += ticks * interval
+    if ap >= max_ap:
+        anchor = now
+
+    character['ap'] = ap
+    character['ap_updated_at'] = anchor
+    return character
+
+
+def next_ap_regen_at(character):
+    """When a regenerated character next gains AP (ms), or None at max_ap."""
+    if character['ap'] >= character['max_ap']:
+        return None
+    return character['ap_updated_at'] + AP_REGEN_INTERVAL * 1000
+
 
 def create_user(username, password_hash, character_name):
-    """Create a new user and character."""
+    """Create a new user and character; returns (user ID, character ID)."""
     db = get_db()
 
     # Check if username already exists
     if db.exists(f'username:{username}'):
         raise ValueError("Username already exists")
 
-    # Get new IDs
-    user_id = get_next_id('users')
-    character_id = get_next_id('characters')
+    # Get new IDs from this worker's reserved blocks
+    user_id = next_id('users')
+    character_id = next_id('characters')
 
     try:
         # Create user
@@ -22,6 +88,7 @@ def create_user(username, password_hash, character_name):
             'id': user_id,
             'username': username,
             'password_hash': password_hash,
+            'character_id': character_id,
             'created_at': datetime.now().isoformat()
         }
 
@@ -36,6 +103,7 @@ def create_user(username, password_hash, character_name):
             'max_mp': 100,
             'ap': 10,
             'max_ap': 10,
+            'ap_updated_at': now_ms(),
             'experience': 0,
             'x': 1,
             'y': 1,
@@ -47,17 +115,17 @@ def create_user(username, password_hash, character_name):
         pipe = db.pipeline()
 
         # Store user
-        pipe.hmset(f'user:{user_id}', dict_to_redis_hash(user_data))
+        pipe.hmset(f'user:{user_id}', USERS.encode(user_data))
         pipe.set(f'username:{username}', user_id)
 
         # Store character
-        pipe.hmset(f'character:{character_id}', dict_to_redis_hash(character_data))
+        pipe.hmset(f'character:{character_id}', CHARACTERS.encode(character_data))
         pipe.set(f'user_character:{user_id}', character_id)
+        pipe.zadd(tile_key(1, 1, False), {character_id: character_id})
 
         # Create initial action log
-        log_id = get_next_id('action_logs')
         log_data = {
-            'id': log_id,
+            'id': next_action_log_id(),
             'character_id': character_id,
             'action_type': 'SIGNUP',
             'message': f'Created character {character_name}',
@@ -66,12 +134,12 @@ def create_user(username, password_hash, character_name):
 
         # Store log in a sorted set
         timestamp = time.time()
-        pipe.zadd(f'action_logs:{character_id}', {json.dumps(log_data): timestamp})
+        pipe.zadd(f'action_logs:{character_id}', {encode_log(log_data): timestamp})
 
         # Execute all commands
         pipe.execute()
 
-        return user_id
+        return user_id, character_id
     except Exception as e:
         # Redis doesn't have transactions in the same way as SQLite,
         # but we can at least raise the error
@@ -89,7 +157,12 @@ def get_user_by_username(username):
 
     # Get user data
     user_data = db.hgetall(f'user:{user_id}')
-    return redis_hash_to_dict(user_data)
+    return USERS.decode(user_data)
+
+
+def update_password_hash(user_id, password_hash):
+    """Replace a user's stored password hash, e.g. after rehashing at a new cost."""
+    get_db().hset(f'user:{user_id}', 'password_hash', password_hash)
 
 
 def get_user_by_id(user_id):
@@ -97,91 +170,266 @@ def get_user_by_id(user_id):
     db = get_db()
 
     user_data = db.hgetall(f'user:{user_id}')
-    return redis_hash_to_dict(user_data)
+    return USERS.decode(user_data)
+
+
+def get_character_id(user_id):
+    """Get the ID of a user's character, or None."""
+    character_id = get_db().get(f'user_character:{user_id}')
+    return int(character_id) if character_id else None
+
+
+def get_character(character_id):
+    """Get a character by ID, with the AP regenerated since it was last spent."""
+    character = CHARACTERS.decode(get_db().hgetall(f'character:{character_id}'))
+    if character is None:
+        return None
+    return regenerate_ap(character, now_ms())
+
+
+def get_character_position(character_id):
+    """A character's (x, y, inside_building), read with one HMGET, or None."""
+    fields = ('x', 'y', 'inside_building')
+    values = get_db().hmget(f'character:{character_id}', *fields)
+    if values[0] is None:
+        return None
+    position = CHARACTERS.decode(dict(zip(fields, values)))
+    return position['x'], position['y'], position['inside_building']
 
 
 def get_character_by_user_id(user_id):
-    """Get a character by user_id."""
-    db = get_db()
+    """Get a character by user_id.
 
-    # Get character_id from user_id
-    character_id = db.get(f'user_character:{user_id}')
-    if not character_id:
+    Request handlers know the character ID from the session and should call
+    get_character instead, which skips the user_character lookup.
+    """
+    character_id = get_character_id(user_id)
+    if character_id is None:
         return None
+    return get_character(character_id)
 
-    # Get character data
-    character_data = db.hgetall(f'character:{character_id}')
-    return redis_hash_to_dict(character_data)
 
+def encode_log(log_data):
+    """Encode an action log entry for storage."""
+    return dumps_text(log_data)
 
-def update_character_position(character_id, x, y, inside_building):
-    """Update a character's position."""
+
+def decode_logs(entries):
+    """Stored action log entries, kept as the JSON text they were stored as.
+
+    Entries are RawJSON, so responses and socket emits splice them in
+    without parsing and re-encoding them; parse one with serializer.loads.
+    """
+    return [RawJSON(entry) for entry in entries]
+
+
+def trim_action_logs(pipe, character_id, now):
+    """Queue commands on a pipeline that cap a character's log by count and age."""
+    key = f'action_logs:{character_id}'
+    if LOG_TRIM_ENTRIES:
+        pipe.zremrangebyrank(key, 0, -(LOG_TRIM_ENTRIES + 1))
+    pipe.zremrangebyscore(key, '-inf', f'({now - LOG_MAX_AGE}')
+
+
+def get_action_logs(character_id, limit=10):
+    """Get recent action logs for a character."""
     db = get_db()
 
-    # Update specific fields
-    db.hmset(f'character:{character_id}', {
-        'x': x,
-        'y': y,
-        'inside_building': 1 if inside_building else 0
-    })
+    # Get the most recent logs from the sorted set
+    log_entries = db.zrevrange(f'action_logs:{character_id}', 0, limit - 1)
+
+    return decode_logs(log_entries)
 
 
-def update_character_stats(character_id, health=None, mp=None, ap=None, experience=None):
-    """Update a character's stats."""
+def get_action_logs_page(character_id, before=None, limit=20):
+    """Get a page of action logs, newest first, older than the ``before`` score.
+
+    Returns the logs and the cursor for the next (older) page, which is None
+    once the oldest entry has been returned. Entries sharing the cursor's exact
+    score are skipped, which at microsecond timestamps does not happen in practice.
+    """
     db = get_db()
 
-    # Get current character data
-    character_data = redis_hash_to_dict(db.hgetall(f'character:{character_id}'))
-    if not character_data:
-        return
+    limit = max(1, min(limit, LOG_PAGE_MAX))
+    max_score = f'({before}' if before is not None else '+inf'
+
+    entries = db.zrevrangebyscore(
+        f'action_logs:{character_id}', max_score, '-inf', start=0, num=limit, withscores=True
+    )
+
+    return {
+        'logs': decode_logs(entry for entry, _ in entries),
+        'next_before': entries[-1][1] if len(entries) == limit else None
+    }
+
+
+# Reads an action handler can declare (see actions.py), fetched by the load
+# script in the same round trip as the character: name -> (function giving
+# the key for a character ID, kind of read (see scripts.READ_KEYS), count,
+# function decoding the reply)
+ACTION_READS = {
+    'recent_logs': (lambda character_id: f'action_logs:{character_id}', 'recent', 10, decode_logs)
+}
 
-    # Prepare updates
-    updates = {}
 
-    if health is not None:
-        updates['health'] = min(health, character_data['max_health'])
+def _read_keys(character_id, reads):
+    """The KEYS and ARGV that fetch the named ACTION_READS for a character."""
+    keys, args = [], []
+    for name in reads:
+        key, kind, count, _ = ACTION_READS[name]
+        keys.append(key(character_id))
+        args += [kind, count]
+    return keys, args
 
-    if mp is not None:
-        updates['mp'] = min(mp, character_data['max_mp'])
 
-    if ap is not None:
-        updates['ap'] = min(ap, character_data['max_ap'])
+def _decode_reads(reads, replies):
+    return {name: ACTION_READS[name][3](reply or []) for name, reply in zip(reads, replies)}
 
-    if experience is not None:
-        updates['experience'] = experience
 
-    # Apply updates if any
-    if updates:
-        db.hmset(f'character:{character_id}', dict_to_redis_hash(updates))
+def load_reads(character_id, reads):
+    """Fetch the named ACTION_READS for a character in one round trip."""
+    if not reads:
+        return {}
+    keys, args = _read_keys(character_id, reads)
+    return _decode_reads(reads, run_script(get_db(), 'load_reads', keys=keys, args=args))
 
 
-def add_action_log(character_id, action_type, message):
-    """Add an action log entry."""
+def load_action_state(character_id, reads=()):
+    """Load a character in one round trip, with a log ID for the entry it may write.
+
+    The character's AP is regenerated up to the Redis server's clock. The
+    named ACTION_READS are fetched by the same script call.
+    """
     db = get_db()
 
-    # Create log entry
-    log_id = get_next_id('action_logs')
-    log_data = {
-        'id': log_id,
-        'character_id': character_id,
-        'action_type': action_type,
-        'message': message,
-        'created_at': datetime.now().isoformat()
+    keys, args = _read_keys(character_id, reads)
+    reply = run_script(db, 'load_action_state', keys=[f'character:{character_id}', *keys], args=args)
+
+    (seconds, microseconds), fields, read_replies = reply
+    character = CHARACTERS.decode(_pairs_to_dict(fields))
+    if character is None:
+        return None
+
+    now = int(seconds) * 1000 + int(microseconds) // 1000
+    return {
+        'character': regenerate_ap(character, now),
+        'log_id': next_action_log_id(),
+        'reads': _decode_reads(reads, read_replies)
     }
 
-    # Add to sorted set with current timestamp as score
-    timestamp = time.time()
-    db.zadd(f'action_logs:{character_id}', {json.dumps(log_data): timestamp})
 
+def commit_action(character, updates=None, log_data=None, log_limit=10, event=None, tile_move=None):
+    """Write an action's results in one script call and read back the recent logs.
 
-def get_action_logs(character_id, limit=10):
-    """Get recent action logs for a character."""
+    ``character`` is the character as loaded before the action. Character
+    field updates, the log entry and the action's event (see events.py) are
+    applied atomically. A move also moves the character's tile index entry
+    between the ``tile_move`` keys, but only if the character is still where
+    it was loaded; otherwise nothing is written and None is returned.
+    Returns the most recent log entries.
+    """
     db = get_db()
 
-    # Get the most recent logs from the sorted set
-    log_entries = db.zrevrange(f'action_logs:{character_id}', 0, limit - 1)
+    character_id = character['id']
+    now = time.time()
+    args = [log_limit, LOG_TRIM_ENTRIES, now - LOG_MAX_AGE,
+            now, encode_log(log_data) if log_data else '', EVENT_STREAM_MAXLEN,
+            dumps_text([item for pair in encode_event(event).items() for item in pair]) if event else '',
+            character['x'], character['y'], 1 if character['inside_building'] else 0]
+    for field, value in CHARACTERS.encode(updates or {}).items():
+        args += [field, value]
+
+    reply = run_script(
+        db,
+        'commit_action',
+        keys=[f'character:{character_id}', f'action_logs:{character_id}', *(tile_move or ('', '')), EVENT_STREAM],
+        args=args
+    )
+
+    if not reply[0]:
+        return None
+    return decode_logs(reply[1])
+
 
-    # Parse JSON strings back to dictionaries
-    logs = [json.loads(entry) for entry in log_entries]
+def spend_ap_action(script_name, character, action_type, cost, log_id,
+                    message, log_entry, denied_message, log_limit=10):
+    """Run an AP-spending action as one atomic server-side script.
+
+    The script checks and deducts AP against the stored value, applies the
+    action's stat changes clamped to their maximums and appends the log entry
+    and the action's event. ``character`` is the character as loaded; an
+    action that takes it in or out of a building at another position is not
+    written, and None is returned. Returns the outcome, the fields written
+    and the recent logs.
+    """
+    db = get_db()
 
-    return logs
\ No newline at end of file
+    character_id, x, y = character['id'], character['x'], character['y']
+    now = time.time()
+    reply = run_script(
+        db,
+        script_name,
+        keys=[f'character:{character_id}', f'action_logs:{character_id}', EVENT_STREAM,
+              tile_key(x, y, False), tile_key(x, y, True)],
+        args=[cost, log_id, datetime.now().isoformat(), now, log_limit,
+              message, log_entry, denied_message, action_type,
+              LOG_TRIM_ENTRIES, now - LOG_MAX_AGE,
+              AP_REGEN_INTERVAL * 1000, AP_REGEN_AMOUNT, EVENT_STREAM_MAXLEN, x, y]
+    )
+
+    if reply[0] == -1:
+        return None
+    if not reply[0]:
+        return {'success': False, 'message': reply[1]}
+
+    _, message, log_entry, fields, logs = reply
+    return {
+        'success': True,
+        'message': message,
+        'log_entry': log_entry,
+        'updates': CHARACTERS.decode(_pairs_to_dict(fields)) or {},
+        'logs': decode_logs(logs)
+    }
+
+
+def commit_batch(character, cost, updates, log_entries, events=(), tile_move=None, log_limit=10):
+    """Write the net effect of a batch of actions in one script call, with their events.
+
+    ``character`` is the character as loaded before the batch. The write only
+    happens if its position, health and MP are unchanged and its AP covers
+    ``cost``; otherwise None is returned and nothing is written. On success
+    returns the AP fields written and the recent logs.
+    """
+    db = get_db()
+
+    character_id = character['id']
+    now = time.time()
+    encoded = CHARACTERS.encode(updates)
+
+    args = [cost, log_limit, LOG_TRIM_ENTRIES, now - LOG_MAX_AGE,
+            AP_REGEN_INTERVAL * 1000, AP_REGEN_AMOUNT,
+            character['x'], character['y'], 1 if character['inside_building'] else 0,
+            character['health'], character['mp'], EVENT_STREAM_MAXLEN,
+            dumps_text([[item for pair in encode_event(event).items() for item in pair] for event in events]),
+            len(encoded)]
+    for field, value in encoded.items():
+        args += [field, value]
+    # Later entries score higher, so the log keeps the batch's order
+    for offset, log_data in enumerate(log_entries):
+        args += [now + offset / 1e6, encode_log(log_data)]
+
+    reply = run_script(
+        db,
+        'commit_batch',
+        keys=[f'character:{character_id}', f'action_logs:{character_id}', *(tile_move or ('', '')), EVENT_STREAM],
+        args=args
+    )
+
+    if not reply[0]:
+        return None
+
+    _, fields, logs = reply
+    return {
+        'updates': CHARACTERS.decode(_pairs_to_dict(fields)),
+        'logs': decode_logs(logs)
+    }
@@ -0,0 +1,134 @@
+"""Password hashing on a bounded pool of worker processes.
+
+PBKDF2 is slow on purpose, so hashing inline holds a request thread (or,
+under eventlet, the whole event loop) for the duration. Hashes run in a
+process pool instead, and the caller waits on the result. At most
+PASSWORD_HASH_QUEUE hashes may be queued or running at once; beyond that
+HashingBusy is raised straight away, so a login storm gets 503s instead of
+starving the game endpoints.
+
+Hashes made with another method or cost than PASSWORD_HASH_METHOD are
+replaced with a fresh hash on the next successful login (see needs_rehash).
+
+Workers are spawned rather than forked, so they start from a fresh
+interpreter instead of a copy of the server's green threads, locks and
+Redis connections, and the pool is shut down without waiting for them when
+the server exits.
+"""
+import atexit
+import os
+import threading
+import weakref
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from multiprocessing.context import SpawnContext, SpawnProcess
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+import metrics
+
+# Method and cost for new hashes, in werkzeug's method:hash:iterations form
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:260000')
+
+# Worker processes; 0 hashes in the calling thread (e.g. for development)
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+
+# Hashes allowed to be queued or running before callers are turned away
+PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE', max(1, PASSWORD_HASH_WORKERS) * 8))
+
+# Longest a caller waits for its hash, and the Retry-After given when busy
+PASSWORD_HASH_TIMEOUT = float(os.environ.get('PASSWORD_HASH_TIMEOUT', 10))
+PASSWORD_HASH_RETRY_AFTER = int(os.environ.get('PASSWORD_HASH_RETRY_AFTER', 2))
+
+
+class HashingBusy(Exception):
+    """The hashing queue is full or too slow; retry after ``retry_after`` seconds."""
+
+    def __init__(self, retry_after=PASSWORD_HASH_RETRY_AFTER):
+        super().__init__('Password hashing is busy')
+        self.retry_after = retry_after
+
+
+class _WorkerProcess(SpawnProcess):
+    """A spawned pool worker, remembered so that only the pool's own workers are stopped."""
+
+    def start(self):
+        super().start()
+        _workers.add(self)
+
+
+class _WorkerContext(SpawnContext):
+    Process = _WorkerProcess
+
+
+_workers = weakref.WeakSet()
+_slots = threading.BoundedSemaphore(PASSWORD_HASH_QUEUE)
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+
+    pool = _pool
+    if pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, mp_context=_WorkerContext())
+                atexit.register(_shutdown_pool, _pool)
+            pool = _pool
+    return pool
+
+
+def _shutdown_pool(pool):
+    """Stop the pool's workers, dropping queued hashes, without waiting for running ones.
+
+    Without eventlet, concurrent.futures' own exit hook runs first and lets
+    the queued hashes finish, which PASSWORD_HASH_QUEUE keeps short.
+    """
+    pool.shutdown(wait=False, cancel_futures=True)
+    # Joining the workers can hang under eventlet; a hash left running is lost anyway
+    for process in list(_workers):
+        process.terminate()
+
+
+def _run(operation, fn, *args):
+    """Run fn in the pool, or raise HashingBusy if the queue is full or it times out."""
+    if not _slots.acquire(blocking=False):
+        metrics.inc('password_hash_rejected_total', reason='queue_full')
+        raise HashingBusy()
+
+    with metrics.timer('password_hash_duration_seconds', operation=operation):
+        if PASSWORD_HASH_WORKERS == 0:
+            try:
+                return fn(*args)
+            finally:
+                _slots.release()
+
+        try:
+            future = _get_pool().submit(fn, *args)
+        except Exception:
+            _slots.release()
+            raise
+        # The slot is held until the work finishes, even if the caller gives up
+        future.add_done_callback(lambda _: _slots.release())
+
+        try:
+            return future.result(timeout=PASSWORD_HASH_TIMEOUT)
+        except TimeoutError:
+            metrics.inc('password_hash_rejected_total', reason='timeout')
+            raise HashingBusy()
+
+
+def hash_password(password):
+    """Hash a password with the configured method."""
+    return _run('hash', generate_password_hash, password, PASSWORD_HASH_METHOD)
+
+
+def verify_password(password_hash, password):
+    """Check a password against a stored hash."""
+    return _run('verify', check_password_hash, password_hash, password)
+
+
+def needs_rehash(password_hash):
+    """Whether a stored hash was made with a method or cost other than the configured one."""
+    return password_hash.split('$', 1)[0] != PASSWORD_HASH_METHOD
@@ -0,0 +1,153 @@
+import os
+import socket
+import threading
+import time
+
+from database import get_db
+from scripts import register_script, run_script
+
+# Identifies this worker in the presence keys; must be unique per process
+NODE_ID = os.environ.get('NODE_ID', f'{socket.gethostname()}:{os.getpid()}')
+
+# A node whose heartbeat is older than this is treated as dead and purged
+NODE_TTL = int(os.environ.get('PRESENCE_NODE_TTL', 30))
+HEARTBEAT_INTERVAL = NODE_TTL / 3
+
+# Presence keys:
+#   presence:sids          hash of socket ID -> user ID, for every open socket
+#   presence:user:{id}     set of a user's open socket IDs, on any node
+#   presence:node:{node}   set of socket IDs held by one node
+#   presence:online        set of user IDs with at least one open socket
+#   presence:nodes         set of live node IDs
+#   presence:alive:{node}  heartbeat key that expires if the node dies
+
+# Records an open socket.
+#
+# KEYS: presence:sids, the user's socket set, the node's socket set, presence:online
+# ARGV: socket ID, user ID
+#
+# Returns the user's open socket count.
+register_script('presence_join', """
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+redis.call('SADD', KEYS[2], ARGV[1])
+redis.call('SADD', KEYS[3], ARGV[1])
+redis.call('SADD', KEYS[4], ARGV[2])
+return redis.call('SCARD', KEYS[2])
+""")
+
+# Removes sockets held by one node.
+#
+# KEYS: presence:sids, the node's socket set, presence:online, then the
+#       socket set of each socket's user
+# ARGV: socket ID, user ID pairs, in the order of the user socket sets
+#
+# Returns how many sockets each user still has open, for the sockets that
+# were still recorded.
+register_script('presence_leave', """
+local remaining = {}
+for i = 4, #KEYS do
+    local sid, user_id = ARGV[2 * (i - 4) + 1], ARGV[2 * (i - 4) + 2]
+    redis.call('SREM', KEYS[2], sid)
+    if redis.call('HGET', KEYS[1], sid) == user_id then
+        redis.call('HDEL', KEYS[1], sid)
+        redis.call('SREM', KEYS[i], sid)
+        local count = redis.call('SCARD', KEYS[i])
+        if count == 0 then
+            redis.call('SREM', KEYS[3], user_id)
+        end
+        remaining[#remaining + 1] = count
+    end
+end
+return remaining
+""")
+
+
+def _user_key(user_id):
+    return f'presence:user:{user_id}'
+
+
+def _node_key(node):
+    return f'presence:node:{node}'
+
+
+def join(sid, user_id):
+    """Record an open socket for a user. Returns the user's open socket count."""
+    keys = ['presence:sids', _user_key(user_id), _node_key(NODE_ID), 'presence:online']
+    return run_script(get_db(), 'presence_join', keys=keys, args=[sid, user_id])
+
+
+def _leave(db, node, sockets):
+    """Remove (socket ID, user ID) pairs held by a node; returns the users' remaining socket counts."""
+    keys = ['presence:sids', _node_key(node), 'presence:online']
+    args = []
+    for sid, user_id in sockets:
+        keys.append(_user_key(user_id))
+        args += [sid, user_id]
+    return run_script(db, 'presence_leave', keys=keys, args=args)
+
+
+def leave(sid, user_id):
+    """Forget a user's closed socket. Returns how many sockets the user still has open."""
+    remaining = _leave(get_db(), NODE_ID, [(sid, user_id)])
+    return remaining[0] if remaining else 0
+
+
+def get_user_sockets(user_id):
+    """Socket IDs a user has open across every node."""
+    return get_db().smembers(_user_key(user_id))
+
+
+def is_online(user_id):
+    """Whether a user has any socket open on any node."""
+    return bool(get_db().sismember('presence:online', user_id))
+
+
+def heartbeat():
+    """Mark this node alive and purge the sockets of nodes that stopped beating."""
+    db = get_db()
+
+    pipe = db.pipeline(transaction=False)
+    pipe.set(f'presence:alive:{NODE_ID}', '1', ex=NODE_TTL)
+    pipe.sadd('presence:nodes', NODE_ID)
+    pipe.smembers('presence:nodes')
+    nodes = pipe.execute()[-1]
+
+    others = [node for node in nodes if node != NODE_ID]
+    if not others:
+        return
+
+    pipe = db.pipeline(transaction=False)
+    for node in others:
+        pipe.exists(f'presence:alive:{node}')
+    for node, alive in zip(others, pipe.execute()):
+        if not alive:
+            purge_node(node)
+
+
+def purge_node(node):
+    """Remove every socket a dead node held, then the node itself."""
+    db = get_db()
+
+    sids = list(db.smembers(_node_key(node)))
+    for start in range(0, len(sids), 500):
+        batch = sids[start:start + 500]
+        user_ids = db.hmget('presence:sids', batch)
+        _leave(db, node, [(sid, user_id) for sid, user_id in zip(batch, user_ids) if user_id is not None])
+    db.delete(_node_key(node))
+    db.srem('presence:nodes', node)
+
+
+def _run_heartbeat():
+    while True:
+        try:
+            heartbeat()
+        except Exception as e:
+            print(f'Presence heartbeat failed: {e}')
+        time.sleep(HEARTBEAT_INTERVAL)
+
+
+def start_heartbeat():
+    """Start the heartbeat in a daemon thread (a green thread under eventlet)."""
+    thread = threading.Thread(target=_run_heartbeat, name='presence-heartbeat', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,347 @@
+import hashlib
+from redis.exceptions import NoScriptError
+
+# Registered Lua scripts: name -> (sha1, source)
+_scripts = {}
+
+
+def register_script(name, source):
+    """Register a Lua script under a name and return its SHA1."""
+    sha = hashlib.sha1(source.encode('utf-8')).hexdigest()
+    _scripts[name] = (sha, source)
+    return sha
+
+
+def load_scripts(db):
+    """Load every registered script into the Redis script cache with SCRIPT LOAD."""
+    pipe = db.pipeline(transaction=False)
+    for sha, source in _scripts.values():
+        pipe.script_load(source)
+    pipe.execute()
+
+
+def run_script(db, name, keys=(), args=()):
+    """Run a registered script with EVALSHA.
+
+    If the script cache was flushed (or this server never saw the script), the
+    script is loaded again and the call retried once.
+    """
+    sha, source = _scripts[name]
+    try:
+        return db.evalsha(sha, len(keys), *keys, *args)
+    except NoScriptError:
+        db.script_load(source)
+        return db.evalsha(sha, len(keys), *keys, *args)
+
+
+def queue_script(pipe, name, keys=(), args=()):
+    """Queue a registered script on a pipeline with EVALSHA.
+
+    Pipelines cannot retry a single command, so load_scripts must have run
+    against the server; if its script cache was flushed since, the pipeline
+    raises NoScriptError and the caller reloads and retries.
+    """
+    sha, _ = _scripts[name]
+    pipe.evalsha(sha, len(keys), *keys, *args)
+
+
+# Defines read_keys(first), which reads KEYS[first] onwards as an action's
+# declared reads (see models.ACTION_READS) and returns the replies in order.
+# Each key takes a (kind, count) pair from ARGV, in the same order: 'hash'
+# reads the whole hash, 'recent' the count highest-scored members of a sorted
+# set and 'value' a string.
+READ_KEYS = """
+local function read_keys(first)
+    local replies = {}
+    for i = first, #KEYS do
+        local kind, count = ARGV[2 * (i - first) + 1], tonumber(ARGV[2 * (i - first) + 2])
+        if kind == 'hash' then
+            replies[#replies + 1] = redis.call('HGETALL', KEYS[i])
+        elseif kind == 'recent' then
+            replies[#replies + 1] = redis.call('ZREVRANGE', KEYS[i], 0, count - 1)
+        else
+            replies[#replies + 1] = redis.call('GET', KEYS[i])
+        end
+    end
+    return replies
+end
+"""
+
+
+# Reads everything an action needs from Redis in one round trip: the
+# character, whose ID comes from the session, and the keys its handler
+# declares. Locations come from the in-process world snapshot and log IDs
+# from the local ID allocator. The Redis clock is returned too, so AP
+# regeneration is worked out against the same clock the scripts below use.
+# KEYS: character hash, then the declared reads
+# ARGV: a (kind, count) pair per declared read
+register_script('load_action_state', READ_KEYS + """
+return {redis.call('TIME'), redis.call('HGETALL', KEYS[1]), read_keys(2)}
+""")
+
+
+# Reads the keys an action declares, for characters already held in memory
+# (see character_cache.py).
+# KEYS: the declared reads
+# ARGV: a (kind, count) pair per declared read
+register_script('load_reads', READ_KEYS + """
+return read_keys(1)
+""")
+
+
+# Loads the character at character_key with its AP regenerated up to the
+# Redis clock (see models.regenerate_ap), into ``character``, ``now`` and
+# ``ap_updated_at``. Expects character_key, regen_interval and regen_amount to
+# be set. Calling TIME before writing needs the effect replication that is
+# the default since Redis 5.
+LOAD_CHARACTER = """
+local stored = redis.call('HMGET', character_key,
+    'id', 'ap', 'max_ap', 'health', 'max_health', 'mp', 'max_mp', 'inside_building', 'ap_updated_at',
+    'x', 'y')
+if not stored[1] then
+    return {0, 'Character not found'}
+end
+
+local character = {
+    id = tonumber(stored[1]),
+    ap = tonumber(stored[2]) or 0,
+    max_ap = tonumber(stored[3]) or 0,
+    health = tonumber(stored[4]) or 0,
+    max_health = tonumber(stored[5]) or 0,
+    mp = tonumber(stored[6]) or 0,
+    max_mp = tonumber(stored[7]) or 0,
+    inside_building = tonumber(stored[8]) or 0,
+    x = tonumber(stored[10]) or 0,
+    y = tonumber(stored[11]) or 0
+}
+
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) * 1000 + math.floor(tonumber(clock[2]) / 1000)
+local ap_updated_at = tonumber(stored[9]) or 0
+if ap_updated_at == 0 then
+    ap_updated_at = now
+end
+if character.ap < character.max_ap then
+    local ticks = math.floor(math.max(0, now - ap_updated_at) / regen_interval)
+    character.ap = math.min(character.max_ap, character.ap + ticks * regen_amount)
+    ap_updated_at = ap_updated_at + ticks * regen_interval
+end
+if character.ap >= character.max_ap then
+    ap_updated_at = now
+end
+"""
+
+
+# Shared prologue for actions that spend AP. It checks and deducts AP against
+# the stored value, so concurrent requests cannot spend the same AP twice.
+#
+# KEYS: character hash, action log sorted set, event stream, tile index
+#       sets outside and inside the building at the loaded position
+# ARGV: AP cost, log ID, created_at, log score, log limit, message,
+#       log entry, message when AP is short, action type,
+#       max log entries (0 for no count cap), oldest log score to keep,
+#       AP regeneration interval (ms), AP regained per interval,
+#       event stream length cap, x and y as loaded
+#
+# AP regenerated since ap_updated_at is added before the check. The action
+# is appended to the event stream under the field names in events.py.
+#
+# Returns {0, message} if the action was refused, {-1} if it would move the
+# character between the tile sets but the character is no longer at the
+# position they were named for, otherwise
+# {1, message, log entry, [field, value, ...] written, recent logs}.
+SPEND_AP_PROLOGUE = """
+local character_key, log_key = KEYS[1], KEYS[2]
+local cost = tonumber(ARGV[1])
+local created_at, score = ARGV[3], ARGV[4]
+local log_limit = tonumber(ARGV[5])
+local message, log_entry = ARGV[6], ARGV[7]
+local denied_message, action_type = ARGV[8], ARGV[9]
+local log_max_entries, log_min_score = tonumber(ARGV[10]), ARGV[11]
+local regen_interval, regen_amount = tonumber(ARGV[12]), tonumber(ARGV[13])
+local event_key, event_maxlen = KEYS[3], ARGV[14]
+local loaded_x, loaded_y = tonumber(ARGV[15]), tonumber(ARGV[16])
+""" + LOAD_CHARACTER + """
+if character.ap < cost then
+    return {0, denied_message}
+end
+
+local function commit(updates)
+    local changes_side = updates.inside_building ~= nil and updates.inside_building ~= character.inside_building
+    if changes_side and (character.x ~= loaded_x or character.y ~= loaded_y) then
+        return {-1}
+    end
+
+    updates.ap = math.min(character.ap - cost, character.max_ap)
+    updates.ap_updated_at = ap_updated_at
+
+    local fields = {}
+    for field, value in pairs(updates) do
+        fields[#fields + 1] = field
+        fields[#fields + 1] = tostring(value)
+    end
+    redis.call('HSET', character_key, unpack(fields))
+
+    -- Keep the tile index in step when the character enters or leaves a building
+    if changes_side then
+        redis.call('ZREM', KEYS[4 + character.inside_building], character.id)
+        redis.call('ZADD', KEYS[4 + updates.inside_building], character.id, character.id)
+    end
+
+    -- cjson formats numbers to 14 digits, which would round snowflake IDs,
+    -- so the IDs are spliced into the entry as given
+    local log_fields = cjson.encode({action_type = action_type, message = log_entry, created_at = created_at})
+    redis.call('ZADD', log_key, score,
+        '{"id":' .. ARGV[2] .. ',"character_id":' .. stored[1] .. ',' .. string.sub(log_fields, 2))
+    if log_max_entries > 0 then
+        redis.call('ZREMRANGEBYRANK', log_key, 0, -(log_max_entries + 1))
+    end
+    redis.call('ZREMRANGEBYSCORE', log_key, '-inf', '(' .. log_min_score)
+
+    -- IDs go as given: a large number would be formatted as a float
+    redis.call('XADD', event_key, 'MAXLEN', '~', event_maxlen, '*',
+        'c', stored[1], 'a', action_type, 'l', ARGV[2], 'k', ARGV[1],
+        'x', character.x, 'y', character.y, 'b', updates.inside_building or character.inside_building)
+
+    return {1, message, log_entry, fields, redis.call('ZREVRANGE', log_key, 0, log_limit - 1)}
+end
+"""
+
+register_script('enter_building', SPEND_AP_PROLOGUE + """
+return commit({inside_building = 1})
+""")
+
+register_script('exit_building', SPEND_AP_PROLOGUE + """
+if character.inside_building ~= 1 then
+    return {0, 'Not inside a building'}
+end
+return commit({inside_building = 0})
+""")
+
+register_script('rest', SPEND_AP_PROLOGUE + """
+local hp_recovery = math.min(10, character.max_health - character.health)
+local mp_recovery = math.min(10, character.max_mp - character.mp)
+message = string.format('Rested and recovered %d HP and %d MP', hp_recovery, mp_recovery)
+log_entry = message
+return commit({
+    health = math.min(character.health + hp_recovery, character.max_health),
+    mp = math.min(character.mp + mp_recovery, character.max_mp)
+})
+""")
+
+register_script('search', SPEND_AP_PROLOGUE + """
+return commit({})
+""")
+
+
+# Writes the net effect of a batch of actions worked out in memory (see
+# game_logic.process_actions), provided the character is as the batch found
+# it: same position, health and MP, and enough AP, regenerated to now, for
+# the batch's total cost. Otherwise nothing is written and the caller runs
+# the actions one at a time.
+#
+# KEYS: character hash, action log sorted set, tile index set left and set
+#       entered (both empty when the batch ends on the tile it started on),
+#       event stream
+# ARGV: AP cost, log limit, max log entries (0 for no count cap), oldest log score to keep,
+#       AP regeneration interval (ms), AP regained per interval,
+#       x, y, inside_building, health and mp as loaded,
+#       event stream length cap, JSON list of each event's [field, value, ...],
+#       number of fields updated, then field, value pairs,
+#       then log score, log entry pairs
+#
+# Returns {0} if the character changed, otherwise
+# {1, [field, value, ...] of the AP written, recent logs}.
+register_script('commit_batch', """
+local character_key, log_key = KEYS[1], KEYS[2]
+local cost, log_limit = tonumber(ARGV[1]), tonumber(ARGV[2])
+local log_max_entries, log_min_score = tonumber(ARGV[3]), ARGV[4]
+local regen_interval, regen_amount = tonumber(ARGV[5]), tonumber(ARGV[6])
+""" + LOAD_CHARACTER + """
+if character.x ~= tonumber(ARGV[7]) or character.y ~= tonumber(ARGV[8])
+        or character.inside_building ~= tonumber(ARGV[9])
+        or character.health ~= tonumber(ARGV[10]) or character.mp ~= tonumber(ARGV[11])
+        or character.ap < cost then
+    return {0}
+end
+
+local ap_fields = {'ap', tostring(math.min(character.ap - cost, character.max_ap)),
+                   'ap_updated_at', tostring(ap_updated_at)}
+local fields = {unpack(ap_fields)}
+local i = 15
+for _ = 1, tonumber(ARGV[14]) do
+    fields[#fields + 1] = ARGV[i]
+    fields[#fields + 1] = ARGV[i + 1]
+    i = i + 2
+end
+redis.call('HSET', character_key, unpack(fields))
+
+if KEYS[3] ~= '' then
+    redis.call('ZREM', KEYS[3], character.id)
+    redis.call('ZADD', KEYS[4], character.id, character.id)
+end
+
+while i < #ARGV do
+    redis.call('ZADD', log_key, ARGV[i], ARGV[i + 1])
+    i = i + 2
+end
+if log_max_entries > 0 then
+    redis.call('ZREMRANGEBYRANK', log_key, 0, -(log_max_entries + 1))
+end
+redis.call('ZREMRANGEBYSCORE', log_key, '-inf', '(' .. log_min_score)
+
+for _, event in ipairs(cjson.decode(ARGV[13])) do
+    redis.call('XADD', KEYS[5], 'MAXLEN', '~', ARGV[12], '*', unpack(event))
+end
+
+return {1, ap_fields, redis.call('ZREVRANGE', log_key, 0, log_limit - 1)}
+""")
+
+
+# Writes the results of an action that spends no AP (see
+# models.commit_action). A move is applied to the hash and the tile index
+# together, and only if the character is still where it was loaded, so a
+# move racing another write to the position cannot leave the character
+# indexed on a tile it has left; the caller loads and decides again.
+#
+# KEYS: character hash, action log sorted set, tile index set left and set
+#       entered (both empty when the action does not change tile),
+#       event stream
+# ARGV: log limit, max log entries (0 for no count cap), oldest log score to keep,
+#       log score, log entry ('' for none), event stream length cap,
+#       event's [field, value, ...] as JSON ('' for none),
+#       x, y and inside_building as loaded, then field, value pairs
+#
+# Returns {0} if the action moves the character but the character has moved
+# since it was loaded, otherwise {1, recent logs}.
+register_script('commit_action', """
+local character_key, log_key = KEYS[1], KEYS[2]
+local log_limit, log_max_entries, log_min_score = tonumber(ARGV[1]), tonumber(ARGV[2]), ARGV[3]
+
+if KEYS[3] ~= '' then
+    local stored = redis.call('HMGET', character_key, 'id', 'x', 'y', 'inside_building')
+    if not stored[1] or tonumber(stored[2]) ~= tonumber(ARGV[8]) or tonumber(stored[3]) ~= tonumber(ARGV[9])
+            or (tonumber(stored[4]) or 0) ~= tonumber(ARGV[10]) then
+        return {0}
+    end
+    redis.call('ZREM', KEYS[3], stored[1])
+    redis.call('ZADD', KEYS[4], stored[1], stored[1])
+end
+if #ARGV > 10 then
+    redis.call('HSET', character_key, unpack(ARGV, 11))
+end
+
+if ARGV[5] ~= '' then
+    redis.call('ZADD', log_key, ARGV[4], ARGV[5])
+    if log_max_entries > 0 then
+        redis.call('ZREMRANGEBYRANK', log_key, 0, -(log_max_entries + 1))
+    end
+    redis.call('ZREMRANGEBYSCORE', log_key, '-inf', '(' .. log_min_score)
+end
+
+if ARGV[7] ~= '' then
+    redis.call('XADD', KEYS[5], 'MAXLEN', '~', ARGV[6], '*', unpack(cjson.decode(ARGV[7])))
+end
+
+return {1, redis.call('ZREVRANGE', log_key, 0, log_limit - 1)}
+""")
@@ -0,0 +1,144 @@
+"""JSON encoding for HTTP responses, Socket.IO packets and stored log entries.
+
+orjson 3.9 or later (for orjson.Fragment) is used when it is installed, and
+the standard library otherwise; JSON_BACKEND=json forces the standard
+library. Values that are already encoded are wrapped in RawJSON and spliced
+into the output as-is, wherever they appear: the action menus are encoded
+once at import, and action log entries are kept as the JSON text they were
+stored as.
+"""
+import hashlib
+import json
+import os
+from functools import cached_property
+
+from flask import Response
+
+import metrics
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Embedding RawJSON needs orjson.Fragment, new in orjson 3.9
+if orjson is not None and not hasattr(orjson, 'Fragment'):
+    orjson = None
+
+JSON_BACKEND = os.environ.get('JSON_BACKEND', 'orjson') if orjson else 'json'
+
+
+class RawJSON(str):
+    """JSON text that is already encoded and is embedded in output as-is.
+
+    ``encoded`` holds the same text as UTF-8 bytes, ready for HTTP responses,
+    and ``etag`` a hash of them for conditional GETs.
+    """
+
+    @cached_property
+    def encoded(self):
+        return self.encode('utf-8')
+
+    @cached_property
+    def etag(self):
+        return hashlib.blake2b(self.encoded, digest_size=8).hexdigest()
+
+
+if JSON_BACKEND == 'orjson':
+    _OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_SUBCLASS
+    _BASE_TYPES = (dict, list, tuple, int, float, str)
+
+    def _dumps_bytes(obj):
+        def default(value):
+            if isinstance(value, RawJSON):
+                return orjson.Fragment(value.encoded)
+            return _base_value(value)
+        return orjson.dumps(obj, default=default, option=_OPTIONS)
+
+    def _base_value(value):
+        # OPT_PASSTHROUGH_SUBCLASS hands every subclass to default, not just RawJSON
+        for base in _BASE_TYPES:
+            if isinstance(value, base):
+                return base(value)
+        raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+    def dumps_text(obj):
+        """Encode an object as compact JSON text."""
+        return _dumps_bytes(obj).decode('utf-8')
+
+    def loads(s, **kwargs):
+        """Decode JSON text."""
+        # orjson only takes exact str, not subclasses such as RawJSON
+        return orjson.loads(s.encoded if isinstance(s, RawJSON) else s)
+else:
+    _encoder = json.JSONEncoder(separators=(',', ':'))
+
+    def _dumps_bytes(obj):
+        return dumps_text(obj).encode('utf-8')
+
+    def dumps_text(obj):
+        """Encode an object as compact JSON text."""
+        return ''.join(_iter_encode(obj))
+
+    def _iter_encode(obj):
+        # The standard library encodes str subclasses as strings, so walk
+        # down to the containers holding RawJSON and encode the rest whole
+        if isinstance(obj, RawJSON):
+            yield obj
+        elif not _has_raw(obj):
+            yield _encoder.encode(obj)
+        elif isinstance(obj, dict):
+            yield '{'
+            for i, (key, value) in enumerate(obj.items()):
+                yield (',' if i else '') + _encoder.encode(str(key)) + ':'
+                yield from _iter_encode(value)
+            yield '}'
+        else:
+            yield '['
+            for i, item in enumerate(obj):
+                if i:
+                    yield ','
+                yield from _iter_encode(item)
+            yield ']'
+
+    def _has_raw(obj):
+        if isinstance(obj, RawJSON):
+            return True
+        if isinstance(obj, dict):
+            return any(_has_raw(value) for value in obj.values())
+        if isinstance(obj, (list, tuple)):
+            return any(_has_raw(item) for item in obj)
+        return False
+
+    def loads(s, **kwargs):
+        """Decode JSON text."""
+        return json.loads(s, **kwargs)
+
+
+def encode(obj):
+    """Encode an object as compact JSON, wrapped so it is not encoded again."""
+    return RawJSON(dumps_text(obj))
+
+
+def raw_list(items):
+    """Join already-encoded JSON values into one RawJSON array, without parsing them."""
+    return RawJSON('[' + ','.join(items) + ']')
+
+
+def jsonify(obj):
+    """flask.jsonify through the fast encoder, splicing in RawJSON values."""
+    return Response(_dumps_bytes(obj), mimetype='application/json')
+
+
+def dumps(obj, **kwargs):
+    """Encode a Socket.IO packet, splicing RawJSON values in without re-encoding them.
+
+    Packets are encoded once per recipient, so the encoded size is counted
+    per event as the bytes emitted.
+    """
+    text = dumps_text(obj)
+
+    event = obj[0] if isinstance(obj, list) and obj and isinstance(obj[0], str) else 'other'
+    metrics.inc('socketio_emits_total', event=event)
+    metrics.inc('socketio_emit_bytes_total', len(text), event=event)
+    return text
@@ -1,33 +1,149 @@
-from flask_socketio import SocketIO, emit, join_room, leave_room
+import os
+
+from flask_socketio import SocketIO, emit, join_room, leave_room, rooms
 from flask import request, session
-import json
-from game_logic import process_action
-from models import get_character_by_user_id, get_action_logs
+import action_queue
+import ap_regen
+import metrics
+import presence
+from auth import check_rate_limit, session_valid, current_character_id
+import serializer
+from concurrency import ASYNC_MODE
+from database import get_db, redis_url
+from spatial import tile_room
+from game_logic import process_actions, get_available_actions_json
+from character_cache import get_character, get_position
+from models import get_action_logs
+from world_data import get_location_info
 
 # Create SocketIO instance - use simpler configuration
-# We'll initialize it later with the app
-socketio = SocketIO(cors_allowed_origins="*", async_mode='threading')
+# We'll initialize it later with the app. The async mode comes from
+# SOCKETIO_ASYNC_MODE (see concurrency.py). The serializer module lets emits
+# carry pre-encoded RawJSON payloads without encoding them again.
+#
+# With SOCKETIO_MULTI_NODE=1 every worker shares the Redis server as the
+# Socket.IO message queue, so an emit to a room reaches its sockets on all
+# workers. Run the workers behind a load balancer with sticky sessions.
+MULTI_NODE = os.environ.get('SOCKETIO_MULTI_NODE', '0') == '1'
+SOCKETIO_CHANNEL = os.environ.get('SOCKETIO_CHANNEL', 'flask-socketio')
+
+socketio = SocketIO(cors_allowed_origins="*", async_mode=ASYNC_MODE, json=serializer)
+
+def init_socketio(app):
+    """Initialize Socket.IO with the app, through the Redis queue in multi-node mode."""
+    if MULTI_NODE:
+        socketio.init_app(app, message_queue=redis_url(), channel=SOCKETIO_CHANNEL)
+    else:
+        socketio.init_app(app)
+
+
+# Last state this worker sent to each user room, used to send only what
+# changed. Socket membership itself lives in Redis (see presence.py).
+room_states = {}
+
+
+def remember_state(room, character, location, actions, logs, seq=None):
+    """Record the state a room's sockets have been sent."""
+    room_states[room] = {
+        'character': dict(character),
+        'location': location,
+        'actions': actions,
+        'logs': set(logs),
+        'seq': seq
+    }
+
+
+def current_state_seq(user_id):
+    """The number of patches sent to a user room by any worker."""
+    if not MULTI_NODE:
+        return None
+    return int(get_db().get(f'state_seq:{user_id}') or 0)
+
+
+def patch_baseline(user_id, room):
+    """The state to diff a new patch against, and the patch's sequence number.
+
+    In multi-node mode another worker may have sent patches to the room since
+    this worker last did, leaving its baseline stale. Patches are numbered per
+    user in Redis; if any were missed the baseline is dropped and the full
+    state is sent instead.
+    """
+    previous = room_states.get(room, {})
+    if not MULTI_NODE:
+        return previous, None
+
+    seq = get_db().incr(f'state_seq:{user_id}')
+    if previous.get('seq') != seq - 1:
+        previous = {}
+    return previous, seq
+
+
+def build_state_patch(previous, character, location, actions, logs):
+    """Build a patch holding only what differs from the state last sent.
 
-# Active user rooms mapping
-user_rooms = {}
+    Character fields are sent individually, location and actions whole when
+    they change, and logs only for entries the room has not seen. Every part
+    of a patch sets values, so applying one twice is harmless.
+    """
+    patch = {}
+
+    sent_character = previous.get('character', {})
+    changed = {key: value for key, value in character.items() if sent_character.get(key) != value}
+    if changed:
+        patch['character'] = changed
+
+    if location != previous.get('location'):
+        patch['location'] = location
+
+    # Action menus are shared, pre-encoded objects, so identity means unchanged
+    if actions is not previous.get('actions'):
+        patch['actions'] = actions
+
+    # Log entries are the JSON text they were stored as, unique per entry
+    sent_logs = previous.get('logs', set())
+    new_logs = [log for log in logs if log not in sent_logs]
+    if new_logs:
+        patch['logs'] = new_logs
+
+    return patch
 
 
 @socketio.on('connect')
-def handle_connect():
+@metrics.timed('socketio_event_duration_seconds', event='connect')
+def handle_connect(auth=None):
     """Handle client connection"""
+    if 'user_id' in session and not session_valid():
+        return False  # The session token was revoked; refuse the connection
+
+    metrics.add_gauge('socketio_connections', 1)
     if 'user_id' in session:
         user_id = session['user_id']
         # Join a room specific to this user
         join_room(f'user_{user_id}')
-        user_rooms[request.sid] = f'user_{user_id}'
+        presence.join(request.sid, user_id)
 
         # Send initial data
-        character = get_character_by_user_id(user_id)
+        character = get_character(current_character_id())
+
+        # Hear others arrive at and leave the character's tile
+        join_room(tile_room(character['x'], character['y'], character['inside_building']))
         emit('character_update', character)
 
+        # Location and actions come from in-process tables
+        location = get_location_info(character['x'], character['y'], character['inside_building'])
+        emit('location_update', location)
+        actions = get_available_actions_json(character['x'], character['y'], character['inside_building'])
+        emit('actions_update', actions)
+
         # Fetch recent logs
         logs = get_action_logs(character['id'])
-        emit('logs_update', logs)
+        emit('logs_update', serializer.raw_list(logs))
+
+        # Later updates to this room are patches against this state
+        remember_state(f'user_{user_id}', character, location, actions, logs, current_state_seq(user_id))
+
+        # Push AP to this player as it regenerates
+        ap_regen.schedule(character)
 
         print(f"User {user_id} connected with socket ID {request.sid}")
     else:
@@ -35,57 +151,167 @@ def handle_connect():
 
 
 @socketio.on('disconnect')
+@metrics.timed('socketio_event_duration_seconds', event='disconnect')
 def handle_disconnect():
     """Handle client disconnection"""
-    sid = request.sid
-    if sid in user_rooms:
-        room = user_rooms[sid]
-        leave_room(room)
-        del user_rooms[sid]
+    metrics.add_gauge('socketio_connections', -1)
+    if 'user_id' in session:
+        # Rooms are left automatically; only presence needs updating
+        user_id = session['user_id']
+        room = f'user_{user_id}'
+        if presence.leave(request.sid, user_id) == 0:
+            state = room_states.pop(room, None)
+            if state:
+                ap_regen.unschedule(state['character']['id'], user_id)
         print(f"User in room {room} disconnected")
 
 
 @socketio.on('perform_action')
+@metrics.timed('socketio_event_duration_seconds', event='perform_action')
 def handle_action(data):
-    """Handle game actions via WebSocket"""
-    if 'user_id' not in session:
+    """Handle game actions via WebSocket.
+
+    Sending PROFILE_TOKEN as ``profile`` runs the sampling profiler over the
+    action (see metrics.py).
+    """
+    if metrics.profile_requested(data.get('profile')):
+        profile = metrics.start_profile()
+        try:
+            return _handle_action(data)
+        finally:
+            metrics.finish_profile(f"perform_action {data.get('action_type')}", profile)
+    return _handle_action(data)
+
+
+def _handle_action(data):
+    if not session_valid():
         emit('error', {'message': 'Not authenticated'})
         return
 
+    if not isinstance(data, dict):
+        emit('error', {'message': 'Invalid request'})
+        return
+
     user_id = session['user_id']
     action_type = data.get('action_type')
-    action_data = data.get('action_data', {})
+    action_data = data.get('action_data')
 
     if not action_type:
         emit('error', {'message': 'Action type is required'})
         return
+    if not isinstance(action_type, str):
+        emit('error', {'message': 'Invalid action type'})
+        return
+    if action_data is not None and not isinstance(action_data, dict):
+        emit('error', {'message': 'Invalid action data'})
+        return
 
-    # Process the action
-    result = process_action(user_id, action_type, action_data)
+    allowed, retry_after = check_rate_limit(user_id, action_type)
+    if not allowed:
+        emit('error', {'message': 'Rate limit exceeded', 'retry_after': retry_after})
+        return
 
-    # Emit updates to the user
-    if result.get('success', False):
-        room = f'user_{user_id}'
+    # Queue the action; if no other handler is draining this character's
+    # queue, drain it here, batching whatever arrives in the meantime
+    character_id = current_character_id()
+    if action_queue.enqueue(character_id, (action_type, action_data, request.sid)):
+        action_queue.drain(character_id, lambda batch: run_action_batch(user_id, character_id, batch))
 
-        # Character update
-        if 'character' in result:
-            emit('character_update', result['character'], room=room)
 
-        # Location update
-        if 'location' in result:
-            emit('location_update', result['location'], room=room)
+def run_action_batch(user_id, character_id, batch):
+    """Process queued (action type, action data, sid) entries and push one patch.
 
-        # Actions update
-        if 'available_actions' in result:
-            emit('actions_update', result['available_actions'], room=room)
+    Errors go back to the socket that sent the failed action.
+    """
+    actions = [(action_type, action_data) for action_type, action_data, _ in batch]
+    results, final = process_actions(character_id, actions)
 
-        # Logs update
-        if 'logs' in result:
-            emit('logs_update', result['logs'], room=room)
+    for (_, _, sid), result in zip(batch, results):
+        if not result['success']:
+            socketio.emit('error', {'message': result.get('message') or 'Action failed'}, to=sid)
 
-        # Message
-        if 'message' in result:
-            emit('message', {'text': result['message']}, room=room)
-    else:
-        # Error handling
-        emit('error', {'message': result.get('message', 'Action failed')})
\ No newline at end of file
+    if final is not None:
+        push_state_patch(user_id, final)
+        announce_move(final, skip_sid=batch[-1][2])
+
+
+def push_state_patch(user_id, result):
+    """Emit one patch with what changed since the last state sent to the user.
+
+    The emit goes through the message queue in multi-node mode, so it reaches
+    every socket the user has open, whichever worker ran the action.
+    """
+    room = f'user_{user_id}'
+    character = result['character']
+    actions = get_available_actions_json(character['x'], character['y'], character['inside_building'])
+
+    previous, seq = patch_baseline(user_id, room)
+    patch = build_state_patch(previous, character, result['location'], actions, result['logs'])
+    patch['message'] = result.get('message', '')
+    socketio.emit('state_patch', patch, to=room)
+
+    remember_state(room, character, result['location'], actions, result['logs'], seq)
+
+    # Spending AP moves when the player next regains it
+    if 'ap' in patch.get('character', {}):
+        ap_regen.schedule(character)
+
+
+def push_character_update(user_id, fields):
+    """Send changed character fields to a user's sockets outside of an action.
+
+    Used for AP regeneration. The fields are folded into this worker's
+    baseline; in multi-node mode the patch is numbered like an action's, so
+    workers that did not send it send full state next time.
+    """
+    room = f'user_{user_id}'
+    state = room_states.get(room)
+
+    if MULTI_NODE:
+        seq = get_db().incr(f'state_seq:{user_id}')
+        if state and state['seq'] == seq - 1:
+            state['character'].update(fields)
+            state['seq'] = seq
+    elif state:
+        state['character'].update(fields)
+
+    socketio.emit('state_patch', {'character': fields}, to=room)
+
+
+@socketio.on('watch_tile')
+@metrics.timed('socketio_event_duration_seconds', event='watch_tile')
+def handle_watch_tile():
+    """Move this socket to the tile room of the character's current position.
+
+    Clients send this after a patch changes their position, so each of a
+    player's sockets follows the character, on whichever worker it is open.
+    """
+    if not session_valid():
+        return
+
+    position = get_position(current_character_id())
+    if position is None:
+        return
+
+    room = tile_room(*position)
+    for joined in rooms():
+        if joined.startswith('tile_') and joined != room:
+            leave_room(joined)
+    join_room(room)
+
+
+def announce_move(result, skip_sid=None):
+    """Tell the players on the tiles an action moved a character between."""
+    previous_tile = result.get('previous_tile')
+    if not previous_tile:
+        return
+
+    character = result['character']
+    occupant = {'id': character['id'], 'name': character['name']}
+    socketio.emit('occupant_left', occupant, to=tile_room(**previous_tile), skip_sid=skip_sid)
+    socketio.emit(
+        'occupant_entered',
+        occupant,
+        to=tile_room(character['x'], character['y'], character['inside_building']),
+        skip_sid=skip_sid
+    )
@@ -0,0 +1,110 @@
+"""Spatial index of the characters on each tile.
+
+Usage (to index characters created before the index existed):
+    python spatial.py --rebuild
+
+Each side of a tile (outside, or inside its building) has a sorted set
+tile:{x}:{y}:{inside} of character IDs, scored by ID. Occupants page in ID
+order from a cursor, so a page of k costs O(log n + k) whatever the world's
+population. Every write that changes a character's position updates the
+index in the same transaction or script.
+"""
+import argparse
+
+from codec import CHARACTERS
+from database import get_db
+
+OCCUPANT_PAGE_MAX = 100
+BATCH_SIZE = 500
+
+
+def tile_key(x, y, inside_building):
+    """The index key for one side of a tile."""
+    return f'tile:{int(x)}:{int(y)}:{1 if inside_building else 0}'
+
+
+def tile_room(x, y, inside_building):
+    """The Socket.IO room for the sockets of players on one side of a tile."""
+    return f'tile_{int(x)}_{int(y)}_{1 if inside_building else 0}'
+
+
+def get_tile_occupants(x, y, inside_building, after=None, limit=20):
+    """Page through the characters on one side of a tile, in ID order.
+
+    Pass the previous page's ``next_after`` as ``after`` for the next page.
+    Takes two round trips: the page of IDs with the count, then their names.
+    """
+    db = get_db()
+
+    limit = max(1, min(limit, OCCUPANT_PAGE_MAX))
+    lowest = f'({int(after)}' if after is not None else '-inf'
+    key = tile_key(x, y, inside_building)
+
+    pipe = db.pipeline(transaction=False)
+    pipe.zcard(key)
+    pipe.zrangebyscore(key, lowest, '+inf', start=0, num=limit)
+    count, ids = pipe.execute()
+
+    pipe = db.pipeline(transaction=False)
+    for id in ids:
+        pipe.hget(f'character:{id}', 'name')
+    names = pipe.execute() if ids else []
+    characters = [{'id': int(id), 'name': name or ''} for id, name in zip(ids, names)]
+
+    return {
+        'characters': characters,
+        'count': count,
+        'next_after': characters[-1]['id'] if len(characters) == limit else None
+    }
+
+
+def rebuild_tile_index(db):
+    """Rebuild every tile set from the character hashes; returns how many were indexed."""
+    indexed = 0
+
+    for batch in _batches(db.scan_iter(match='tile:*', count=BATCH_SIZE)):
+        db.delete(*batch)
+
+    for batch in _batches(db.scan_iter(match='character:*', count=BATCH_SIZE, _type='hash')):
+        read = db.pipeline(transaction=False)
+        for key in batch:
+            read.hmget(key, 'id', 'x', 'y', 'inside_building')
+        positions = read.execute()
+
+        write = db.pipeline(transaction=False)
+        for values in positions:
+            character = CHARACTERS.decode(dict(zip(('id', 'x', 'y', 'inside_building'), values)))
+            if not character['id']:
+                continue
+            key = tile_key(character['x'], character['y'], character['inside_building'])
+            write.zadd(key, {character['id']: character['id']})
+            indexed += 1
+        write.execute()
+
+    return indexed
+
+
+def _batches(keys):
+    batch = []
+    for key in keys:
+        batch.append(key)
+        if len(batch) == BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintain the tile occupancy index.')
+    parser.add_argument('--rebuild', action='store_true', help='rebuild the index from the character hashes')
+    args = parser.parse_args()
+
+    if args.rebuild:
+        print(f'Indexed {rebuild_tile_index(get_db())} characters')
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
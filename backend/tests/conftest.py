@@ -0,0 +1,57 @@
+"""Fixtures for the backend tests, which run against an in-process fake Redis.
+
+The fake needs the fakeredis and lupa packages (see benchmarks/requirements.txt).
+"""
+import os
+import sys
+
+# Hash passwords in the calling thread: spawned workers would re-import pytest
+os.environ.setdefault('PASSWORD_HASH_WORKERS', '0')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fakeredis
+import pytest
+
+import database
+from scripts import load_scripts
+
+_server = fakeredis.FakeServer()
+_create_pool = database.create_pool
+
+
+def _create_fake_pool(**overrides):
+    return _create_pool(connection_class=fakeredis.FakeConnection, server=_server, **overrides)
+
+
+database.create_pool = _create_fake_pool
+
+
+@pytest.fixture
+def db():
+    """The shared Redis client, emptied and with the scripts loaded."""
+    client = database.get_db()
+    client.flushall()
+    load_scripts(client)
+    return client
+
+
+@pytest.fixture
+def character_id(db):
+    """A freshly signed-up character, standing outside at (1, 1)."""
+    from models import create_user
+
+    _, character_id = create_user('tester', 'unused', 'Tester')
+    return character_id
+
+
+@pytest.fixture
+def client(db, character_id):
+    """A test client signed in as the character's user."""
+    from app import app
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session.update(user_id=int(db.hget(f'character:{character_id}', 'user_id')), character_id=character_id,
+                       token_id='token')
+    return client
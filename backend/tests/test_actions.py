@@ -0,0 +1,63 @@
+import pytest
+
+import actions
+import game_logic
+from actions import Action, succeed
+from models import load_action_state
+from serializer import loads
+
+
+@pytest.mark.parametrize('action_type', [['MOVE'], {'type': 'MOVE'}, 7, None])
+def test_process_action_rejects_non_string_action_type(character_id, action_type):
+    result = game_logic.process_action(character_id, action_type, {'direction': 'north'})
+
+    assert result == {'success': False, 'message': 'Invalid action type'}
+
+
+@pytest.mark.parametrize('action_data', [['north'], 'north', 3])
+def test_process_action_rejects_non_dict_action_data(character_id, action_data):
+    result = game_logic.process_action(character_id, 'MOVE', action_data)
+
+    assert result == {'success': False, 'message': 'Invalid action data'}
+
+
+def test_batch_rejects_invalid_actions_one_by_one(character_id):
+    results, final = game_logic.process_actions(character_id, [
+        (['MOVE'], {}),
+        ('MOVE', ['north']),
+        ('MOVE', {'direction': 'north'})
+    ])
+
+    assert [result['message'] for result in results[:2]] == ['Invalid action type', 'Invalid action data']
+    assert results[2]['success']
+    assert final['character']['y'] == 0
+
+
+class ReadsLogs(Action):
+    type = 'READ_LOGS'
+    reads = ('recent_logs',)
+
+    def run(self, character, location, data, reads):
+        return succeed(f"{len(reads['recent_logs'])} entries")
+
+
+def test_declared_reads_are_fetched_with_the_character(character_id, monkeypatch):
+    monkeypatch.setitem(actions.ACTIONS, ReadsLogs.type, ReadsLogs())
+
+    state = load_action_state(character_id, ReadsLogs.reads)
+    assert [loads(entry)['action_type'] for entry in state['reads']['recent_logs']] == ['SIGNUP']
+
+    result = game_logic.process_action(character_id, ReadsLogs.type)
+    assert result['message'] == '1 entries'
+
+
+@pytest.mark.parametrize('body, message', [
+    ({'action_type': ['MOVE']}, 'Invalid action type'),
+    ({'action_type': 'MOVE', 'action_data': ['north']}, 'Invalid action data'),
+    (['MOVE'], 'Invalid request')
+])
+def test_action_endpoint_rejects_malformed_input(client, body, message):
+    response = client.post('/api/action', json=body)
+
+    assert response.status_code == 400
+    assert response.get_json()['message'] == message
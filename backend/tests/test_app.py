@@ -0,0 +1,16 @@
+import pytest
+
+
+@pytest.mark.parametrize('before', ['nan', 'inf', '-inf'])
+def test_logs_reject_a_non_finite_cursor(client, before):
+    response = client.get(f'/api/logs?before={before}')
+
+    assert response.status_code == 400
+
+
+def test_logs_page_from_a_cursor(client):
+    first = client.get('/api/logs?limit=1').get_json()
+    assert [entry['action_type'] for entry in first['logs']] == ['SIGNUP']
+
+    older = client.get(f"/api/logs?before={first['next_before']}").get_json()
+    assert older == {'logs': [], 'next_before': None}
@@ -0,0 +1,60 @@
+import time
+
+import pytest
+
+import auth
+
+
+@pytest.fixture
+def revocations(db, monkeypatch):
+    """Fresh revocation state, read again on every check."""
+    monkeypatch.setattr(auth, '_revoked', {})
+    monkeypatch.setattr(auth, '_revoked_read_to', '0-0')
+    monkeypatch.setattr(auth, '_revoked_loaded_at', 0.0)
+    monkeypatch.setattr(auth, 'AUTH_REVOCATION_REFRESH', 0)
+    return db
+
+
+def revoke_elsewhere(db, token_id, expires_at):
+    """Revoke a token the way another worker's logout does; returns the entry ID."""
+    return db.xadd(auth.REVOCATIONS, {'t': token_id, 'e': int(expires_at)})
+
+
+def test_revocations_are_read_as_deltas(revocations):
+    first = revoke_elsewhere(revocations, 'first', time.time() + 60)
+    assert 'first' in auth._revoked_tokens()
+    assert auth._revoked_read_to == first
+
+    # Only entries after the last one read come back; the earlier ones are kept locally
+    revocations.xdel(auth.REVOCATIONS, first)
+    second = revoke_elsewhere(revocations, 'second', time.time() + 60)
+
+    assert set(auth._revoked_tokens()) == {'first', 'second'}
+    assert auth._revoked_read_to == second
+
+
+def test_expired_revocations_are_forgotten(revocations):
+    revoke_elsewhere(revocations, 'expired', time.time() - 1)
+    revoke_elsewhere(revocations, 'current', time.time() + 60)
+
+    assert set(auth._revoked_tokens()) == {'current'}
+
+
+def test_logout_revokes_the_session_everywhere(client, revocations):
+    assert client.get('/api/logs').status_code == 200
+
+    with client.session_transaction() as session:
+        saved = dict(session)
+    client.get('/logout')
+    with client.session_transaction() as session:
+        session.update(saved)
+
+    assert client.get('/api/logs', headers={'Accept': 'application/json'}).status_code == 401
+    assert revocations.xlen(auth.REVOCATIONS) == 1
+
+
+def test_sessions_without_a_token_id_are_invalid(client):
+    with client.session_transaction() as session:
+        del session['token_id']
+
+    assert client.get('/api/logs', headers={'Accept': 'application/json'}).status_code == 401
@@ -0,0 +1,84 @@
+import pytest
+
+import ap_regen
+import character_cache
+import game_logic
+from character_cache import CHARACTER_LEASE_TTL
+
+
+@pytest.fixture
+def cache(db, monkeypatch):
+    """The character cache, enabled and empty."""
+    monkeypatch.setattr(character_cache, 'ENABLED', True)
+    monkeypatch.setattr(character_cache, '_cache', {})
+    monkeypatch.setattr(character_cache, '_dirty_count', 0)
+    return character_cache
+
+
+def move_north(character_id):
+    return game_logic.process_action(character_id, 'MOVE', {'direction': 'north'})
+
+
+def test_cached_actions_are_journaled_until_flushed(cache, db, character_id):
+    assert move_north(character_id)['success']
+
+    assert db.hget(f'character:{character_id}', 'y') == '1'
+    assert db.xlen(f'character_journal:{character_id}') == 1
+
+    assert cache.flush() == 1
+    assert db.hget(f'character:{character_id}', 'y') == '0'
+    assert db.xlen(f'character_journal:{character_id}') == 0
+
+
+def test_action_is_refused_once_the_lease_is_lost(cache, db, character_id):
+    assert move_north(character_id)['success']
+    entry = cache._cache[character_id]
+
+    # Another worker took the lease after it lapsed, and renewal is due
+    db.set(f'character_owner:{character_id}', 'other-node')
+    entry.renewed_at -= CHARACTER_LEASE_TTL
+
+    assert move_north(character_id) == {'success': False, 'message': game_logic.CHARACTER_BUSY}
+    assert not cache.held(character_id, entry)
+    # What was not flushed stays in the journal for the new owner
+    assert db.xlen(f'character_journal:{character_id}') == 1
+
+
+def test_flush_drops_a_character_whose_lease_was_lost(cache, db, character_id):
+    assert move_north(character_id)['success']
+    entry = cache._cache[character_id]
+
+    db.set(f'character_owner:{character_id}', 'other-node')
+
+    assert cache.flush() == 0
+    assert not cache.held(character_id, entry)
+    assert db.hget(f'character:{character_id}', 'y') == '1'
+
+
+def test_next_owner_replays_the_journal(cache, db, character_id):
+    assert move_north(character_id)['success']
+
+    # This worker dies without flushing, and its lease lapses
+    cache._cache.clear()
+    db.delete(f'character_owner:{character_id}')
+
+    entry = cache.acquire(character_id)
+    assert entry.character['y'] == 0
+    assert db.hget(f'character:{character_id}', 'y') == '0'
+    assert db.xlen(f'character_journal:{character_id}') == 0
+
+
+def test_ap_tick_reads_the_journal(cache, db, character_id):
+    result = game_logic.process_action(character_id, 'SEARCH')
+    spent = result['character']['ap']
+    stored = int(db.hget(f'character:{character_id}', 'ap'))
+    assert spent < stored
+
+    user_id = int(db.hget(f'character:{character_id}', 'user_id'))
+    db.sadd('presence:online', user_id)
+    db.zadd(ap_regen._due_key(character_id), {f'{character_id}:{user_id}': 0})
+
+    pushed = []
+    ap_regen.tick(lambda user, fields: pushed.append((user, fields['ap'])))
+
+    assert pushed == [(user_id, spent)]
@@ -0,0 +1,30 @@
+import queue
+
+import database
+from events import EventConsumer, action_event
+from models import commit_action, get_character
+
+
+def test_blocking_client_outlasts_the_block():
+    client = database.create_blocking_client(5)
+
+    assert client.connection_pool.connection_kwargs['socket_timeout'] == 5 + database.REDIS_SOCKET_TIMEOUT
+    assert client.connection_pool is not database.get_db().connection_pool
+
+
+def test_consumer_handles_committed_events(character_id):
+    handled = queue.Queue()
+    consumer = EventConsumer('tests', handled.put, block=0.1)
+    thread = consumer.start()
+
+    character = {'x': 2, 'y': 1, 'inside_building': False}
+    commit_action(get_character(character_id), event=action_event(character_id, 'MOVE', None, 1, character))
+
+    try:
+        (_, event), = handled.get(timeout=5)
+    finally:
+        consumer.stop()
+        thread.join(5)
+
+    assert event['character_id'] == character_id and event['action_type'] == 'MOVE'
+    assert not thread.is_alive()
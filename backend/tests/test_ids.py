@@ -0,0 +1,76 @@
+import pytest
+
+import ids
+from ids import MAX_WORKER_ID, NoFreeWorkerId, SnowflakeIdGenerator, WorkerIdLease
+
+
+@pytest.fixture
+def snowflake(db, monkeypatch):
+    """Snowflake action log IDs, with this process's lease taken afresh."""
+    monkeypatch.setattr(ids, 'ACTION_LOG_IDS', 'snowflake')
+    monkeypatch.delenv('WORKER_ID', raising=False)
+    monkeypatch.setattr(ids, '_action_log_ids', None)
+    monkeypatch.setattr(ids, '_worker_id_lease', None)
+    yield
+    ids._release_worker_id()
+
+
+def test_leases_hand_out_distinct_worker_ids(db):
+    first, second = WorkerIdLease('a'), WorkerIdLease('b')
+
+    assert (first.acquire(), second.acquire()) == (0, 1)
+    assert db.get('id:worker:0') == 'a' and db.get('id:worker:1') == 'b'
+
+    first.release()
+    assert db.get('id:worker:0') is None
+    assert WorkerIdLease('c').acquire() == 0
+
+
+def test_leasing_fails_when_every_worker_id_is_taken(db):
+    for worker_id in range(MAX_WORKER_ID + 1):
+        assert WorkerIdLease(f'node-{worker_id}').acquire() == worker_id
+
+    with pytest.raises(NoFreeWorkerId):
+        WorkerIdLease('one-too-many').acquire()
+
+
+def test_lost_lease_is_not_renewed_or_used(db):
+    lease = WorkerIdLease('a')
+    lease.acquire()
+    assert lease.held() and lease.renew()
+
+    db.set('id:worker:0', 'b')
+    assert not lease.renew()
+    assert not lease.held()
+    assert db.get('id:worker:0') == 'b'
+
+    lease.release()
+    assert db.get('id:worker:0') == 'b'
+
+
+def test_lost_lease_is_replaced_before_the_next_id(snowflake, db):
+    ids.next_action_log_id()
+    lease = ids._worker_id_lease
+    assert lease.worker_id == 0
+
+    # Another process took the ID after this one failed to renew in time
+    db.set('id:worker:0', 'someone-else')
+    lease.renew()
+    ids.next_action_log_id()
+
+    assert ids._worker_id_lease is not lease
+    assert ids._worker_id_lease.worker_id == 1
+    assert ids._action_log_ids.worker_id == 1
+
+
+def test_ids_stay_unique_across_worker_restarts(db):
+    seen = set()
+    # Clean exits give the worker ID back; crashed workers keep theirs until the lease lapses
+    for crashed in (False, True, False, True):
+        lease = WorkerIdLease(f'restart-{len(seen)}')
+        generator = SnowflakeIdGenerator(lease.acquire())
+        seen.update(generator.next_id() for _ in range(500))
+        if not crashed:
+            lease.release()
+
+    assert len(seen) == 2000
@@ -0,0 +1,33 @@
+import migrate_records
+from codec import CHARACTERS
+from migrate_records import migrate_batch, migrate_prefix
+
+
+def test_records_are_rewritten_in_canonical_form(db):
+    db.hset('character:1', mapping={'id': '01', 'name': 'Old', 'inside_building': 'True', 'x': '3'})
+
+    assert migrate_prefix(db, 'character', CHARACTERS, dry_run=True) == 1
+    assert db.hget('character:1', 'inside_building') == 'True'
+
+    assert migrate_prefix(db, 'character', CHARACTERS) == 1
+    stored = db.hgetall('character:1')
+    assert stored['id'] == '1' and stored['inside_building'] == '1' and stored['x'] == '3'
+    assert stored['ap'] == '0' and stored['created_at'] == ''
+
+
+def test_a_record_written_meanwhile_is_read_again(db, monkeypatch):
+    db.hset('character:1', mapping={'id': '1', 'name': 'Old', 'ap': '05'})
+    canonical = migrate_records.canonical
+    calls = []
+
+    def racing_canonical(codec, hash_dict):
+        calls.append(hash_dict)
+        if len(calls) == 1:
+            db.hset('character:1', 'ap', '9')  # An action spends AP between the read and the write
+        return canonical(codec, hash_dict)
+
+    monkeypatch.setattr(migrate_records, 'canonical', racing_canonical)
+
+    assert migrate_batch(db, ['character:1'], CHARACTERS) == 1
+    assert len(calls) == 2
+    assert db.hget('character:1', 'ap') == '9'
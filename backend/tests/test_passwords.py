@@ -0,0 +1,25 @@
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import passwords
+
+
+def test_shutdown_stops_only_the_pools_own_workers():
+    bystander = multiprocessing.get_context('spawn').Process(target=time.sleep, args=(30,))
+    bystander.start()
+    pool = ProcessPoolExecutor(max_workers=1, mp_context=passwords._WorkerContext())
+    pool.submit(time.sleep, 30)
+    time.sleep(0.5)
+    workers = list(passwords._workers)
+
+    try:
+        passwords._shutdown_pool(pool)
+        for worker in workers:
+            worker.join(5)
+
+        assert workers and not any(worker.is_alive() for worker in workers)
+        assert bystander.is_alive()
+    finally:
+        bystander.terminate()
+        bystander.join()
@@ -0,0 +1,41 @@
+import presence
+from presence import NODE_ID
+
+
+def test_join_and_leave_track_a_users_sockets(db):
+    assert presence.join('sid-1', 7) == 1
+    assert presence.join('sid-2', 7) == 2
+    assert presence.is_online(7)
+
+    assert presence.leave('sid-1', 7) == 1
+    assert presence.leave('sid-2', 7) == 0
+    assert not presence.is_online(7)
+    assert db.hgetall('presence:sids') == {}
+    assert db.smembers(f'presence:node:{NODE_ID}') == set()
+
+
+def test_leaving_a_socket_twice_changes_nothing(db):
+    presence.join('sid-1', 7)
+    presence.join('sid-2', 7)
+    presence.leave('sid-1', 7)
+
+    assert presence.leave('sid-1', 7) == 0
+    assert presence.get_user_sockets(7) == {'sid-2'}
+    assert presence.is_online(7)
+
+
+def test_purging_a_dead_node_drops_its_sockets_only(db):
+    presence.join('local', 7)
+    db.hset('presence:sids', mapping={'remote-1': 7, 'remote-2': 8})
+    db.sadd('presence:user:7', 'remote-1')
+    db.sadd('presence:user:8', 'remote-2')
+    db.sadd('presence:node:dead', 'remote-1', 'remote-2')
+    db.sadd('presence:online', 7, 8)
+    db.sadd('presence:nodes', 'dead')
+
+    presence.heartbeat()
+
+    assert presence.get_user_sockets(7) == {'local'}
+    assert presence.is_online(7) and not presence.is_online(8)
+    assert not db.exists('presence:node:dead')
+    assert db.smembers('presence:nodes') == {NODE_ID}
@@ -0,0 +1,14 @@
+from serializer import RawJSON, dumps_text, loads
+
+
+def test_raw_json_is_spliced_in_unchanged():
+    raw = RawJSON('{"b":[1, 2],"id":12345678901234567890}')
+
+    assert dumps_text({'logs': [raw], 'n': 1}) == '{"logs":[{"b":[1, 2],"id":12345678901234567890}],"n":1}'
+
+
+def test_strings_that_look_like_placeholders_stay_strings():
+    text = dumps_text(['\x00abc0', RawJSON('1')])
+
+    assert loads(text) == ['\x00abc0', 1]
+
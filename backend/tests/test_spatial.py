@@ -0,0 +1,52 @@
+import game_logic
+from models import commit_action, get_character
+from spatial import get_tile_occupants, tile_key
+from world_data import get_location
+
+
+def occupants(db, x, y, inside_building):
+    return db.zrange(tile_key(x, y, inside_building), 0, -1)
+
+
+def place(db, character_id, x, y):
+    """Put a character outside on (x, y), index entry included."""
+    db.zrem(tile_key(1, 1, False), character_id)
+    db.hset(f'character:{character_id}', mapping={'x': x, 'y': y, 'inside_building': 0})
+    db.zadd(tile_key(x, y, False), {character_id: character_id})
+
+
+def test_move_takes_the_index_entry_along(db, character_id):
+    result = game_logic.process_action(character_id, 'MOVE', {'direction': 'east'})
+
+    assert result['success']
+    assert occupants(db, 1, 1, False) == []
+    assert occupants(db, 2, 1, False) == [str(character_id)]
+
+
+def test_entering_and_leaving_a_building_moves_between_its_sides(db, character_id):
+    x, y = next((x, y) for x in range(20) for y in range(20) if get_location(x, y).has_building)
+    place(db, character_id, x, y)
+
+    assert game_logic.process_action(character_id, 'ENTER_BUILDING')['success']
+    assert occupants(db, x, y, False) == [] and occupants(db, x, y, True) == [str(character_id)]
+
+    assert game_logic.process_action(character_id, 'EXIT_BUILDING')['success']
+    assert occupants(db, x, y, True) == [] and occupants(db, x, y, False) == [str(character_id)]
+
+
+def test_move_decided_against_a_stale_position_is_not_written(db, character_id):
+    stale = get_character(character_id)
+    assert game_logic.process_action(character_id, 'MOVE', {'direction': 'east'})['success']
+
+    moved = commit_action(stale, updates={'x': 1, 'y': 0}, tile_move=(tile_key(1, 1, False), tile_key(1, 0, False)))
+
+    assert moved is None
+    assert get_character(character_id)['x'] == 2
+    assert occupants(db, 1, 0, False) == [] and occupants(db, 2, 1, False) == [str(character_id)]
+
+
+def test_occupants_page_in_id_order_with_names(db, character_id):
+    page = get_tile_occupants(1, 1, False, limit=1)
+
+    assert page == {'characters': [{'id': character_id, 'name': 'Tester'}], 'count': 1, 'next_after': character_id}
+    assert get_tile_occupants(1, 1, False, after=character_id)['characters'] == []
@@ -1,110 +1,362 @@
-from database import get_db, dict_to_redis_hash, redis_hash_to_dict
+from collections import OrderedDict, namedtuple
+import hashlib
+import json
+import os
+import threading
+from database import get_db
 
+# Channel used to tell every worker the world was reseeded
+WORLD_RESEED_CHANNEL = 'world:reseed'
 
-def initialize_world():
-    """Initialize the 3x3 world grid with locations."""
+# The world is stored and cached in square chunks of tiles
+CHUNK_SIZE = 16
+
+# Bounds and seed for a new world; an existing world keeps those in world:meta
+WORLD_WIDTH = int(os.environ.get('WORLD_WIDTH', 3))
+WORLD_HEIGHT = int(os.environ.get('WORLD_HEIGHT', 3))
+WORLD_SEED = os.environ.get('WORLD_SEED', 'default')
+
+# Chunks each process keeps in memory, least recently used dropped first
+WORLD_CHUNK_CACHE_SIZE = int(os.environ.get('WORLD_CHUNK_CACHE_SIZE', 1024))
+
+# Immutable, slotted record for one tile of the world
+Location = namedtuple('Location', [
+    'x', 'y', 'name', 'description', 'has_building', 'building_name', 'building_description'
+])
+
+# The hand-made town every new character starts in, at (0, 0)-(2, 2)
+STARTING_TOWN = [
+    # Row 0
+    (0, 0, 'Forest Edge', 'A dense forest borders this area to the north and west.', 1,
+     'Ranger Station', 'A small wooden station used by the local forest rangers.'),
+    (1, 0, 'North Road', 'A well-traveled road runs north to south.', 1,
+     'Roadside Inn', 'A cozy inn offering respite to weary travelers.'),
+    (2, 0, 'Eastern Hills', 'Rolling hills stretch to the east as far as the eye can see.', 1,
+     'Old Windmill', 'A weathered windmill creaks in the breeze.'),
+
+    # Row 1
+    (0, 1, 'Western Creek', 'A small creek flows from the northwest to the southeast.', 1,
+     'Fisherman\'s Hut', 'A simple wooden hut with fishing gear scattered around.'),
+    (1, 1, 'Town Square', 'The central hub of a small settlement.', 1,
+     'Town Hall', 'A modest but well-maintained building where town business is conducted.'),
+    (2, 1, 'Marketplace', 'Stalls are set up for traders and merchants.', 1,
+     'General Store', 'A store selling various goods and supplies.'),
+
+    # Row 2
+    (0, 2, 'Southwestern Farm', 'Tilled fields stretch across the landscape.', 1,
+     'Farmhouse', 'A rustic farmhouse with a smoking chimney.'),
+    (1, 2, 'South Road', 'A dusty road continues southward.', 1,
+     'Guard Post', 'A small outpost where guards keep watch over the southern approach.'),
+    (2, 2, 'Southeastern Meadow', 'A meadow full of wildflowers and tall grass.', 1,
+     'Abandoned Cottage', 'A partially ruined cottage, long since abandoned.')
+]
+
+# Terrain and buildings for procedurally generated tiles
+TERRAINS = [
+    ('Open Plains', 'Grassland rolls away in every direction.'),
+    ('Pine Forest', 'Tall pines crowd close, and the air smells of resin.'),
+    ('Rocky Hills', 'Boulders and scrub cover a run of low hills.'),
+    ('Marshland', 'Reeds and standing water make the going slow.'),
+    ('River Bank', 'A wide river slides past, brown and unhurried.'),
+    ('Dusty Track', 'A rutted track winds between the fields.'),
+    ('Birch Grove', 'Pale birches stand in a quiet clearing.'),
+    ('Stony Ridge', 'A bare ridge gives a long view over the land.')
+]
+BUILDINGS = [
+    ('Farmstead', 'A working farm with a barn and a few outbuildings.'),
+    ('Watchtower', 'A stone tower keeps watch over the surrounding land.'),
+    ('Ruined Chapel', 'Roofless walls are all that remain of a small chapel.'),
+    ('Trading Post', 'A timber post where travelers swap goods and news.'),
+    ('Hunting Lodge', 'A sturdy lodge hung with antlers and pelts.')
+]
+BUILDING_ONE_IN = 6
+
+# Chunks read and written per pipeline when storing tiles
+CHUNK_WRITE_BATCH = 256
+
+
+def chunk_key(cx, cy):
+    """The Redis key of the tiles stored for one chunk."""
+    return f'chunk:{cx}:{cy}'
+
+
+def tile_index(x, y):
+    """A tile's position within its chunk's row-major tile list."""
+    return (y % CHUNK_SIZE) * CHUNK_SIZE + x % CHUNK_SIZE
+
+
+def generate_location(seed, x, y):
+    """Generate the tile at (x, y) from the world seed; the same inputs always give the same tile."""
+    digest = hashlib.blake2b(f'{seed}:{x}:{y}'.encode('utf-8'), digest_size=8).digest()
+    value = int.from_bytes(digest, 'little')
+
+    name, description = TERRAINS[value % len(TERRAINS)]
+    value //= len(TERRAINS)
+
+    if value % BUILDING_ONE_IN:
+        return Location(x, y, name, description, False, None, None)
+
+    building_name, building_description = BUILDINGS[(value // BUILDING_ONE_IN) % len(BUILDINGS)]
+    return Location(x, y, name, description, True, building_name, building_description)
+
+
+def encode_chunk(entries):
+    """Encode a chunk's stored tiles: a row-major list with None for generated tiles."""
+    return json.dumps(entries, separators=(',', ':'))
+
+
+def decode_chunk(text):
+    """Decode a stored chunk, or None if nothing is stored for it."""
+    return json.loads(text) if text else None
+
+
+def location_entry(location):
+    """The stored form of one tile."""
+    return [
+        location.name,
+        location.description,
+        1 if location.has_building else 0,
+        location.building_name,
+        location.building_description
+    ]
+
+
+class World:
+    """One version of the world: its bounds plus an LRU cache of its chunks.
+
+    A chunk is loaded from Redis on first visit. Tiles with nothing stored are
+    generated from the world's seed, so only imported or hand-made tiles take
+    up space, and a map of millions of tiles costs memory only where visited.
+    """
+
+    __slots__ = ('version', 'width', 'height', 'seed', '_chunks', '_lock')
+
+    def __init__(self, version, width, height, seed):
+        self.version = version
+        self.width = width
+        self.height = height
+        self.seed = seed
+        self._chunks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def in_bounds(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def get(self, x, y):
+        """The Location at (x, y), or None outside the world."""
+        if not self.in_bounds(x, y):
+            return None
+        return self.get_chunk(x // CHUNK_SIZE, y // CHUNK_SIZE)[tile_index(x, y)]
+
+    def get_chunk(self, cx, cy):
+        """Every Location in a chunk, row-major, loading it on a cache miss."""
+        key = (cx, cy)
+        with self._lock:
+            chunk = self._chunks.get(key)
+            if chunk is not None:
+                self._chunks.move_to_end(key)
+                return chunk
+
+        # Load outside the lock; two threads loading the same chunk is harmless
+        chunk = self._load_chunk(cx, cy)
+
+        with self._lock:
+            self._chunks[key] = chunk
+            self._chunks.move_to_end(key)
+            while len(self._chunks) > WORLD_CHUNK_CACHE_SIZE:
+                self._chunks.popitem(last=False)
+        return chunk
+
+    def _load_chunk(self, cx, cy):
+        stored = decode_chunk(get_db().get(chunk_key(cx, cy)))
+
+        tiles = []
+        for ly in range(CHUNK_SIZE):
+            for lx in range(CHUNK_SIZE):
+                x, y = cx * CHUNK_SIZE + lx, cy * CHUNK_SIZE + ly
+                entry = stored[ly * CHUNK_SIZE + lx] if stored else None
+                if entry:
+                    name, description, has_building, building_name, building_description = entry
+                    tiles.append(Location(x, y, name, description, bool(has_building),
+                                          building_name or None, building_description or None))
+                else:
+                    tiles.append(generate_location(self.seed, x, y))
+        return tuple(tiles)
+
+
+# The world loaded by this process; None until first use or after a reseed
+_world = None
+_world_lock = threading.Lock()
+
+
+def initialize_world(reseed=False):
+    """Initialize the world metadata and the starting town.
+
+    Pass ``reseed=True`` to rewrite an existing world. Either way the world
+    version is bumped and every worker is told to drop its cached chunks.
+    """
     db = get_db()
 
     # Check if world already initialized
-    if db.exists('world:initialized'):
+    if not reseed and db.exists('world:meta'):
         return  # World already initialized
 
-    # Create the 3x3 grid
-    locations = [
-        # Row 0
-        (0, 0, 'Forest Edge', 'A dense forest borders this area to the north and west.', 1,
-         'Ranger Station', 'A small wooden station used by the local forest rangers.'),
-        (1, 0, 'North Road', 'A well-traveled road runs north to south.', 1,
-         'Roadside Inn', 'A cozy inn offering respite to weary travelers.'),
-        (2, 0, 'Eastern Hills', 'Rolling hills stretch to the east as far as the eye can see.', 1,
-         'Old Windmill', 'A weathered windmill creaks in the breeze.'),
-
-        # Row 1
-        (0, 1, 'Western Creek', 'A small creek flows from the northwest to the southeast.', 1,
-         'Fisherman\'s Hut', 'A simple wooden hut with fishing gear scattered around.'),
-        (1, 1, 'Town Square', 'The central hub of a small settlement.', 1,
-         'Town Hall', 'A modest but well-maintained building where town business is conducted.'),
-        (2, 1, 'Marketplace', 'Stalls are set up for traders and merchants.', 1,
-         'General Store', 'A store selling various goods and supplies.'),
-
-        # Row 2
-        (0, 2, 'Southwestern Farm', 'Tilled fields stretch across the landscape.', 1,
-         'Farmhouse', 'A rustic farmhouse with a smoking chimney.'),
-        (1, 2, 'South Road', 'A dusty road continues southward.', 1,
-         'Guard Post', 'A small outpost where guards keep watch over the southern approach.'),
-        (2, 2, 'Southeastern Meadow', 'A meadow full of wildflowers and tall grass.', 1,
-         'Abandoned Cottage', 'A partially ruined cottage, long since abandoned.')
-    ]
+    set_world_meta(db, WORLD_WIDTH, WORLD_HEIGHT, WORLD_SEED)
 
-    # Insert locations into Redis
-    pipe = db.pipeline()
+    town = [Location(*tile[:4], bool(tile[4]), *tile[5:]) for tile in STARTING_TOWN]
+    write_tiles(db, town)
 
-    for loc in locations:
-        x, y, name, desc, has_building, b_name, b_desc = loc
+    db.set('world:initialized', '1')
+    bump_world_version(db)
 
-        location_data = {
-            'x': x,
-            'y': y,
-            'name': name,
-            'description': desc,
-            'has_building': has_building,
-            'building_name': b_name,
-            'building_description': b_desc
-        }
 
-        # Store location data
-        pipe.hmset(f'location:{x}:{y}', dict_to_redis_hash(location_data))
+def set_world_meta(db, width, height, seed):
+    """Store the world's bounds and seed."""
+    db.hset('world:meta', mapping={
+        'width': width,
+        'height': height,
+        'seed': seed,
+        'chunk_size': CHUNK_SIZE
+    })
+
+
+def write_tiles(db, locations):
+    """Store Locations in their chunks, merged with the tiles already stored there."""
+    chunks = {}
+    for location in locations:
+        chunk = chunks.setdefault((location.x // CHUNK_SIZE, location.y // CHUNK_SIZE), {})
+        chunk[tile_index(location.x, location.y)] = location_entry(location)
+    return write_chunk_entries(db, chunks)
+
+
+def write_chunk_entries(db, chunks):
+    """Merge ``{(cx, cy): {tile index: entry}}`` into the stored chunks.
+
+    Chunks are read and written in pipelined batches. Returns how many
+    chunks were written. Callers bump the world version afterwards.
+    """
+    items = list(chunks.items())
+    for start in range(0, len(items), CHUNK_WRITE_BATCH):
+        batch = items[start:start + CHUNK_WRITE_BATCH]
+        stored = db.mget([chunk_key(cx, cy) for (cx, cy), _ in batch])
+
+        pipe = db.pipeline(transaction=False)
+        for ((cx, cy), tiles), text in zip(batch, stored):
+            entries = decode_chunk(text) or [None] * (CHUNK_SIZE * CHUNK_SIZE)
+            for index, entry in tiles.items():
+                entries[index] = entry
+            pipe.set(chunk_key(cx, cy), encode_chunk(entries))
+        pipe.execute()
+
+    return len(items)
+
+
+def bump_world_version(db):
+    """Bump the world version and tell every worker (including this one) to reload."""
+    version = db.incr('world:version')
+    db.publish(WORLD_RESEED_CHANNEL, version)
+    invalidate_world()
+    return version
+
+
+def load_world():
+    """Load the world's version and metadata; chunks load later, on first visit."""
+    db = get_db()
+
+    pipe = db.pipeline(transaction=False)
+    pipe.get('world:version')
+    pipe.hgetall('world:meta')
+    version, meta = pipe.execute()
+
+    return World(
+        int(version or 0),
+        int(meta.get('width', WORLD_WIDTH)),
+        int(meta.get('height', WORLD_HEIGHT)),
+        meta.get('seed', WORLD_SEED)
+    )
 
-    # Set flag that world is initialized
-    pipe.set('world:initialized', '1')
 
-    # Execute all commands
-    pipe.execute()
+def get_world():
+    """Get this process's world, loading it on first use."""
+    global _world
+
+    world = _world
+    if world is None:
+        with _world_lock:
+            if _world is None:
+                _world = load_world()
+            world = _world
+    return world
+
+
+def invalidate_world(version=None):
+    """Drop the cached world so the next read reloads it.
+
+    If ``version`` is given, the world is kept when it is already that version.
+    """
+    global _world
+
+    with _world_lock:
+        if version is None or _world is None or _world.version != int(version):
+            _world = None
+
+
+def start_world_listener(db):
+    """Listen for world reseeds in a background thread and invalidate on each."""
+    pubsub = db.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(**{WORLD_RESEED_CHANNEL: lambda message: invalidate_world(message['data'])})
+    return pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+
+def get_location(x, y):
+    """Get the Location at (x, y), or None outside the world."""
+    return get_world().get(x, y)
+
+
+def get_world_bounds():
+    """The world's (width, height) in tiles."""
+    world = get_world()
+    return world.width, world.height
+
+
+def get_world_version():
+    """The version of the world this process has loaded, bumped on every reseed."""
+    return get_world().version
 
 
 def get_location_info(x, y, inside_building):
     """Get information about a location."""
-    db = get_db()
+    return format_location_info(get_location(x, y), inside_building)
 
-    # Get location data
-    location_data = db.hgetall(f'location:{x}:{y}')
 
+def format_location_info(location, inside_building):
+    """Format a Location for a player inside or outside its building."""
     # If no location data found, return default
-    if not location_data:
+    if not location:
         return {
             'name': 'Unknown Area',
             'description': 'You seem to be lost.'
         }
 
-    # Convert Redis hash to Python dict
-    location_dict = redis_hash_to_dict(location_data)
-
     # Format response based on whether player is inside or outside
     if inside_building:
         return {
-            'name': location_dict['building_name'],
-            'description': location_dict['building_description'],
+            'name': location.building_name,
+            'description': location.building_description,
             'inside_building': True,
-            'building_name': location_dict['building_name']
+            'building_name': location.building_name
         }
     else:
         return {
-            'name': location_dict['name'],
-            'description': location_dict['description'],
+            'name': location.name,
+            'description': location.description,
             'inside_building': False,
-            'has_building': bool(int(location_dict['has_building'])),
-            'building_name': location_dict['building_name'] if int(location_dict['has_building']) else None
+            'has_building': location.has_building,
+            'building_name': location.building_name if location.has_building else None
         }
 
 
 def location_has_building(x, y):
     """Check if a location has a building."""
-    db = get_db()
-
-    # Get has_building field from location
-    has_building = db.hget(f'location:{x}:{y}', 'has_building')
-
-    if not has_building:
-        return False
-
-    return bool(int(has_building))
\ No newline at end of file
+    location = get_location(x, y)
+    return bool(location and location.has_building)
@@ -0,0 +1,85 @@
+"""Bulk import tiles into the chunked world store.
+
+Usage:
+    python world_import.py tiles.tsv [--width W] [--height H] [--seed S]
+
+The tile file holds one tab-separated tile per line:
+
+    x  y  name  description  has_building  building_name  building_description
+
+with has_building as 1 or 0 and the building fields empty when there is none.
+The file is memory mapped and parsed line by line. Tiles are grouped by
+chunk and written in pipelined batches, merged with whatever is already
+stored, so a region of a million tiles is a few thousand chunk writes. The
+world version is bumped at the end, so every worker drops its cached chunks.
+"""
+import argparse
+import mmap
+
+from database import get_db
+from world_data import (CHUNK_SIZE, WORLD_WIDTH, WORLD_HEIGHT, WORLD_SEED, tile_index,
+                        write_chunk_entries, set_world_meta, bump_world_version)
+
+# Chunks buffered in memory before they are merged into Redis
+BUFFERED_CHUNKS = 4096
+
+
+def parse_tile(line):
+    """Parse one tile file line into ((cx, cy), tile index, stored entry)."""
+    x, y, name, description, has_building, building_name, building_description = \
+        line.decode('utf-8').rstrip('\r\n').split('\t')
+    x, y = int(x), int(y)
+    entry = [name, description, 1 if has_building == '1' else 0, building_name or None, building_description or None]
+    return (x // CHUNK_SIZE, y // CHUNK_SIZE), tile_index(x, y), entry
+
+
+def import_tiles(db, path):
+    """Import a tile file; returns (tiles, chunk writes)."""
+    tiles = writes = 0
+    chunks = {}
+
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        for line in iter(data.readline, b''):
+            if not line.strip() or line.startswith(b'#'):
+                continue
+
+            chunk, index, entry = parse_tile(line)
+            chunks.setdefault(chunk, {})[index] = entry
+            tiles += 1
+
+            if len(chunks) >= BUFFERED_CHUNKS:
+                writes += write_chunk_entries(db, chunks)
+                chunks = {}
+
+    if chunks:
+        writes += write_chunk_entries(db, chunks)
+    return tiles, writes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk import tiles into the world.')
+    parser.add_argument('path', help='tab-separated tile file')
+    parser.add_argument('--width', type=int, help='set the world width in tiles')
+    parser.add_argument('--height', type=int, help='set the world height in tiles')
+    parser.add_argument('--seed', help='set the seed for tiles that are not stored')
+    args = parser.parse_args()
+
+    db = get_db()
+
+    if args.width or args.height or args.seed:
+        # Settings not given keep their stored values, or the defaults the world loads with
+        meta = db.hgetall('world:meta')
+        set_world_meta(
+            db,
+            args.width or int(meta.get('width', WORLD_WIDTH)),
+            args.height or int(meta.get('height', WORLD_HEIGHT)),
+            args.seed or meta.get('seed', WORLD_SEED)
+        )
+
+    tiles, writes = import_tiles(db, args.path)
+    version = bump_world_version(db)
+    print(f'Imported {tiles} tiles in {writes} chunk writes (world version {version})')
+
+
+if __name__ == '__main__':
+    main()
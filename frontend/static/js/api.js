@@ -79,12 +79,19 @@ class GameAPI {
     }
     
     /**
-     * Get action logs
+     * Get a page of action logs, newest first
+     * @param {number|null} before - Cursor from a previous page's next_before
+     * @param {number} limit - Maximum number of entries to return
      * @returns {Promise<Array>} Action logs
      */
-    static async getLogs() {
+    static async getLogs(before = null, limit = 10) {
         try {
-            const response = await fetch('/api/logs', {
+            const params = new URLSearchParams({ limit: limit });
+            if (before !== null) {
+                params.set('before', before);
+            }
+
+            const response = await fetch(`/api/logs?${params}`, {
                 method: 'GET',
                 headers: {
                     'Accept': 'application/json'
@@ -95,7 +102,8 @@ class GameAPI {
                 throw new Error('Failed to fetch logs');
             }
             
-            return await response.json();
+            const page = await response.json();
+            return page.logs;
         } catch (error) {
             console.error('Error fetching logs:', error);
             return [];
@@ -37,11 +37,16 @@ document.addEventListener('DOMContentLoaded', function() {
             // Action logs
             logs: [],
 
+            // Other characters on the same side of the tile
+            occupants: [],
+
             // Available actions
             availableActions: [],
 
-            // Map data
+            // Map data: a mapSize x mapSize view of the world around the character
             mapSize: 3,
+            worldWidth: 3,
+            worldHeight: 3,
             mapTiles: [],
             currentX: 1,
             currentY: 1,
@@ -106,9 +111,13 @@ document.addEventListener('DOMContentLoaded', function() {
              * Initialize the map grid
              */
             initializeMap() {
+                // Center the view on the character, keeping it inside the world
+                const originX = Math.max(0, Math.min(this.currentX - 1, this.worldWidth - this.mapSize));
+                const originY = Math.max(0, Math.min(this.currentY - 1, this.worldHeight - this.mapSize));
+
                 this.mapTiles = [];
-                for (let y = 0; y < this.mapSize; y++) {
-                    for (let x = 0; x < this.mapSize; x++) {
+                for (let y = originY; y < Math.min(originY + this.mapSize, this.worldHeight); y++) {
+                    for (let x = originX; x < Math.min(originX + this.mapSize, this.worldWidth); x++) {
                         this.mapTiles.push({
                             x: x,
                             y: y,
@@ -157,6 +166,53 @@ document.addEventListener('DOMContentLoaded', function() {
                     this.logs = data;
                 });
 
+                // Characters arriving at and leaving this tile
+                socket.on('occupant_entered', (occupant) => {
+                    if (occupant.id !== this.character.id && !this.occupants.some(o => o.id === occupant.id)) {
+                        this.occupants.push(occupant);
+                    }
+                });
+
+                socket.on('occupant_left', (occupant) => {
+                    this.occupants = this.occupants.filter(o => o.id !== occupant.id);
+                });
+
+                // After an action the server sends only what changed
+                socket.on('state_patch', (patch) => {
+                    if (patch.character) {
+                        const moved = ['x', 'y', 'inside_building'].some(key => key in patch.character);
+                        this.character = Object.assign({}, this.character, patch.character);
+                        this.currentX = this.character.x;
+                        this.currentY = this.character.y;
+                        this.updateMapTiles();
+
+                        // Follow the character to its new tile room and list who is there
+                        if (moved) {
+                            socket.emit('watch_tile');
+                            this.fetchOccupants();
+                        }
+                    }
+
+                    if (patch.location) {
+                        this.location = patch.location;
+                    }
+
+                    if (patch.actions) {
+                        this.availableActions = patch.actions;
+                    }
+
+                    if (patch.logs) {
+                        // New entries arrive newest first; skip any already shown
+                        const shown = new Set(this.logs.map(log => log.id));
+                        const fresh = patch.logs.filter(log => !shown.has(log.id));
+                        this.logs = fresh.concat(this.logs).slice(0, 10);
+                    }
+
+                    if (patch.message) {
+                        this.showToastMessage(patch.message, 'success');
+                    }
+                });
+
                 // Messages and errors
                 socket.on('message', (data) => {
                     this.showToastMessage(data.text, 'success');
@@ -172,6 +228,14 @@ document.addEventListener('DOMContentLoaded', function() {
              */
             async fetchInitialData() {
                 try {
+                    // Get the world's bounds for the map view
+                    const worldResponse = await fetch('/api/world');
+                    if (worldResponse.ok) {
+                        const world = await worldResponse.json();
+                        this.worldWidth = world.width;
+                        this.worldHeight = world.height;
+                    }
+
                     // Get character data
                     const characterResponse = await fetch('/api/character');
                     if (characterResponse.ok) {
@@ -193,24 +257,40 @@ document.addEventListener('DOMContentLoaded', function() {
                         this.availableActions = await actionsResponse.json();
                     }
 
-                    // Get action logs
-                    const logsResponse = await fetch('/api/logs');
+                    // Get the most recent page of action logs
+                    const logsResponse = await fetch('/api/logs?limit=10');
                     if (logsResponse.ok) {
-                        this.logs = await logsResponse.json();
+                        this.logs = (await logsResponse.json()).logs;
                     }
+
+                    await this.fetchOccupants();
                 } catch (error) {
                     console.error('Error fetching initial data:', error);
                     this.showToastMessage('Error loading game data', 'error');
                 }
             },
 
+            /**
+             * Fetch the first page of other characters on this tile
+             */
+            async fetchOccupants() {
+                try {
+                    const response = await fetch('/api/location/occupants?limit=20');
+                    if (response.ok) {
+                        const page = await response.json();
+                        this.occupants = page.characters.filter(o => o.id !== this.character.id);
+                    }
+                } catch (error) {
+                    console.error('Error fetching occupants:', error);
+                }
+            },
+
             /**
              * Update map tiles based on current position
              */
             updateMapTiles() {
-                this.mapTiles.forEach(tile => {
-                    tile.current = (tile.x === this.currentX && tile.y === this.currentY);
-                });
+                // The view follows the character across the world
+                this.initializeMap();
             },
 
             /**
@@ -325,6 +405,10 @@ document.addEventListener('DOMContentLoaded', function() {
                                 this.updateMapTiles();
                             }
 
+                            if (result.previous_tile) {
+                                this.fetchOccupants();
+                            }
+
                             // Update location
                             if (result.location) {
                                 this.location = result.location;